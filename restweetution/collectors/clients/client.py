@@ -12,6 +12,8 @@ from tweepy import BadRequest, Unauthorized, Forbidden, NotFound, TooManyRequest
 from tweepy.asynchronous import AsyncClient
 from yarl import URL
 
+from restweetution import http_session
+
 log = logging.getLogger(__name__)
 
 
@@ -27,7 +29,22 @@ class RateLimit(BaseModel):
         return self.reset - now
 
 
-class Client(AsyncClient):
+class PooledAsyncClient(AsyncClient):
+    """
+    tweepy AsyncClient using the shared twitter session instead of a new session per request
+    """
+
+    @property
+    def session(self):
+        return http_session.get_session(http_session.TWITTER)
+
+    @session.setter
+    def session(self, value):
+        # set to None by AsyncClient.__init__, the shared session is always used
+        pass
+
+
+class Client(PooledAsyncClient):
     def __init__(
             self, bearer_token=None, consumer_key=None, consumer_secret=None,
             access_token=None, access_token_secret=None, *, return_type=Response,
@@ -2,13 +2,18 @@ import asyncio
 import logging
 from typing import Callable, List
 
-import aiohttp
 from aiohttp import ClientTimeout
 
+from restweetution import serializer, http_session
 from restweetution.models.config.query_fields import QueryFields
 from restweetution.models.config.user_config import RuleConfig
 from restweetution.models.rule import StreamRuleResponse, StreamAPIRule
 
+# rules requests
+REQUEST_TIMEOUT = ClientTimeout(total=60)
+# the stream has no end, twitter sends a keep-alive line every 20 seconds: a silent stream is reconnected
+STREAM_TIMEOUT = ClientTimeout(total=None, sock_connect=30, sock_read=90)
+
 
 class StreamerClient:
     def __init__(self, token: str, base_url: str = "https://api.twitter.com", error_handler: Callable = None):
@@ -17,19 +22,15 @@ class StreamerClient:
         self._headers = {"Authorization": f"Bearer {token}"}
         self._error_handler = error_handler
         self._logger = logging.getLogger("ApiClient")
-        self._client = None
 
-    def _get_client(self):
+    def _request(self, method: str, uri: str, session_name=http_session.TWITTER, timeout=REQUEST_TIMEOUT, **kwargs):
         """
-        Get an aiohttp Client Session that will close correctly
-        @return:
+        Request on a shared session, the connection is kept alive for the next calls
+        @param session_name: http_session name, STREAM for the tweet stream
+        @return: the request context manager of aiohttp
         """
-        connector = aiohttp.TCPConnector(force_close=True, enable_cleanup_closed=True)
-        self._client = aiohttp.ClientSession(headers=self._headers,
-                                             timeout=ClientTimeout(),
-                                             base_url=self.base_url,
-                                             connector=connector)
-        return self._client
+        session = http_session.get_session(session_name)
+        return session.request(method, self.base_url + uri, headers=self._headers, timeout=timeout, **kwargs)
 
     def set_error_handler(self, error_handler: Callable):
         self._error_handler = error_handler
@@ -44,11 +45,12 @@ class StreamerClient:
         wait_time = 0
         while True:
             try:
-                async with self._get_client() as session:
-                    async with session.get("/2/tweets/search/stream", params=fields.twitter_format(join='.')) as resp:
-                        async for line in resp.content:
-                            # print(resp.headers)
-                            yield line
+                params = fields.twitter_format(join='.')
+                async with self._request('GET', "/2/tweets/search/stream", session_name=http_session.STREAM,
+                                         timeout=STREAM_TIMEOUT, params=params) as resp:
+                    async for line in resp.content:
+                        # print(resp.headers)
+                        yield line
             except KeyboardInterrupt as e:
                 raise e
             except Exception as e:
@@ -66,19 +68,17 @@ class StreamerClient:
         """
 
         uri = "/2/tweets/search/stream/rules"
-        # session = self._get_client()
-        async with self._get_client() as session:
-            async with session.post(uri, json={"delete": {"ids": ids}}) as r:
-                res = await r.json()
+        async with self._request('POST', uri, json={"delete": {"ids": ids}}) as r:
+            res = await r.json(loads=serializer.loads)
 
-                # if everything went fine we return the ids of the deleted rules
-                if "errors" not in res:
-                    self._logger.info(f'Removed {res["meta"]["summary"]["deleted"]} rule(s)')
-                    return ids
+            # if everything went fine we return the ids of the deleted rules
+            if "errors" not in res:
+                self._logger.info(f'Removed {res["meta"]["summary"]["deleted"]} rule(s)')
+                return ids
 
-                # if not, return no ids as we can't know what rule failed or not
-                self._logger.error(res)
-            return []
+            # if not, return no ids as we can't know what rule failed or not
+            self._logger.error(res)
+        return []
 
     async def get_rules(self, ids: List[str] = None) -> List[StreamAPIRule]:
         """
@@ -91,17 +91,15 @@ class StreamerClient:
         uri = "/2/tweets/search/stream/rules"
         if ids:
             uri += f"?ids={','.join(ids)}"
-        # session = self._get_client()
-        async with self._get_client() as session:
-            async with session.get(uri) as r:
-                res = await r.json()
-                if not res.get('data'):
-                    res['data'] = []
-                # print(res)
-                res = StreamRuleResponse(**res)
-                # rules = [StreamerRule(tag=r.tag, query=r.value, api_id=r.id) for r in res.data]
-                rules = res.data
-                return rules
+        async with self._request('GET', uri) as r:
+            res = await r.json(loads=serializer.loads)
+            if not res.get('data'):
+                res['data'] = []
+            # print(res)
+            res = StreamRuleResponse(**res)
+            # rules = [StreamerRule(tag=r.tag, query=r.value, api_id=r.id) for r in res.data]
+            rules = res.data
+            return rules
 
     async def add_rules(self, rules: List[StreamAPIRule]):
         """
@@ -111,17 +109,16 @@ class StreamerClient:
         """
         uri = "/2/tweets/search/stream/rules"
         rules_data = [{'tag': r.tag, 'value': r.value} for r in rules]
-        async with self._get_client() as session:
-            async with session.post(uri, json={"add": rules_data}) as r:
-                res = await r.json()
-                valid_rules = []
-                if 'errors' in res:
-                    errs = res['errors']
-                    for err in errs:
-                        self._logger.info(f"add_rules Error: {err['title']} Rule: {err['value']}")
-                if 'data' in res:
-                    valid_rules = res['data']
-                return [StreamAPIRule(**r) for r in valid_rules]
+        async with self._request('POST', uri, json={"add": rules_data}) as r:
+            res = await r.json(loads=serializer.loads)
+            valid_rules = []
+            if 'errors' in res:
+                errs = res['errors']
+                for err in errs:
+                    self._logger.info(f"add_rules Error: {err['title']} Rule: {err['value']}")
+            if 'data' in res:
+                valid_rules = res['data']
+            return [StreamAPIRule(**r) for r in valid_rules]
 
     async def test_rule(self, rule: RuleConfig):
         """
@@ -131,9 +128,8 @@ class StreamerClient:
         """
         uri = "/2/tweets/search/stream/rules"
         rule_data = [{'tag': rule.tag, 'value': rule.query}]
-        async with self._get_client() as session:
-            async with session.post(uri, json={"add": rule_data}, params={'dry_run': 'true'}) as r:
-                res = await r.json()
-                valid = 'errors' not in res
-                error = None if valid else res['errors']
-                return {'valid': valid, 'error': error}
+        async with self._request('POST', uri, json={"add": rule_data}, params={'dry_run': 'true'}) as r:
+            res = await r.json(loads=serializer.loads)
+            valid = 'errors' not in res
+            error = None if valid else res['errors']
+            return {'valid': valid, 'error': error}
@@ -8,8 +8,9 @@ from typing import Callable, List, Optional
 
 import aiohttp
 import tweepy.errors
-from tweepy.asynchronous import AsyncClient
 
+from restweetution import serializer
+from restweetution.collectors.clients.client import PooledAsyncClient
 from restweetution.collectors.response_parser import parse_includes
 from restweetution.models.bulk_data import BulkData
 from restweetution.models.config.query_fields import QueryFields
@@ -30,7 +31,7 @@ class Searcher:
         super().__init__()
 
         self.storage = storage
-        self._client = AsyncClient(bearer_token=bearer_token, return_type=aiohttp.ClientResponse)
+        self._client = PooledAsyncClient(bearer_token=bearer_token, return_type=aiohttp.ClientResponse)
 
         self._rule: Optional[Rule] = None
         self._fields: QueryFields = ALL_CONFIG
@@ -342,7 +343,7 @@ class Searcher:
                     resp = await get_function(query=query, **kwargs)
 
                 async with resp:
-                    res = TweetPyLookupResponse(**await resp.json())
+                    res = TweetPyLookupResponse(**serializer.loads(await resp.read()))
 
                 if res.meta and 'next_token' in res.meta:
                     next_token = res.meta['next_token']
@@ -0,0 +1,104 @@
+"""
+Parsing of the lines sent by the Twitter Stream API
+Functions are kept at module level so they can be sent to a process pool
+"""
+from typing import List
+
+from restweetution import serializer
+from restweetution.errors import ResponseParseError, TwitterAPIError, UnreadableResponseError
+from restweetution.models.twitter.tweet import TweetResponse
+from restweetution.storages.postgres_jsonb_storage.bulk_rows import BulkRows
+
+
+def _load_line(line: bytes) -> dict | None:
+    """
+    Decode one line of the stream to a json object
+    :return: the json object or None if the line is a keep alive signal
+    """
+    # if line is empty log message
+    if not line:
+        return None
+
+    # parse to utf-8
+    try:
+        txt = line.decode('utf-8')
+    except Exception as e:
+        raise UnreadableResponseError('Failed to parse the server response to utf-8') from e
+
+    # ignore line return
+    if txt == '\r\n':
+        return None
+
+    # try parsing to json
+    try:
+        return serializer.loads(txt)
+    except Exception as e:
+        raise ResponseParseError('Failed to parse the server response to json', raw_text=txt) from e
+
+
+def parse_stream_line(line: bytes) -> TweetResponse | None:
+    """
+    Parse one line of the stream into a TweetResponse
+    Full pydantic validation, the rows parser is used by default
+    :param line: bytes to be parsed
+    :return: the TweetResponse or None if the line is a keep alive signal
+    """
+    data = _load_line(line)
+    if data is None:
+        return None
+
+    # Parse json object with pydantic
+    try:
+        return TweetResponse(**data)
+    except Exception as e:
+        # If there is a Twitter API Error we assume the parsing failed because of this. Probably no data
+        if 'errors' in data:
+            raise TwitterAPIError('Streamer response has error field', data=data)
+
+        raise ResponseParseError('Failed to parse the json response with pydantic', data=data) from e
+
+
+class RowsResponse:
+    """
+    Result of parse_stream_line_rows, the rule matches are added by the streamer that knows the rules
+    """
+    __slots__ = ('rows', 'tweet_id', 'text', 'include_tweet_ids', 'matching_rules', 'errors')
+
+    def __init__(self, rows: BulkRows, tweet_id: str, text: str, include_tweet_ids: List[str],
+                 matching_rules: List[str], errors: List[dict] | None):
+        self.rows = rows
+        self.tweet_id = tweet_id
+        self.text = text
+        self.include_tweet_ids = include_tweet_ids
+        self.matching_rules = matching_rules
+        self.errors = errors
+
+
+def parse_stream_line_rows(line: bytes) -> RowsResponse | None:
+    """
+    Parse one line of the stream straight into table rows, without pydantic models
+    Only the structure needed to save the data is checked
+    :param line: bytes to be parsed
+    :return: the RowsResponse or None if the line is a keep alive signal
+    """
+    data = _load_line(line)
+    if data is None:
+        return None
+
+    try:
+        tweet = data['data']
+        rows = BulkRows()
+        rows.add_response(data)
+        includes = data.get('includes') or {}
+        return RowsResponse(rows=rows,
+                            tweet_id=tweet['id'],
+                            text=tweet.get('text'),
+                            include_tweet_ids=[t['id'] for t in includes.get('tweets', ())],
+                            matching_rules=[r['id'] for r in data.get('matching_rules') or ()],
+                            errors=data.get('errors'))
+    except Exception as e:
+        # If there is a Twitter API Error we assume the parsing failed because of this. Probably no data
+        if 'errors' in data:
+            raise TwitterAPIError('Streamer response has error field', data=data)
+
+        raise ResponseParseError('Failed to parse the json response to rows', data=data) from e
@@ -1,31 +1,63 @@
 import asyncio
 import datetime
-import json
 import logging
+import time
 import traceback
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Dict, Optional
 
+from pydantic import BaseModel
+
 from restweetution.collectors.response_parser import parse_includes
+from restweetution.collectors.stream_parser import parse_stream_line, parse_stream_line_rows, RowsResponse
 from restweetution.errors import ResponseParseError, TwitterAPIError, StorageError, set_error_handler, handle_error, \
-    UnreadableResponseError, RESTweetutionError
+    RESTweetutionError
 from restweetution.models.bulk_data import BulkData
 from restweetution.models.config.query_fields_preset import ALL_CONFIG
 from restweetution.models.config.query_fields import QueryFields
 from restweetution.models.config.user_config import RuleConfig
+from restweetution.models.metrics import StageMetrics
 from restweetution.models.rule import StreamerRule
 from restweetution.models.storage.error import ErrorModel
 from restweetution.models.twitter.tweet import TweetResponse
+from restweetution.storages.bulk_writer import BulkWriter, BulkWriterStatus
 from restweetution.storages.postgres_jsonb_storage.postgres_jsonb_storage import PostgresJSONBStorage
 from restweetution.collectors.clients.streamer_client import StreamerClient
 from restweetution.utils import AsyncEvent, fire_and_forget
 
 logger = logging.getLogger('Streamer')
 
+# seconds given to the parser to handle the lines already read when the collection stops
+STOP_DRAIN_TIMEOUT = 10
+
+
+class StreamerPipelineStatus(BaseModel):
+    parser_workers: int
+    parse_queue_size: int
+    handoff_queue_size: int
+    parse: StageMetrics
+    build: StageMetrics
+    writer: BulkWriterStatus
+
 
 class Streamer:
-    def __init__(self, bearer_token, storage: PostgresJSONBStorage, verbose: bool = False):
+    def __init__(self,
+                 bearer_token,
+                 storage: PostgresJSONBStorage,
+                 verbose: bool = False,
+                 parse_queue_size: int = 10000,
+                 flush_size: int = 500,
+                 flush_delay: float = 0.2,
+                 max_pending: int = 5000,
+                 parser_workers: int = 0,
+                 validate: bool = False):
         """
         The Streamer is the class used to connect to the Twitter Stream API and fetch live tweets
+        Parsed tweets are merged and saved in batches of flush_size tweets or every flush_delay seconds
+        With parser_workers > 0 the lines are decoded and validated in a process pool,
+        results are still handed to the storage in the order of the stream
+        By default lines are converted straight to table rows (BulkRows),
+        validate=True parses them with the pydantic models instead, useful to debug the API responses
         """
         # Member declaration before super constructor
         self._params = None
@@ -55,7 +87,18 @@ class Streamer:
         self.event_collect = AsyncEvent()
 
         self._parse_task: Optional[asyncio.Task] = None
-        self._parse_queue = asyncio.Queue()
+        # bounded, the stream reader waits when the parser or the writer fall behind
+        self._parse_queue = asyncio.Queue(maxsize=parse_queue_size)
+        # parser pool, created on first use
+        self._parser_workers = parser_workers
+        self._parse_func = parse_stream_line if validate else parse_stream_line_rows
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # futures of the lines being parsed, in stream order
+        self._handoff_queue = asyncio.Queue(maxsize=max(parser_workers * 4, 1))
+        self._parse_metrics = StageMetrics()
+        self._build_metrics = StageMetrics()
+        self._writer = BulkWriter(storage=storage, callback=self.event_collect, max_tweets=flush_size,
+                                  max_delay=flush_delay, max_pending=max_pending)
 
     async def verify_api_sync(self):
         api_rules = await self.get_api_rules()
@@ -234,20 +277,28 @@ class Streamer:
     #     for id_ in ids:
     #         self._api_id_to_rule.pop(id_)
 
-    def _log_tweets(self, tweet: TweetResponse):
+    def _log_tweets(self, tweet_id: str, text: str | None):
         self._tweet_count += 1
         fire_and_forget(self.event_update())
         if self._verbose:
-            text = tweet.data.text.split('\n')[0]
+            text = (text or '').split('\n')[0]
             if len(text) > 80:
                 text = text[0:80] + '..'
-            logger.info(f'id: {tweet.data.id} - {text}')
+            logger.info(f'id: {tweet_id} - {text}')
         if self._tweet_count % 10 == 0:
             logger.info(f'{self._tweet_count} tweets collected')
 
     def get_count(self):
         return self._tweet_count
 
+    def get_pipeline_status(self):
+        return StreamerPipelineStatus(parser_workers=self._parser_workers,
+                                      parse_queue_size=self._parse_queue.qsize(),
+                                      handoff_queue_size=self._handoff_queue.qsize(),
+                                      parse=self._parse_metrics,
+                                      build=self._build_metrics,
+                                      writer=self._writer.status())
+
     async def _main_error_handler(self, error: Exception):
         trace = traceback.format_exc()
         logger.exception(trace)
@@ -263,7 +314,7 @@ class Streamer:
         The bulk_data is then given to the storage manager for saving
         :params tweet_res: the tweet response object
         """
-        self._log_tweets(tweet_res)
+        self._log_tweets(tweet_res.data.id, tweet_res.data.text)
 
         bulk_data = BulkData()
 
@@ -295,6 +346,26 @@ class Streamer:
         bulk_data.add_rules(rules)
         return bulk_data
 
+    def _rows_response_to_bulk_rows(self, rows_res: RowsResponse):
+        """
+        Same as _tweet_response_to_bulk_data for the rows parser
+        :params rows_res: the rows response
+        """
+        self._log_tweets(rows_res.tweet_id, rows_res.text)
+
+        # Get the rule ids from the api ids in matching_rules
+        rule_ids = [r.id for r in self._get_cache_rules(rows_res.matching_rules)]
+        if not rule_ids:
+            logger.warning('No rule matched requested rules')
+            return
+
+        # Mark the tweets as collected by the rules
+        bulk_rows = rows_res.rows
+        collected_at = datetime.datetime.now()
+        bulk_rows.add_rule_matches(rule_ids, [rows_res.tweet_id], collected_at, direct_hit=True)
+        bulk_rows.add_rule_matches(rule_ids, rows_res.include_tweet_ids, collected_at)
+        return bulk_rows
+
     # def _handle_errors(self, errors: List[dict]) -> None:
     #     """
     #     Some errors might still be wrapped in a 200 response
@@ -320,56 +391,61 @@ class Streamer:
         Is used to parse the line of bytes into a TweetResponse containing the tweet data
         :param line: bytes to be parsed
         """
-        # if line is empty log message
-        if not line:
-            # self._logger.info("waiting for new tweets")
-            return
-
-        # parse to utf-8
+        old = time.time()
         try:
-            txt = line.decode('utf-8')
-        except Exception as e:
-            raise UnreadableResponseError('Failed to parse the server response to utf-8') from e
-
-        # ignore line return
-        if txt == '\r\n':
+            tweet_res = self._parse_func(line)
+        finally:
+            self._parse_metrics.add(time.time() - old)
+        if not tweet_res:
             return
+        await self._handle_tweet_response(tweet_res)
 
-        # try parsing to json
-        try:
-            data = json.loads(txt)
-        except Exception as e:
-            raise ResponseParseError('Failed to parse the server response to json', raw_text=txt) from e
-
-        # Parse json object with pydantic
+    @handle_error
+    async def _handle_parse_result(self, started: float, future: asyncio.Future):
+        """
+        Wait for a line parsed in the parser pool and handle the result
+        Parsing errors raised in the worker process are raised again here
+        :param started: time the line was sent to the pool
+        :param future: future of the parse function
+        """
         try:
-            tweet_res = TweetResponse(**data)
-        except Exception as e:
-            # If there is a Twitter API Error we assume the parsing failed because of this. Probably no data
-            if 'errors' in data:
-                raise TwitterAPIError('Streamer response has error field', data=data)
-
-            raise ResponseParseError('Failed to parse the json response with pydantic', data=data) from e
+            tweet_res = await future
+        finally:
+            self._parse_metrics.add(time.time() - started)
+        if not tweet_res:
+            return
+        await self._handle_tweet_response(tweet_res)
 
+    async def _handle_tweet_response(self, tweet_res: TweetResponse | RowsResponse):
+        """
+        Build the BulkData (or BulkRows) from a parsed response and send it to the writer
+        :param tweet_res: the tweet response object
+        """
         # Build BulkData from the TweetResponse containing all objects that can be saved
+        old = time.time()
         try:
-            bulk_data = await self._tweet_response_to_bulk_data(tweet_res)
-            if not bulk_data:
-                return
-        except Exception as e:
-            raise ResponseParseError('Unexpected Error while building BulkData from the TweetResponse', data=data) \
-                from e
-
-        # send data to storage_manager
-        try:
-            bulk_data.timestamp = datetime.datetime.now()
-            fire_and_forget(self._storage.save_bulk(bulk_data, callback=self.event_collect))
+            if isinstance(tweet_res, RowsResponse):
+                bulk_data = self._rows_response_to_bulk_rows(tweet_res)
+            else:
+                bulk_data = await self._tweet_response_to_bulk_data(tweet_res)
         except Exception as e:
-            raise StorageError('Unexpected StorageManager bulk_save function error') from e
+            raise ResponseParseError('Unexpected Error while building BulkData from the TweetResponse',
+                                     data={'tweet_id': tweet_res.tweet_id} if isinstance(tweet_res, RowsResponse)
+                                     else tweet_res.dict()) from e
+        finally:
+            self._build_metrics.add(time.time() - old)
+
+        if bulk_data:
+            # send data to the bulk writer, waits if too many tweets are waiting to be saved
+            try:
+                bulk_data.timestamp = datetime.datetime.now()
+                await self._writer.put(bulk_data)
+            except Exception as e:
+                raise StorageError('Unexpected StorageManager bulk_save function error') from e
 
         # We cast the Twitter api error at the end, so we can save the data that was retrieved before
-        if 'errors' in data:
-            raise TwitterAPIError('Streamer response has error field', data=data)
+        if tweet_res.errors is not None:
+            raise TwitterAPIError('Streamer response has error field', data={'errors': tweet_res.errors})
 
     async def collect(self, rules: List[RuleConfig] = None, fields: QueryFields = None):
         """
@@ -408,6 +484,35 @@ class Streamer:
         if self._collect_task:
             self._collect_task.cancel()
             self._collect_task = None
+            fire_and_forget(self._stop_parsing())
+
+    async def _stop_parsing(self):
+        """
+        Let the parser handle the lines already read from the stream, then cancel the parse loops,
+        shut the parser pool down and flush the writer
+        """
+        try:
+            await asyncio.wait_for(self._drain_parse_queues(), STOP_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f'Parser not drained after {STOP_DRAIN_TIMEOUT}s, pending lines are dropped')
+        # the collection was started again during the drain, the parser is in use
+        if self.is_running():
+            return
+        if self._parse_task:
+            self._parse_task.cancel()
+            self._parse_task = None
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._parse_queue = asyncio.Queue(maxsize=self._parse_queue.maxsize)
+        self._handoff_queue = asyncio.Queue(maxsize=self._handoff_queue.maxsize)
+        await self._writer.flush()
+
+    async def _drain_parse_queues(self):
+        if not self._is_parsing():
+            return
+        await self._parse_queue.join()
+        await self._handoff_queue.join()
 
     def is_running(self):
         return self._collect_task is not None and not self._collect_task.done()
@@ -415,13 +520,50 @@ class Streamer:
     def _is_parsing(self):
         return self._parse_task is not None and not self._parse_task.done()
 
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self._parser_workers)
+        return self._executor
+
     async def _parse_loop(self):
+        if self._parser_workers > 0:
+            await asyncio.gather(self._dispatch_loop(), self._handoff_loop())
+            return
+
         while True:
+            line = await self._parse_queue.get()
             try:
-                line = await self._parse_queue.get()
                 await self._handle_line_response(line)
             except Exception as e:
                 print(e)
+            finally:
+                self._parse_queue.task_done()
+
+    async def _dispatch_loop(self):
+        """
+        Send the lines of the parse queue to the parser pool
+        The handoff queue is bounded, so at most parser_workers * 4 lines are parsed ahead of the storage
+        """
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        while True:
+            line = await self._parse_queue.get()
+            future = loop.run_in_executor(executor, self._parse_func, line)
+            await self._handoff_queue.put((time.time(), future))
+            self._parse_queue.task_done()
+
+    async def _handoff_loop(self):
+        """
+        Handle the parsed lines in the order they were received from the stream
+        """
+        while True:
+            started, future = await self._handoff_queue.get()
+            try:
+                await self._handle_parse_result(started, future)
+            except Exception as e:
+                logger.error(e, exc_info=True)
+            finally:
+                self._handoff_queue.task_done()
 
     def _start_parsing(self):
         if not self._is_parsing():
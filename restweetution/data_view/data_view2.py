@@ -43,6 +43,7 @@ class ViewResult(BaseModel):
     view: List[ViewDict]
     fields: List[str]
     default_fields: List[str]
+    cursor: str = None
 
 
 class DataView2(ABC):
@@ -3,6 +3,7 @@ from typing import List
 from restweetution.data_view.data_view2 import DataView2, get_safe_set, ViewDict, ViewResult
 from restweetution.data_view.fields import MediaFields as MField
 from restweetution.data_view.fields import TweetFields as TField
+from restweetution.downloaders.media_store import relative_path
 from restweetution.models.linked.linked_media import LinkedMedia
 
 
@@ -43,7 +44,7 @@ class MediaView2(DataView2):
         if downloaded:
             safe_set(MField.SHA1, downloaded.sha1)
             safe_set(MField.FORMAT, downloaded.format)
-            safe_set(MField.FILE, downloaded.sha1 + '.' + downloaded.format)
+            safe_set(MField.FILE, relative_path(downloaded.sha1, downloaded.format))
 
         tweets = linked_media.get_tweets()
         if tweets:
@@ -1,7 +1,10 @@
-from typing import List
+from functools import cached_property
+from typing import List, Dict, Callable, Tuple
 
-from restweetution.data_view.data_view2 import DataView2, ViewDict, get_safe_set, get_any_field, ViewResult
+from restweetution.data_view.data_view2 import DataView2, ViewDict, ViewResult
+from restweetution.downloaders.media_store import relative_path
 from restweetution.models.linked.linked_tweet import LinkedTweet
+from restweetution.utils import LRUCache
 
 ID = 'id'
 TEXT = 'text'
@@ -90,7 +93,250 @@ required_tweet_fields = {
 tweet_fields = list(required_tweet_fields.keys())
 
 
+class ChunkContext:
+    """
+    Values shared by several columns, computed once per chunk and only if a column uses them
+    The linked objects are read from the dicts of the LinkedBulkData, the LinkedTweet getters are only used
+    for the missing ones (they build a model for each lookup)
+    """
+
+    def __init__(self, linked_tweets: List[LinkedTweet]):
+        self.linked = linked_tweets
+        self.tweets = [lt.tweet for lt in linked_tweets]
+        self.data = linked_tweets[0].data if linked_tweets else None
+
+    def _user(self, lt: LinkedTweet, user_id: str, getter: Callable):
+        if not user_id:
+            return None
+        return self.data.users.get(user_id) or getter(lt)
+
+    @cached_property
+    def medias(self):
+        """
+        (Media, DownloadedMedia or None) of each tweet
+        """
+        medias = self.data.medias
+        downloaded = self.data.downloaded_medias
+        res = []
+        for lt, t in zip(self.linked, self.tweets):
+            keys = t.get_media_keys()
+            if all(k in medias for k in keys):
+                res.append([(medias[k], downloaded.get(k)) for k in keys])
+            else:
+                res.append([(m.media, m.downloaded) for m in lt.get_media()])
+        return res
+
+    @cached_property
+    def downloaded(self):
+        return [[d for _, d in medias if d] if medias else None for medias in self.medias]
+
+    @cached_property
+    def authors(self):
+        getter = LinkedTweet.get_author_user
+        return [self._user(lt, t.author_id, getter) for lt, t in zip(self.linked, self.tweets)]
+
+    @cached_property
+    def replied_users(self):
+        getter = LinkedTweet.get_replied_user
+        return [self._user(lt, t.in_reply_to_user_id, getter) for lt, t in zip(self.linked, self.tweets)]
+
+    @cached_property
+    def matches(self):
+        return [self.data.get_tweet_matches(t.id) for t in self.tweets]
+
+    @cached_property
+    def rules(self):
+        rules = self.data.rules
+        res = []
+        for lt, matches in zip(self.linked, self.matches):
+            if all(m.rule_id in rules for m in matches):
+                res.append([rules[m.rule_id] for m in matches])
+            else:
+                res.append(lt.get_rules())
+        return res
+
+    @cached_property
+    def metrics(self):
+        return [t.public_metrics for t in self.tweets]
+
+    @cached_property
+    def withheld(self):
+        return [t.withheld for t in self.tweets]
+
+
+def _attr(name: str):
+    def extract(ctx: ChunkContext):
+        return [getattr(t, name) for t in ctx.tweets]
+
+    return extract
+
+
+def _metric(name: str):
+    def extract(ctx: ChunkContext):
+        return [getattr(m, name) if m else None for m in ctx.metrics]
+
+    return extract
+
+
+def _withheld(name: str):
+    def extract(ctx: ChunkContext):
+        return [getattr(w, name) if w else None for w in ctx.withheld]
+
+    return extract
+
+
+def _entities(getter: str, name: str):
+    def extract(ctx: ChunkContext):
+        res = []
+        for t in ctx.tweets:
+            values = getattr(t, getter)()
+            res.append([getattr(v, name) for v in values] if values else None)
+        return res
+
+    return extract
+
+
+def _medias(func: Callable):
+    def extract(ctx: ChunkContext):
+        return [[func(m) for m in medias] if medias else None for medias in ctx.medias]
+
+    return extract
+
+
+def _downloaded(func: Callable):
+    def extract(ctx: ChunkContext):
+        return [[func(d) for d in downloaded] if downloaded is not None else None for downloaded in ctx.downloaded]
+
+    return extract
+
+
+def _user(source: str, name: str):
+    def extract(ctx: ChunkContext):
+        return [getattr(u, name) if u else None for u in getattr(ctx, source)]
+
+    return extract
+
+
+def _context(name: str):
+    def extract(ctx: ChunkContext):
+        return [[getattr(c, name).name for c in t.context_annotations] if t.context_annotations else None
+                for t in ctx.tweets]
+
+    return extract
+
+
+def _referenced(name: str):
+    def extract(ctx: ChunkContext):
+        return [[getattr(r, name) for r in t.referenced_tweets] if t.referenced_tweets else None for t in ctx.tweets]
+
+    return extract
+
+
+def _poll_ids(ctx: ChunkContext):
+    return [t.attachments.poll_ids if t.attachments and t.attachments.poll_ids else None for t in ctx.tweets]
+
+
+def _coordinates(ctx: ChunkContext):
+    return [t.geo.coordinates.coordinates if t.geo and t.geo.coordinates else None for t in ctx.tweets]
+
+
+def _place_id(ctx: ChunkContext):
+    return [t.geo.place_id if t.geo else None for t in ctx.tweets]
+
+
+def _rule_tags(ctx: ChunkContext):
+    res = []
+    for rules in ctx.rules:
+        if not rules:
+            res.append(None)
+            continue
+        tags = set()
+        for r in rules:
+            tags.update(r.tag.split(','))
+        res.append(list(tags))
+    return res
+
+
+def _direct_hit(ctx: ChunkContext):
+    return [any(m.direct_hit for m in matches) if rules else None for matches, rules in zip(ctx.matches, ctx.rules)]
+
+
+def _none(ctx: ChunkContext):
+    return [None] * len(ctx.tweets)
+
+
+# field -> function computing the column of a chunk
+COLUMN_EXTRACTORS: Dict[str, Callable[[ChunkContext], List]] = {
+    ID: _attr('id'),
+    TEXT: _attr('text'),
+    CREATED_AT: _attr('created_at'),
+    CONVERSATION_ID: _attr('conversation_id'),
+    POLL_IDS: _poll_ids,
+    MEDIA_KEYS: _medias(lambda m: m[0].media_key),
+    MEDIA_TYPES: _medias(lambda m: m[0].type),
+    MEDIA_SHA1S: _downloaded(lambda d: d.sha1),
+    MEDIA_FILES: _downloaded(lambda d: relative_path(d.sha1, d.format)),
+    MEDIA_FORMAT: _downloaded(lambda d: d.format),
+    AUTHOR_ID: _user('authors', 'id'),
+    AUTHOR_USERNAME: _user('authors', 'username'),
+    CONTEXT_DOMAINS: _context('domain'),
+    CONTEXT_ENTITIES: _context('entity'),
+    ANNOTATIONS: _entities('get_annotations', 'normalized_text'),
+    CASHTAGS: _entities('get_cashtags', 'tag'),
+    HASHTAGS: _entities('get_hashtags', 'tag'),
+    MENTIONS: _entities('get_mentions', 'username'),
+    URLS: _entities('get_urls', 'url'),
+    COORDINATES: _coordinates,
+    PLACE_ID: _place_id,
+    IN_REPLY_TO_USER_ID: _user('replied_users', 'id'),
+    IN_REPLY_TO_USERNAME: _user('replied_users', 'username'),
+    LANG: _attr('lang'),
+    POSSIBLY_SENSITIVE: _attr('possibly_sensitive'),
+    RETWEET_COUNT: _metric('retweet_count'),
+    REPLY_COUNT: _metric('reply_count'),
+    LIKE_COUNT: _metric('like_count'),
+    QUOTE_COUNT: _metric('quote_count'),
+    REFERENCED_TWEETS_TYPES: _referenced('type'),
+    REFERENCED_TWEETS_IDS: _referenced('id'),
+    REPLY_SETTINGS: _attr('reply_settings'),
+    SOURCE: _attr('source'),
+    WITHHELD_COPYRIGHT: _withheld('copyright'),
+    WITHHELD_COUNTRY_CODES: _withheld('country_codes'),
+    WITHHELD_SCOPE: _withheld('scope'),
+    RULE_TAGS: _rule_tags,
+    DIRECT_HIT: _direct_hit,
+}
+
+
+class TweetViewPlan:
+    """
+    Requested fields resolved once into column extractors
+    A chunk of LinkedTweet is computed column by column, the values shared by several columns
+    (medias, author, rules..) are computed once per chunk in a ChunkContext
+    ex:
+        plan = TweetViewPlan([ID, TEXT, HASHTAGS])
+        columns = plan.compute_columns(linked_tweets)  # {field: [values]}
+        rows = plan.compute_rows(linked_tweets)  # [(id, text, hashtags), ...]
+    """
+    __slots__ = ('fields', 'extractors')
+
+    def __init__(self, fields: List[str]):
+        self.fields = list(fields)
+        self.extractors = [COLUMN_EXTRACTORS.get(f, _none) for f in self.fields]
+
+    def compute_columns(self, linked_tweets: List[LinkedTweet]) -> Dict[str, List]:
+        ctx = ChunkContext(linked_tweets)
+        return {f: extract(ctx) for f, extract in zip(self.fields, self.extractors)}
+
+    def compute_rows(self, linked_tweets: List[LinkedTweet]) -> List[Tuple]:
+        ctx = ChunkContext(linked_tweets)
+        columns = [extract(ctx) for extract in self.extractors]
+        return list(zip(*columns)) if columns else [() for _ in linked_tweets]
+
+
 class TweetView2(DataView2):
+    # tuple of fields -> TweetViewPlan
+    _plans = LRUCache(64)
 
     @staticmethod
     def get_fields() -> List[str]:
@@ -100,121 +346,24 @@ class TweetView2(DataView2):
     def get_default_fields() -> List[str]:
         return [ID, AUTHOR_USERNAME, CREATED_AT, TEXT, HASHTAGS]
 
+    @classmethod
+    def get_plan(cls, fields: List[str]) -> TweetViewPlan:
+        key = tuple(fields)
+        plan = cls._plans.get(key)
+        if plan is None:
+            plan = TweetViewPlan(fields)
+            cls._plans.put(key, plan)
+        return plan
+
     @classmethod
     def compute(cls, tweets: List[LinkedTweet], fields: List[str] = None) -> ViewResult:
         fields = cls.all_if_empty(fields)
+        plan = cls.get_plan(fields)
 
         res_tweets = []
-        for tweet in tweets:
-            res_tweets.append(cls._tweet_to_view(tweet, fields=fields))
+        for tweet, row in zip(tweets, plan.compute_rows(tweets)):
+            res = ViewDict(id_=tweet.tweet.id)
+            res.update(zip(fields, row))
+            res_tweets.append(res)
 
         return cls._result(view_list=res_tweets, fields=fields)
-
-    @classmethod
-    def _tweet_to_view(cls, link_tweet: LinkedTweet, fields: List[str]):
-        tweet = link_tweet.tweet
-        res = ViewDict(id_=tweet.id)
-
-        # set default value
-        [res.update({f: None}) for f in fields]
-        # utility functions to avoid writing if statement in front of every assignement
-        # safe_set only sets value if the field is present in the arguments
-        # any_ tests if any of the fields are present in the arguments
-        safe_set = get_safe_set(res, fields)
-        any_ = get_any_field(fields)
-
-        safe_set(ID, tweet.id)
-        safe_set(TEXT, tweet.text)
-        safe_set(CREATED_AT, tweet.created_at)
-        safe_set(CONVERSATION_ID, tweet.conversation_id)
-
-        if tweet.attachments and tweet.attachments.poll_ids:
-            safe_set(POLL_IDS, tweet.attachments.poll_ids)
-
-        medias = link_tweet.get_media()
-        if medias:
-            safe_set(MEDIA_KEYS, [m.media.media_key for m in medias])
-            safe_set(MEDIA_TYPES, [m.media.type for m in medias])
-
-            safe_set(MEDIA_SHA1S, [m.downloaded.sha1 for m in medias if m.downloaded])
-            safe_set(MEDIA_FILES, [m.downloaded.sha1 + '.' + m.downloaded.format for m in medias if m.downloaded])
-            safe_set(MEDIA_FORMAT, [m.downloaded.format for m in medias if m.downloaded])
-
-        author = link_tweet.get_author_user()
-        if author:
-            safe_set(AUTHOR_ID, author.id)
-            safe_set(AUTHOR_USERNAME, author.username)
-
-        if any_(CONTEXT_DOMAINS, CONTEXT_ENTITIES):
-            if tweet.context_annotations:
-                domains = [c.domain.name for c in tweet.context_annotations]
-                entities = [c.entity.name for c in tweet.context_annotations]
-                safe_set(CONTEXT_DOMAINS, domains)
-                safe_set(CONTEXT_ENTITIES, entities)
-
-        if tweet.get_annotations():
-            safe_set(ANNOTATIONS, [a.normalized_text for a in tweet.get_annotations()])
-        if tweet.get_cashtags():
-            safe_set(CASHTAGS, [t.tag for t in tweet.get_cashtags()])
-        if tweet.get_hashtags():
-            safe_set(HASHTAGS, [t.tag for t in tweet.get_hashtags()])
-        if tweet.get_mentions():
-            safe_set(MENTIONS, [t.username for t in tweet.get_mentions()])
-        if tweet.get_urls():
-            safe_set(URLS, [t.url for t in tweet.get_urls()])
-
-        if tweet.geo:
-            if tweet.geo.coordinates:
-                safe_set(COORDINATES, tweet.geo.coordinates.coordinates)
-            safe_set(PLACE_ID, tweet.geo.place_id)
-
-        if tweet.in_reply_to_user_id:
-            replied_user = link_tweet.get_replied_user()
-            safe_set(IN_REPLY_TO_USER_ID, replied_user.id)
-            safe_set(IN_REPLY_TO_USERNAME, replied_user.username)
-
-        safe_set(LANG, tweet.lang)
-        safe_set(POSSIBLY_SENSITIVE, tweet.possibly_sensitive)
-
-        if tweet.public_metrics:
-            safe_set(RETWEET_COUNT, tweet.public_metrics.retweet_count)
-            safe_set(REPLY_COUNT, tweet.public_metrics.reply_count)
-            safe_set(LIKE_COUNT, tweet.public_metrics.like_count)
-            safe_set(QUOTE_COUNT, tweet.public_metrics.quote_count)
-
-        if tweet.referenced_tweets:
-            tweet_types = [t.type for t in tweet.referenced_tweets]
-            tweet_ids = [t.id for t in tweet.referenced_tweets]
-            safe_set(REFERENCED_TWEETS_TYPES, tweet_types)
-            safe_set(REFERENCED_TWEETS_IDS, tweet_ids)
-
-            # if any_field(REFERENCED_TWEETS_AUTHOR_IDS, REFERENCED_TWEETS_AUTHOR_USERNAMES):
-            #     tweets = [bulk_data.tweets[i] for i in tweet_ids if i in bulk_data.tweets]
-            #     author_ids = [t.author_id for t in tweets if t.author_id]
-            #     authors = [bulk_data.users[i] for i in author_ids if i in bulk_data.users]
-            #     author_usernames = [a.username for a in authors if a.username]
-            #
-            #     safe_set(REFERENCED_TWEETS_AUTHOR_IDS, author_ids)
-            #     safe_set(REFERENCED_TWEETS_AUTHOR_USERNAMES, author_usernames)
-
-        safe_set(REPLY_SETTINGS, tweet.reply_settings)
-        safe_set(SOURCE, tweet.source)
-
-        if tweet.withheld:
-            safe_set(WITHHELD_COPYRIGHT, tweet.withheld.copyright)
-            safe_set(WITHHELD_SCOPE, tweet.withheld.scope)
-            safe_set(WITHHELD_COUNTRY_CODES, tweet.withheld.country_codes)
-
-        rules = link_tweet.get_rules()
-        if rules and any_(RULE_TAGS, DIRECT_HIT):
-            tags = set()
-            direct_hit = False
-            for r in rules:
-                tags.update(r.tag.split(','))
-            safe_set(RULE_TAGS, list(tags))
-
-            for m in link_tweet.get_rule_matches():
-                direct_hit |= m.direct_hit
-
-            safe_set(DIRECT_HIT, direct_hit)
-        return res
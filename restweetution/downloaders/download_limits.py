@@ -0,0 +1,55 @@
+"""
+Limits shared by the download workers of all the DownloadQueue of a MediaDownloader
+"""
+import asyncio
+import time
+from typing import Dict
+from urllib.parse import urlparse
+
+
+class HostLimiter:
+    """
+    Max number of concurrent downloads from the same host
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def get(self, url: str) -> asyncio.Semaphore:
+        """
+        @param url: url of the download
+        @return: semaphore of the url host, to use with async with
+        """
+        host = urlparse(url).hostname or ''
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.limit)
+        return self._semaphores[host]
+
+
+class TokenBucket:
+    """
+    Global bandwidth budget in bytes per second
+    Downloads consume tokens after each chunk, allowing bursts up to capacity bytes
+    The lock keeps the waiting consumers in order while the bucket refills
+    """
+
+    def __init__(self, rate: int, capacity: int = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    async def consume(self, n_bytes: int):
+        async with self._lock:
+            self._refill()
+            self._tokens -= n_bytes
+            if self._tokens < 0:
+                # the debt is paid back by the refill of the next call
+                await asyncio.sleep(-self._tokens / self.rate)
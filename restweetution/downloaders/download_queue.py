@@ -1,149 +1,457 @@
 import asyncio
+import itertools
 import logging
 import traceback
 from abc import ABC
-from typing import Optional, Callable, Dict, List
+from collections import Counter
+from typing import Callable, Dict, List, Tuple, Set
 
 from aiopath import Path
 from pydantic import BaseModel
 
+from restweetution.downloaders.download_limits import HostLimiter, TokenBucket
+from restweetution.downloaders.media_store import MediaStore
+from restweetution.downloaders.resumable_download import ResumableDownload, discard_partial
 from restweetution.downloaders.url_downloader import UrlDownloader
 from restweetution.models.storage.downloaded_media import DownloadedMedia
 from restweetution.models.twitter import Media
 from restweetution.storages.postgres_jsonb_storage.postgres_jsonb_storage import PostgresJSONBStorage
-from restweetution.utils import fire_and_forget
+from restweetution.utils import fire_and_forget, LRUCache, AsyncEvent
 
 logger = logging.getLogger('DownloadQueue')
 
-SENTINEL = 'STOP'
+# priority lanes, lower is downloaded first
+PRIORITY_LIVE = 0
+PRIORITY_BACKFILL = 1
+PRIORITY_NAMES = {PRIORITY_LIVE: 'live', PRIORITY_BACKFILL: 'backfill'}
+
+DEFAULT_HOST_LIMIT = 8
+# number of pending medias checked against the database in one query
+DEDUP_BATCH_SIZE = 500
+# size of the media_key / url -> (sha1, format) cache
+KNOWN_CACHE_SIZE = 100000
+# medias given to download by this process, the tasks claimed by another worker are never popped
+MEDIAS_CACHE_SIZE = 100000
+# DownloadedMedia rows are saved by groups of SAVE_BATCH_SIZE, or after SAVE_INTERVAL seconds
+SAVE_BATCH_SIZE = 100
+SAVE_INTERVAL = 1
+# durable queue: tasks claimed from the database in one query, seconds between two polls
+CLAIM_BATCH_SIZE = 50
+POLL_INTERVAL = 1
+# failed downloads are retried after RETRY_BASE_DELAY * 2^(attempts - 1) seconds, at most MAX_ATTEMPTS times
+RETRY_BASE_DELAY = 30
+RETRY_MAX_DELAY = 6 * 3600
+MAX_ATTEMPTS = 8
 
 
 class DownloadTask(BaseModel):
     media: Media
-    callback: Optional[Callable]
+    # attempts of the task, this one included
+    attempts: int = 0
 
 
-class DownloadQueueStatus(BaseModel):
-    qsize: int
+class DownloadWorkerStatus(BaseModel):
     current_url: str
     bytes_downloaded: int
     bytes_total: int
     progress_percentage: int
+    # resumable downloads: bytes found in the partial file, number of ranges
+    resumed_bytes: int = 0
+    ranges: int = 0
+
+
+class DownloadQueueStatus(BaseModel):
+    qsize: int
+    lanes: Dict[str, int]
+    workers: List[DownloadWorkerStatus]
     downloaded_count: int
+    # tasks of the durable queue not acked yet, updated by the feed loop
+    stored: int = 0
 
 
 class DownloadQueue(ABC):
-    def __init__(self, root: str, storage: PostgresJSONBStorage):
+    def __init__(self, root: str, storage: PostgresJSONBStorage, workers: int = 1, host_limiter: HostLimiter = None,
+                 bandwidth: TokenBucket = None, resumable=False, parallel_ranges: int = 1, name: str = None,
+                 worker_id: str = None):
+        """
+        Queue of medias downloaded by concurrent workers
+        The tasks are persisted in the download_task table and claimed by batches, a task is deleted (acked)
+        with its DownloadedMedia row, so the downloads not done are resumed after a restart
+        @param root: folder of the downloaded files
+        @param storage: storage of the DownloadedMedia
+        @param workers: number of concurrent downloads
+        @param host_limiter: per host concurrency limit, can be shared with other queues
+        @param bandwidth: bandwidth budget, can be shared with other queues
+        @param resumable: keep the partial files to resume the downloads with range requests (large files)
+        @param parallel_ranges: number of ranges fetched in parallel for the large resumable downloads
+        @param name: name of the queue in the download_task table, default to the name of the root folder
+        @param worker_id: name of the process in the claims of the tasks
+        """
         self.root = Path(root)
+        self.name = name if name else self.root.name
+        self.worker_id = worker_id
+        self._store = MediaStore(root)
         self._storage = storage
-        self._queue = asyncio.Queue()
-        self._task: asyncio.Task | None = None
-        self._actual_media: Media | None = None
-        self._downloader = UrlDownloader()
+        # (priority, sequence, DownloadTask), the sequence keeps the FIFO order inside a lane
+        self._queue = asyncio.PriorityQueue()
+        self._sequence = itertools.count()
+        self._lane_sizes = Counter()
+        self._downloaders = [UrlDownloader() for _ in range(max(workers, 1))]
+        self._tasks: List[asyncio.Task | None] = [None] * len(self._downloaders)
+        self._host_limiter = host_limiter if host_limiter else HostLimiter(DEFAULT_HOST_LIMIT)
+        self._bandwidth = bandwidth
+        self._resumable = resumable
+        self._parallel_ranges = parallel_ranges
+        # url -> future of the DownloadedMedia, for the medias with the same url queued at the same time
+        self._in_flight: Dict[str, asyncio.Future] = {}
         self._downloaded_count = 0
 
+        # medias waiting for the dedup step, before the queue
+        self._pending: List[Tuple[int, DownloadTask]] = []
+        self._dedup_task: asyncio.Task | None = None
+        # media_key or url -> (sha1, format) of the downloaded medias
+        self._known = LRUCache(KNOWN_CACHE_SIZE)
+        self._save_buffer: List[DownloadedMedia] = []
+        self._flush_task: asyncio.Task | None = None
+
+        # medias given to download, waiting to be persisted then claimed
+        self._to_persist: List[Tuple[int, Media]] = []
+        self._persist_task: asyncio.Task | None = None
+        self._feed_task: asyncio.Task | None = None
+        # set when new tasks are persisted, the feed loop does not stop before claiming them
+        self._new_tasks = False
+        # wakes the feed loop before POLL_INTERVAL when tasks are added, acked or released
+        self._wake = asyncio.Event()
+        # media_key -> Media of the persisted tasks, the evicted ones are read from the database when claimed
+        self._medias = LRUCache(MEDIAS_CACHE_SIZE)
+        # media_keys claimed by this queue and not acked yet
+        self._claimed: Set[str] = set()
+        # callbacks are not persisted, they are lost on restart
+        self._callbacks: Dict[str, List[Callable]] = {}
+        self._stored = 0
+        # called with each group of saved DownloadedMedia, ex: MediaFingerprinter.add
+        self.event_saved = AsyncEvent()
+
     def status(self):
-        bytes_d, bytes_t = self._downloader.get_progress()
-        url = self._downloader.get_url()
-        percentage = self._downloader.get_progress_percentage()
-        return DownloadQueueStatus(qsize=self.qsize(), current_url=url, bytes_downloaded=bytes_d, bytes_total=bytes_t,
-                                   progress_percentage=percentage, downloaded_count=self._downloaded_count)
+        workers = [
+            DownloadWorkerStatus(current_url=d.get_url() if d.is_downloading() else '',
+                                 bytes_downloaded=d.get_progress()[0], bytes_total=d.get_progress()[1],
+                                 progress_percentage=d.get_progress_percentage(),
+                                 resumed_bytes=d.get_resume_info()[0], ranges=d.get_resume_info()[1])
+            for d in self._downloaders
+        ]
+        lanes = {name: self._lane_sizes[p] for p, name in PRIORITY_NAMES.items()}
+        return DownloadQueueStatus(qsize=self.qsize(), lanes=lanes, workers=workers,
+                                   downloaded_count=self._downloaded_count, stored=self._stored)
 
     def is_running(self):
-        return self._task and not self._task.done()
+        return any(t and not t.done() for t in self._tasks)
 
     def qsize(self):
-        return self._queue.qsize()
-
-    def get_current_url(self):
-        if self._actual_media is None:
-            return None
-        return self._actual_media.get_url()
+        return self._queue.qsize() + len(self._pending) + len(self._to_persist)
 
     async def wait_finish(self):
-        if self._task:
-            await self._task
-        return
+        while True:
+            tasks = [t for t in [self._persist_task, self._feed_task, self._dedup_task, *self._tasks]
+                     if t and not t.done()]
+            if not tasks:
+                break
+            await asyncio.gather(*tasks)
+        await self._flush_saves()
+
+    def _remember(self, media: Media, sha1: str, format_: str):
+        self._known.put(media.media_key, (sha1, format_))
+        url = media.get_url()
+        if url:
+            self._known.put(url, (sha1, format_))
+
+    async def _get_stored(self, media: Media):
+        """
+        @return: (sha1, format) of a known media if its file is in the store
+        """
+        known = self._known.get(media.media_key) or self._known.get(media.get_url())
+        if known and await self._store.has(*known):
+            return known
+        return None
+
+    async def _download_media(self, media: Media, downloader: UrlDownloader):
+        known = await self._get_stored(media)
+        if known:
+            return await self._save_duplicate(media, *known)
 
-    async def _download_media(self, media: Media):
-        d_media = await self._find_same_media(media)
-        if d_media:
-            await self._save_duplicate(media, d_media)
-            return d_media
+        url = media.get_url()
+        d_media = None
+        while url in self._in_flight:
+            # same url is being downloaded by another worker, after a failure one of the waiting workers retries it
+            d_media = await asyncio.shield(self._in_flight[url])
+            if d_media:
+                return await self._save_duplicate(media, d_media.sha1, d_media.format)
 
-        res = await self._downloader.download_save_sha1(src_url=media.get_url(), dest_folder=self.root)
-        d_media = DownloadedMedia(media_key=media.media_key, format=res.ext, sha1=res.sha1, media=media)
-        await self._storage.save_downloaded_medias([d_media])
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[url] = future
+        try:
+            throttle = self._bandwidth.consume if self._bandwidth else None
+            if self._resumable:
+                # the parallel ranges take a host slot each
+                res = await ResumableDownload(downloader, self._store, url, throttle=throttle,
+                                              parallel=self._parallel_ranges, host_limiter=self._host_limiter).run()
+            else:
+                async with self._host_limiter.get(url):
+                    res = await downloader.download_to_store(src_url=url, store=self._store, throttle=throttle)
+            d_media = DownloadedMedia(media_key=media.media_key, format=res.ext, sha1=res.sha1, media=media)
+            self._remember(media, d_media.sha1, d_media.format)
+            await self._save(d_media)
+        finally:
+            # on error the waiting workers download the media themselves
+            future.set_result(d_media)
+            if self._in_flight.get(url) is future:
+                del self._in_flight[url]
 
-        logger.info(f'Downloaded {media.type} | sha1: {d_media.sha1}')
+        logger.info(f'Downloaded {media.type} | sha1: {d_media.sha1}{" (already stored)" if res.existed else ""}')
         self._downloaded_count += 1
 
         return d_media
 
-    async def _save_duplicate(self, media: Media, d_media: DownloadedMedia):
+    async def _save_duplicate(self, media: Media, sha1: str, format_: str):
         """
         Save a media with same url as an already downloaded Media
         @param media: media
-        @param d_media: already downloaded media
-        @return:
+        @param sha1: sha1 of the downloaded file
+        @param format_: format of the downloaded file
+        @return: DownloadedMedia of the media
         """
-        to_save = DownloadedMedia(**media.dict(), sha1=d_media.sha1, format=d_media.format)
-        await self._storage.save_downloaded_medias([to_save])
+        to_save = DownloadedMedia(media_key=media.media_key, sha1=sha1, format=format_, media=media)
+        await self._save(to_save)
+        return to_save
 
-    async def _find_same_media(self, media: Media):
+    async def _save(self, d_media: DownloadedMedia):
         """
-        Checks if the url was already downloaded before starting the download
-        If the media_key or url is already present in DB we return it
+        Buffer a DownloadedMedia, saved with the next group
         """
-        # find downloaded media with same media key or same url
-        d_media = await self._storage.get_downloaded_medias(media_keys=[media.media_key], urls=[media.url],
-                                                            is_and=False)
-        if d_media:
-            return d_media[0]
-        return None
+        self._save_buffer.append(d_media)
+        if len(self._save_buffer) >= SAVE_BATCH_SIZE:
+            await self._flush_saves()
+        elif not self._flush_task or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(SAVE_INTERVAL)
+        await self._flush_saves()
+
+    async def _flush_saves(self):
+        if not self._save_buffer:
+            return
+        batch, self._save_buffer = self._save_buffer, []
+        try:
+            await self._storage.save_downloaded_medias(batch, ack=True)
+            if self.event_saved:
+                fire_and_forget(self.event_saved(batch))
+        except Exception as e:
+            # the tasks stay claimed, they are downloaded again after the claim lease
+            logger.error(f'Failed to save {len(batch)} downloaded medias: {e}')
+        for d_media in batch:
+            self._claimed.discard(d_media.media_key)
+        self._wake.set()
 
-    async def _process_queue(self):
+    def _callback(self, media_key: str, res: DownloadedMedia):
+        for callback in self._callbacks.pop(media_key, []):
+            fire_and_forget(callback(res))
+
+    async def _retry(self, task: DownloadTask, error: Exception):
+        """
+        Release a failed task, retried with an exponential backoff until MAX_ATTEMPTS
+        """
+        media_key = task.media.media_key
+        delay = None
+        if task.attempts < MAX_ATTEMPTS:
+            delay = min(RETRY_BASE_DELAY * 2 ** max(task.attempts - 1, 0), RETRY_MAX_DELAY)
+            self._medias.put(media_key, task.media)
+            logger.warning(f'Download of {media_key} failed ({task.attempts}), retry in {delay}s')
+        else:
+            self._callbacks.pop(media_key, None)
+            logger.error(f'Download of {media_key} failed after {task.attempts} attempts')
+            if self._resumable and task.media.get_url():
+                # the partial file is not resumed anymore
+                await discard_partial(self._store, task.media.get_url())
+        try:
+            await self._storage.retry_download_task(media_key, delay=delay, error=str(error)[:1000])
+        except Exception as e:
+            logger.error(f'Failed to release the download task {media_key}: {e}')
+        self._claimed.discard(media_key)
+        self._wake.set()
+
+    async def _dedup(self, batch: List[Tuple[int, DownloadTask]]):
         """
-        Process Queue Loop
-        Works through the queue one by one.
+        Check a batch of pending medias against the cache and the database with one query
+        Already downloaded medias are saved as duplicates, the others are queued for the workers
+        """
+        unknown = [task.media for _, task in batch
+                   if not self._known.get(task.media.media_key) and not self._known.get(task.media.get_url())]
+        if unknown:
+            found = await self._storage.find_downloaded_medias(media_keys=[m.media_key for m in unknown],
+                                                               urls=[m.url for m in unknown if m.url])
+            for d_media in found:
+                self._remember(d_media.media, d_media.sha1, d_media.format)
+
+        for priority, task in batch:
+            # known medias with a missing file are downloaded again
+            known = await self._get_stored(task.media)
+            if not known:
+                self._queue.put_nowait((priority, next(self._sequence), task))
+                continue
+            self._lane_sizes[priority] -= 1
+            res = await self._save_duplicate(task.media, *known)
+            self._callback(task.media.media_key, res)
+
+    async def _dedup_loop(self):
+        while self._pending:
+            batch = self._pending[:DEDUP_BATCH_SIZE]
+            del self._pending[:DEDUP_BATCH_SIZE]
+            try:
+                await self._dedup(batch)
+            except Exception as e:
+                # the lookup failed before any media of the batch was handled, download them all
+                logger.error(f'Error inside _dedup_loop function : {e}')
+                for priority, task in batch:
+                    self._queue.put_nowait((priority, next(self._sequence), task))
+            self.start()
+
+    async def _process_queue(self, worker: int):
+        """
+        Worker Loop
+        Takes the tasks by priority until the queue is empty.
+        @param worker: index of the worker, selects its UrlDownloader
         @return:
         """
+        downloader = self._downloaders[worker]
         await self.root.mkdir(parents=True, exist_ok=True)
         while True:
+            # if nothing to do, end process, the dedup loop restarts the workers
+            if self._queue.empty():
+                return
+            priority, _, task = self._queue.get_nowait()
+            self._lane_sizes[priority] -= 1
             try:
-                # if nothing to do, end process
-                if self._queue.qsize() == 0:
-                    return
-                task: DownloadTask = await self._queue.get()
-                # Stop if Sentinel is detected
-                if task == SENTINEL:
-                    return
                 # Start a new download
-                self._actual_media = task.media
-                res = await self._download_media(task.media)
-                # trigger callback
-                if task.callback:
-                    fire_and_forget(task.callback(res))
-                # end downloading state
-                self.actual_download = None
+                res = await self._download_media(task.media, downloader)
             except Exception as e:
-                # end downloading state
-                self.actual_download = None
                 logger.error(traceback.print_exc(limit=3))
                 logger.error('Error inside _process_queue function : ' + e.__str__())
+                await self._retry(task, e)
+                continue
+            # trigger callback
+            self._callback(task.media.media_key, res)
+
+    def _enqueue(self, priority: int, task: DownloadTask):
+        """
+        Add a task to the dedup step, then to the workers
+        """
+        self._pending.append((priority, task))
+        self._lane_sizes[priority] += 1
+        if not self._dedup_task or self._dedup_task.done():
+            self._dedup_task = asyncio.create_task(self._dedup_loop())
+
+    async def _persist(self, batch: List[Tuple[int, Media]]):
+        rows = [dict(media_key=m.media_key, queue=self.name, priority=p) for p, m in batch]
+        await self._storage.add_download_tasks(rows)
+        for _, m in batch:
+            self._medias.put(m.media_key, m)
+        self._new_tasks = True
+        self._wake.set()
+
+    async def _persist_loop(self):
+        while self._to_persist:
+            batch = self._to_persist[:DEDUP_BATCH_SIZE]
+            del self._to_persist[:DEDUP_BATCH_SIZE]
+            try:
+                await self._persist(batch)
+            except Exception as e:
+                # without the database the medias are only downloaded by this process
+                logger.error(f'Failed to persist {len(batch)} download tasks: {e}')
+                for priority, media in batch:
+                    self._enqueue(priority, DownloadTask(media=media))
+            self.resume()
+
+    async def _claim(self):
+        """
+        Claim a batch of tasks and add them to the dedup step
+        The medias not given to this process (tasks of a previous run) are loaded from the database
+        @return: number of claimed tasks
+        """
+        rows = await self._storage.claim_download_tasks(self.name, CLAIM_BATCH_SIZE, self.worker_id)
+        # a task still handled by this queue can be claimed again after the claim lease
+        new_rows = [r for r in rows if r['media_key'] not in self._claimed]
+        missing = [r['media_key'] for r in new_rows if r['media_key'] not in self._medias]
+        if missing:
+            for media in await self._storage.get_medias(media_keys=missing):
+                self._medias.put(media.media_key, media)
+
+        orphans = []
+        for row in new_rows:
+            media = self._medias.pop(row['media_key'], None)
+            if not media or not media.get_url():
+                orphans.append(row['media_key'])
+                continue
+            self._claimed.add(row['media_key'])
+            self._enqueue(row['priority'], DownloadTask(media=media, attempts=row['attempts']))
+        if orphans:
+            logger.warning(f'Drop {len(orphans)} download tasks without media url')
+            await self._storage.delete_download_tasks(orphans)
+        return len(rows)
+
+    async def _feed_loop(self):
+        """
+        Claims the tasks while the local queue is short, stops when the download_task table is empty for this queue
+        The tasks waiting for a retry keep the loop polling
+        """
+        while True:
+            self._new_tasks = False
+            self._wake.clear()
+            try:
+                if self._queue.qsize() + len(self._pending) < CLAIM_BATCH_SIZE:
+                    if await self._claim():
+                        continue
+                    if not self._pending and not self.is_running():
+                        # the last downloads are acked now instead of after SAVE_INTERVAL
+                        await self._flush_saves()
+                    self._stored = await self._storage.count_download_tasks(self.name)
+                    if not self._stored and not self._new_tasks:
+                        return
+            except Exception as e:
+                logger.error(f'Error inside _feed_loop function : {e}')
+            try:
+                await asyncio.wait_for(self._wake.wait(), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def resume(self):
+        """
+        Start claiming the tasks of the download_task table, on startup it resumes the downloads of the previous run
+        """
+        if not self._feed_task or self._feed_task.done():
+            self._feed_task = asyncio.create_task(self._feed_loop())
 
     def start(self):
-        self._task = asyncio.create_task(self._process_queue())
+        """
+        Start the workers that are not running
+        """
+        for i, task in enumerate(self._tasks):
+            if task is None or task.done():
+                self._tasks[i] = asyncio.create_task(self._process_queue(i))
 
-    def download(self, medias: List[Media], callback: Callable = None):
+    def download(self, medias: List[Media], callback: Callable = None, priority: int = PRIORITY_LIVE):
         """
         Default function to save medias with the download manager
         :param medias: List of Media to download
         :param callback: Optional Callback to be called on download complete
+        :param priority: PRIORITY_LIVE or PRIORITY_BACKFILL, live medias are downloaded first
+        The medias are persisted in the download_task table before being claimed by the workers
+        The callback is called once the file is downloaded, the DownloadedMedia row is saved with the next group
         """
         for m in medias:
-            d_task = DownloadTask(media=m, callback=callback)
-            self._queue.put_nowait(d_task)
+            self._to_persist.append((priority, m))
+            if callback:
+                self._callbacks.setdefault(m.media_key, []).append(callback)
 
-        if not self.is_running():
-            self.start()
+        if not self._persist_task or self._persist_task.done():
+            self._persist_task = asyncio.create_task(self._persist_loop())
@@ -1,10 +1,14 @@
 import logging
+import socket
 from pathlib import Path
 from typing import List, Callable
 
 from pydantic import BaseModel
 
-from restweetution.downloaders.download_queue import DownloadQueue, DownloadQueueStatus
+from restweetution.downloaders.download_limits import HostLimiter, TokenBucket
+from restweetution.downloaders.download_queue import DownloadQueue, DownloadQueueStatus, PRIORITY_LIVE
+from restweetution.downloaders.media_fingerprinter import MediaFingerprinter, MediaFingerprinterStatus
+from restweetution.models.config.system_config import DownloaderConfig
 from restweetution.models.twitter.media import Media
 from restweetution.storages.postgres_jsonb_storage.postgres_jsonb_storage import PostgresJSONBStorage
 from restweetution.utils import AsyncEvent
@@ -14,14 +18,18 @@ class MediaDownloaderStatus(BaseModel):
     photo: DownloadQueueStatus
     video: DownloadQueueStatus
     gif: DownloadQueueStatus
+    fingerprint: MediaFingerprinterStatus | None = None
 
 
 class MediaDownloader:
 
-    def __init__(self, root: str, storage: PostgresJSONBStorage):
+    def __init__(self, root: str, storage: PostgresJSONBStorage, config: DownloaderConfig = None):
         """
         Utility class to queue the images download
+        The host limit and the bandwidth budget of the config are shared by the three queues
         """
+        if not config:
+            config = DownloaderConfig()
         root = Path(root)
         root_photo = root / 'photo'
         root_video = root / 'video'
@@ -31,31 +39,66 @@ class MediaDownloader:
         self._logger = logging.getLogger("MediaDownloader")
 
         self.event_downloaded = AsyncEvent()
+        # name of this process in the claims of the download tasks
+        self.worker_id = config.worker_id or socket.gethostname()
 
-        self._queue_photo = DownloadQueue(root=root_photo.__str__(), storage=storage)
-        self._queue_video = DownloadQueue(root=root_video.__str__(), storage=storage)
-        self._queue_gif = DownloadQueue(root=root_gif.__str__(), storage=storage)
+        host_limiter = HostLimiter(config.host_limit)
+        bandwidth = TokenBucket(config.max_bytes_per_second) if config.max_bytes_per_second else None
+
+        self._queue_photo = DownloadQueue(root=root_photo.__str__(), storage=storage, workers=config.photo_workers,
+                                          name='photo', host_limiter=host_limiter, bandwidth=bandwidth,
+                                          worker_id=self.worker_id)
+        self._queue_video = DownloadQueue(root=root_video.__str__(), storage=storage, workers=config.video_workers,
+                                          name='video', host_limiter=host_limiter, bandwidth=bandwidth,
+                                          resumable=config.resume_videos, parallel_ranges=config.parallel_ranges,
+                                          worker_id=self.worker_id)
+        self._queue_gif = DownloadQueue(root=root_gif.__str__(), storage=storage, workers=config.gif_workers,
+                                        name='gif', host_limiter=host_limiter, bandwidth=bandwidth,
+                                        resumable=config.resume_videos, parallel_ranges=config.parallel_ranges,
+                                        worker_id=self.worker_id)
+
+        self.fingerprinter = None
+        if config.fingerprint_workers:
+            self.fingerprinter = MediaFingerprinter(root=root_photo.__str__(), storage=storage,
+                                                    workers=config.fingerprint_workers)
+            self._queue_photo.event_saved.add(self.fingerprinter.add)
 
     # Public functions
 
     def status(self):
+        fingerprint = self.fingerprinter.status() if self.fingerprinter else None
         return MediaDownloaderStatus(photo=self._queue_photo.status(), video=self._queue_video.status(),
-                                     gif=self._queue_gif.status())
+                                     gif=self._queue_gif.status(), fingerprint=fingerprint)
+
+    def resume(self):
+        """
+        Resume the downloads saved in the download_task table
+        """
+        for queue in [self._queue_photo, self._queue_video, self._queue_gif]:
+            queue.resume()
+
+    async def close(self):
+        """
+        Shut down the process pool of the fingerprinter, the downloads are resumed from the download_task table
+        """
+        if self.fingerprinter:
+            await self.fingerprinter.close()
 
-    def download_medias(self, medias: List[Media], callback: Callable = None):
+    def download_medias(self, medias: List[Media], callback: Callable = None, priority: int = PRIORITY_LIVE):
         """
         Default function to save medias with the download manager
         :param medias: List of Media to download
         :param callback: Optional Callback to be called on download complete
+        :param priority: PRIORITY_LIVE or PRIORITY_BACKFILL
         """
 
         for m in medias:
             if m.type == 'photo':
-                self._queue_photo.download([m], callback)
+                self._queue_photo.download([m], callback, priority)
             if m.type == 'video':
-                self._queue_video.download([m], callback)
+                self._queue_video.download([m], callback, priority)
             if m.type == 'animated_gif':
-                self._queue_gif.download([m], callback)
+                self._queue_gif.download([m], callback, priority)
 
     def get_root(self):
         return self._root
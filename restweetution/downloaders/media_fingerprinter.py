@@ -0,0 +1,155 @@
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple, Set
+
+from pydantic import BaseModel
+
+from restweetution.downloaders.media_hash import compute_hashes_batch, compute_hashes
+from restweetution.downloaders.media_store import MediaStore
+from restweetution.models.storage.downloaded_media import DownloadedMedia
+from restweetution.storages.postgres_jsonb_storage.postgres_jsonb_storage import PostgresJSONBStorage
+from restweetution.utils import LRUCache
+
+logger = logging.getLogger('MediaFingerprinter')
+
+# files hashed by one call in the process pool
+HASH_BATCH_SIZE = 32
+# sha1 of the files already hashed
+KNOWN_CACHE_SIZE = 100000
+# rows read by one query of the backlog
+BACKLOG_BATCH_SIZE = 1000
+
+
+class MediaFingerprinterStatus(BaseModel):
+    qsize: int
+    hashed_count: int
+
+
+class MediaFingerprinter:
+    def __init__(self, root: str, storage: PostgresJSONBStorage, workers: int = 2):
+        """
+        Computes the perceptual hashes of the downloaded photos in a process pool and saves them in media_hash
+        Fed by the photo DownloadQueue after each saved group of DownloadedMedia
+        @param root: folder of the photo MediaStore
+        @param storage: storage of the hashes
+        @param workers: number of processes
+        """
+        self._store = MediaStore(root)
+        self._storage = storage
+        self._workers = max(workers, 1)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # (sha1, format) waiting to be hashed
+        self._pending: List[Tuple[str, str]] = []
+        self._task: asyncio.Task | None = None
+        # sha1 of _pending and of the batch being hashed
+        self._queued: Set[str] = set()
+        # sha1 with a saved media_hash row
+        self._known = LRUCache(KNOWN_CACHE_SIZE)
+        self._hashed_count = 0
+
+    def status(self):
+        return MediaFingerprinterStatus(qsize=len(self._pending), hashed_count=self._hashed_count)
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self._workers)
+        return self._executor
+
+    async def add(self, downloaded_medias: List[DownloadedMedia]):
+        """
+        Queue the photos of the DownloadedMedia, the files already hashed are skipped
+        """
+        for d_media in downloaded_medias:
+            if d_media.media and d_media.media.type != 'photo':
+                continue
+            if not d_media.sha1 or d_media.sha1 in self._queued or self._known.get(d_media.sha1):
+                continue
+            self._queued.add(d_media.sha1)
+            self._pending.append((d_media.sha1, d_media.format))
+
+        if not self._task or self._task.done():
+            self._task = asyncio.create_task(self._hash_loop())
+
+    async def wait_finish(self):
+        while self._task and not self._task.done():
+            await self._task
+
+    async def close(self):
+        """
+        Stop the hashing and shut down the process pool, the photos not hashed yet are left to hash_backlog
+        """
+        if self._task and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._pending = []
+        self._queued.clear()
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _hash_batch(self, batch: List[Tuple[str, str]]):
+        """
+        Hash a batch of files, one process call per HASH_BATCH_SIZE files
+        The files not found in the store are skipped, the unreadable images are saved without hash
+        The sha1 are known once their hashes are saved, a failed batch can be added again
+        """
+        hashed = await self._storage.get_media_hashes([sha1 for sha1, _ in batch])
+        files = [(sha1, format_) for sha1, format_ in batch if sha1 not in hashed]
+        files = [(sha1, format_) for sha1, format_ in files if await self._store.has(sha1, format_)]
+
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        chunks = [files[i:i + HASH_BATCH_SIZE] for i in range(0, len(files), HASH_BATCH_SIZE)]
+        results = await asyncio.gather(*[
+            loop.run_in_executor(executor, compute_hashes_batch, [str(self._store.path(*f)) for f in chunk])
+            for chunk in chunks
+        ])
+
+        rows = []
+        for chunk, hashes in zip(chunks, results):
+            for (sha1, _), h in zip(chunk, hashes):
+                rows.append(dict(sha1=sha1, ahash=h[0] if h else None, phash=h[1] if h else None))
+        await self._storage.save_media_hashes(rows)
+        for sha1 in [*hashed, *[r['sha1'] for r in rows]]:
+            self._known.put(sha1, True)
+        self._hashed_count += len(rows)
+        return len(rows)
+
+    async def _hash_loop(self):
+        while self._pending:
+            size = HASH_BATCH_SIZE * self._workers
+            batch = self._pending[:size]
+            del self._pending[:size]
+            try:
+                await self._hash_batch(batch)
+            except Exception as e:
+                logger.error(f'Error inside _hash_loop function : {e}')
+            finally:
+                self._queued.difference_update(sha1 for sha1, _ in batch)
+
+    async def hash_backlog(self):
+        """
+        Hash the downloaded photos that have no media_hash row, ex: the photos downloaded before the fingerprinting
+        @return: number of hashed files
+        """
+        total = 0
+        after = None
+        while True:
+            # the photos missing from the store stay without hash, the pages are read by sha1 to skip them
+            batch = await self._storage.get_unhashed_photos(BACKLOG_BATCH_SIZE, after=after)
+            if not batch:
+                return total
+            after = batch[-1][0]
+            total += await self._hash_batch(batch)
+            logger.info(f'{total} photos hashed')
+
+    async def find_similar(self, path: str, max_distance: int = 3, limit: int = 100):
+        """
+        Near duplicates of an image file
+        @return: see PostgresJSONBStorage.find_similar_medias, empty if the file is not a readable image
+        """
+        hashes = await asyncio.to_thread(compute_hashes, path)
+        if not hashes:
+            return []
+        return await self._storage.find_similar_medias(hashes[1], max_distance=max_distance, limit=limit)
@@ -0,0 +1,141 @@
+"""
+Perceptual hashes of the photos, used to find the near duplicates
+Both hashes are 64 bits, two similar images have hashes with a small hamming distance:
+    average_hash: 8x8 grayscale thumbnail, a bit per pixel brighter than the mean
+    perceptual_hash: DCT of a 32x32 grayscale thumbnail, a bit per low frequency above the median
+The storage of the hashes (signed integers, bands) is in restweetution.storages.postgres_jsonb_storage.hash_bands
+Search:
+    BKTree: in memory metric tree, a query only visits the nodes that can be within the distance
+    PostgresJSONBStorage.find_similar_medias: multi-index of the hash bands, see hash_bands
+"""
+from typing import Dict, List, Tuple, Iterable, Any
+
+import numpy as np
+from PIL import Image
+
+# storage helpers, part of the API of the hashes
+from restweetution.storages.postgres_jsonb_storage.hash_bands import HASH_BITS, HASH_BANDS, to_signed, to_unsigned, \
+    hash_bands, band_variants
+
+HASH_SIZE = 8
+PHASH_FACTOR = 4
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    value = 0
+    for bit in bits.flatten():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    matrix[0] *= 1 / np.sqrt(2)
+    return matrix * np.sqrt(2 / n)
+
+
+_DCT = _dct_matrix(HASH_SIZE * PHASH_FACTOR)
+
+
+def _gray(image: Image.Image, size: int) -> np.ndarray:
+    return np.asarray(image.convert('L').resize((size, size), Image.LANCZOS), dtype=np.float64)
+
+
+def average_hash(image: Image.Image) -> int:
+    pixels = _gray(image, HASH_SIZE)
+    return _bits_to_int(pixels > pixels.mean())
+
+
+def perceptual_hash(image: Image.Image) -> int:
+    pixels = _gray(image, HASH_SIZE * PHASH_FACTOR)
+    dct = _DCT @ pixels @ _DCT.T
+    low = dct[:HASH_SIZE, :HASH_SIZE]
+    return _bits_to_int(low > np.median(low))
+
+
+def compute_hashes(path: str) -> Tuple[int, int] | None:
+    """
+    @param path: path of an image file
+    @return: (average_hash, perceptual_hash) unsigned, None if the file is not a readable image
+    """
+    try:
+        with Image.open(path) as image:
+            image.draft('L', (HASH_SIZE * PHASH_FACTOR * 2, HASH_SIZE * PHASH_FACTOR * 2))
+            return average_hash(image), perceptual_hash(image)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def compute_hashes_batch(paths: List[str]) -> List[Tuple[int, int] | None]:
+    """
+    Hashes of several files, one call per batch when run in a process pool
+    """
+    return [compute_hashes(path) for path in paths]
+
+
+def hamming(a: int, b: int) -> int:
+    return ((a ^ b) & ((1 << HASH_BITS) - 1)).bit_count()
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree of hashes with the hamming distance
+    ex:
+        tree = BKTree()
+        tree.add(phash, sha1)
+        tree.search(query, 4) -> [(distance, phash, sha1), ...]
+    """
+
+    def __init__(self, items: Iterable[Tuple[int, Any]] = None):
+        # node: (hash, values, children by distance)
+        self._root: Tuple[int, List[Any], Dict[int, tuple]] | None = None
+        self._size = 0
+        if items:
+            for value, item in items:
+                self.add(value, item)
+
+    def __len__(self):
+        return self._size
+
+    def add(self, value: int, item: Any = None):
+        """
+        @param value: unsigned hash
+        @param item: data returned by the search, ex: sha1 of the file
+        """
+        self._size += 1
+        if self._root is None:
+            self._root = (value, [item], {})
+            return
+        node = self._root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (value, [item], {})
+                return
+            node = child
+
+    def search(self, value: int, max_distance: int) -> List[Tuple[int, int, Any]]:
+        """
+        @return: (distance, hash, item) of the items within max_distance, closest first
+        """
+        if self._root is None:
+            return []
+        res = []
+        stack = [self._root]
+        while stack:
+            node_value, items, children = stack.pop()
+            distance = hamming(value, node_value)
+            if distance <= max_distance:
+                res.extend((distance, node_value, item) for item in items)
+            # triangle inequality: only the children at distance +/- max_distance of the node can match
+            for d in range(max(distance - max_distance, 1), distance + max_distance + 1):
+                child = children.get(d)
+                if child is not None:
+                    stack.append(child)
+        res.sort(key=lambda r: r[0])
+        return res
@@ -0,0 +1,180 @@
+"""
+Content addressed store of the downloaded media files
+Files are named by the sha1 of their content and sharded in sub folders: ab/cd/abcd...ef.jpg
+ex:
+    store = MediaStore('/medias/photo')
+    async with store.writer('jpg') as writer:
+        async for chunk in resp.content.iter_chunked(65536):
+            await writer.write(chunk)
+    print(writer.sha1, writer.path)
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import uuid
+from pathlib import Path
+from typing import List
+
+logger = logging.getLogger('MediaStore')
+
+# writes are done by blocks of BUFFER_SIZE bytes, a multiple of the file system block size
+BUFFER_SIZE = 1 << 20
+SHARD_DEPTH = 2
+SHARD_WIDTH = 2
+TMP_DIR = '.tmp'
+
+
+def relative_path(sha1: str, ext: str, depth: int = SHARD_DEPTH) -> str:
+    """
+    Path of a content in a store, relative to its root, ex: ab/cd/abcd...ef.jpg
+    """
+    shards = [sha1[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(depth)]
+    return '/'.join([*shards, f'{sha1}.{ext}'])
+
+
+class MediaStore:
+    def __init__(self, root: str | Path, depth: int = SHARD_DEPTH, buffer_size: int = BUFFER_SIZE):
+        """
+        @param root: root folder of the store
+        @param depth: number of shard folders, each named by SHARD_WIDTH characters of the sha1
+        @param buffer_size: size of the writes
+        """
+        self.root = Path(root)
+        self.depth = depth
+        self.buffer_size = buffer_size
+
+    def relative_path(self, sha1: str, ext: str) -> str:
+        return relative_path(sha1, ext, self.depth)
+
+    def path(self, sha1: str, ext: str) -> Path:
+        return self.root / self.relative_path(sha1, ext)
+
+    async def has(self, sha1: str, ext: str) -> bool:
+        """
+        Check if a content is stored
+        The files saved before the store, in the root folder, are not found until scripts/migrate_media_store.py
+        moved them to their shard
+        """
+        return await asyncio.to_thread(self.path(sha1, ext).exists)
+
+    def writer(self, ext: str):
+        """
+        @param ext: extension of the file
+        @return: StoreWriter to use with async with, the file is published on exit
+        """
+        return StoreWriter(self, ext)
+
+    def _publish(self, tmp_path: Path, sha1: str, ext: str):
+        """
+        Atomic move of a complete temporary file to its content address
+        @return: True if the content was already stored, the temporary file is then dropped
+        """
+        path = self.path(sha1, ext)
+        if path.exists():
+            tmp_path.unlink()
+            return True
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, path)
+        return False
+
+    def _migrate(self) -> List[Path]:
+        moved = []
+        for file in self.root.iterdir():
+            if not file.is_file() or file.suffix == '.part':
+                continue
+            sha1, _, ext = file.name.partition('.')
+            if len(sha1) != 40 or not ext:
+                continue
+            path = self.path(sha1, ext)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(file, path)
+            moved.append(path)
+        return moved
+
+    async def migrate(self) -> List[Path]:
+        """
+        Move the files of the root folder named <sha1>.<ext> to their shard
+        @return: new paths of the moved files
+        """
+        return await asyncio.to_thread(self._migrate)
+
+
+class StoreWriter:
+    """
+    Buffers the chunks and writes them by blocks of buffer_size in a thread, the sha1 is updated in another thread
+    Write and hash of a block run while the next block is received
+    """
+
+    def __init__(self, store: MediaStore, ext: str):
+        self.store = store
+        self.ext = ext
+        self.sha1: str | None = None
+        self.path: Path | None = None
+        self.size = 0
+        # the content was already in the store, nothing was published
+        self.existed = False
+
+        self._tmp_path = store.root / TMP_DIR / f'{uuid.uuid4().hex}.part'
+        self._file = None
+        self._hash = hashlib.sha1()
+        self._buffer = bytearray()
+        self._pending: asyncio.Future | None = None
+
+    async def __aenter__(self):
+        def open_tmp():
+            self._tmp_path.parent.mkdir(parents=True, exist_ok=True)
+            return open(self._tmp_path, 'wb')
+
+        self._file = await asyncio.to_thread(open_tmp)
+        return self
+
+    async def write(self, chunk: bytes):
+        self._buffer += chunk
+        self.size += len(chunk)
+        if len(self._buffer) >= self.store.buffer_size:
+            await self._flush()
+
+    async def _flush(self, final=False):
+        # the previous block must be written and hashed before the next one
+        if self._pending:
+            await self._pending
+            self._pending = None
+        if final:
+            size = len(self._buffer)
+        else:
+            size = len(self._buffer) - len(self._buffer) % self.store.buffer_size
+        if not size:
+            return
+        # the full buffer is handed to the threads without copy, only the remainder is copied
+        block, self._buffer = self._buffer, self._buffer[size:]
+        view = memoryview(block)[:size]
+        self._pending = asyncio.gather(asyncio.to_thread(self._file.write, view),
+                                       asyncio.to_thread(self._hash.update, view))
+        if final:
+            await self._pending
+            self._pending = None
+
+    def _discard(self):
+        self._file.close()
+        if self._tmp_path.exists():
+            self._tmp_path.unlink()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type:
+            if self._pending:
+                await asyncio.gather(self._pending, return_exceptions=True)
+            await asyncio.to_thread(self._discard)
+            return False
+
+        try:
+            await self._flush(final=True)
+        except Exception:
+            await asyncio.to_thread(self._discard)
+            raise
+        await asyncio.to_thread(self._file.close)
+
+        self.sha1 = self._hash.hexdigest()
+        self.path = self.store.path(self.sha1, self.ext)
+        self.existed = await asyncio.to_thread(self.store._publish, self._tmp_path, self.sha1, self.ext)
+        return False
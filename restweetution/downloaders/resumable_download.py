@@ -0,0 +1,368 @@
+"""
+Resumable downloads into a MediaStore, used for the videos
+While a download is incomplete its partial file and its journal are kept in the store temporary folder:
+    .tmp/<sha1 of the url>.part    bytes received so far, written at their final offset
+    .tmp/<sha1 of the url>.json    PartialJournal: byte ranges received and validators of the response
+A dropped connection is resumed with an HTTP Range request, in the same call or on the next download of the url.
+Large files served with Accept-Ranges are fetched with several ranges in parallel.
+The sha1 is computed from the complete partial file before the file is published in the store.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+from contextlib import nullcontext
+from pathlib import Path
+from typing import List, Tuple
+
+import aiohttp
+from pydantic import BaseModel
+
+from restweetution import http_session
+from restweetution.downloaders.download_limits import HostLimiter
+from restweetution.downloaders.media_store import MediaStore, TMP_DIR, BUFFER_SIZE
+from restweetution.downloaders.url_downloader import UrlDownloader, DownloadResult, Throttle, MEDIA_TIMEOUT, url_ext
+
+logger = logging.getLogger('ResumableDownload')
+
+RETRIES = 5
+RETRY_DELAY = 2
+# files smaller than this are fetched with one request
+PARALLEL_MIN_SIZE = 32 * 1024 * 1024
+# the offsets of the ranges are offsets of the file, not of a compressed body
+IDENTITY_ENCODING = {'Accept-Encoding': 'identity'}
+CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+def partial_paths(store: MediaStore, url: str) -> Tuple[Path, Path]:
+    """
+    @return: paths of the partial file and of the journal of a url
+    """
+    key = hashlib.sha1(url.encode()).hexdigest()
+    return store.root / TMP_DIR / f'{key}.part', store.root / TMP_DIR / f'{key}.json'
+
+
+def _unlink(paths: List[Path]):
+    for path in paths:
+        if path.exists():
+            path.unlink()
+
+
+def parse_content_range(value: str | None) -> Tuple[int, int, int] | None:
+    """
+    @return: start, exclusive end and total size (-1 if unknown) of a Content-Range header, None if it is invalid
+    """
+    match = CONTENT_RANGE.fullmatch(value.strip()) if value else None
+    if not match:
+        return None
+    return int(match[1]), int(match[2]) + 1, -1 if match[3] == '*' else int(match[3])
+
+
+def _is_identity(resp: aiohttp.ClientResponse):
+    return resp.headers.get('Content-Encoding', 'identity').lower() == 'identity'
+
+
+async def discard_partial(store: MediaStore, url: str):
+    """
+    Delete the partial file and the journal of a url, for a download given up
+    """
+    await asyncio.to_thread(_unlink, list(partial_paths(store, url)))
+
+
+class RangeState(BaseModel):
+    start: int
+    # exclusive end, -1 if the size of the file is unknown
+    end: int = -1
+    # bytes written from start
+    done: int = 0
+
+    def offset(self):
+        return self.start + self.done
+
+    def is_complete(self):
+        return self.end >= 0 and self.offset() >= self.end
+
+
+class PartialJournal(BaseModel):
+    url: str
+    total: int = -1
+    etag: str | None = None
+    last_modified: str | None = None
+    ranges: List[RangeState] = []
+
+    def done(self):
+        return sum(r.done for r in self.ranges)
+
+
+class RestartDownload(Exception):
+    """
+    The partial content can't be resumed, the file changed or the server ignored the ranges
+    """
+
+
+class ResumableDownload:
+    def __init__(self, downloader: UrlDownloader, store: MediaStore, url: str, ext: str = None,
+                 throttle: Throttle = None, parallel: int = 1, parallel_min_size: int = PARALLEL_MIN_SIZE,
+                 retries: int = RETRIES, host_limiter: HostLimiter = None):
+        """
+        @param downloader: UrlDownloader reporting the progress
+        @param store: destination store
+        @param url: url of the file
+        @param ext: extension of the file, default from the url
+        @param throttle: called with the size of each chunk
+        @param parallel: max number of ranges fetched in parallel
+        @param parallel_min_size: min size of a file to use parallel ranges
+        @param retries: number of resumes of a range after a connection error
+        @param host_limiter: each range request holds a slot of the url host
+        """
+        self.downloader = downloader
+        self.store = store
+        self.url = url
+        self.ext = ext if ext else url_ext(url)
+        self.throttle = throttle
+        self.parallel = max(parallel, 1)
+        self.parallel_min_size = parallel_min_size
+        self.retries = retries
+        self.host_limiter = host_limiter
+
+        self._part_path, self._journal_path = partial_paths(store, url)
+        self._journal: PartialJournal | None = None
+        self._fd: int | None = None
+        self._journal_lock = asyncio.Lock()
+
+    # journal and partial file
+
+    def _load_journal(self):
+        if not self._journal_path.exists() or not self._part_path.exists():
+            return None
+        try:
+            journal = PartialJournal.parse_file(self._journal_path)
+        except ValueError:
+            return None
+        return journal if journal.url == self.url else None
+
+    def _write_journal(self, data: str):
+        tmp = self._journal_path.with_suffix('.json.tmp')
+        tmp.write_text(data)
+        os.replace(tmp, self._journal_path)
+
+    async def _save_journal(self):
+        # the parallel ranges share the journal, one write at a time
+        async with self._journal_lock:
+            await asyncio.to_thread(self._write_journal, self._journal.json())
+
+    def _open_part(self, truncate: bool):
+        self._part_path.parent.mkdir(parents=True, exist_ok=True)
+        flags = os.O_RDWR | os.O_CREAT | (os.O_TRUNC if truncate else 0)
+        self._fd = os.open(self._part_path, flags, 0o644)
+
+    def _close_part(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _discard(self):
+        self._close_part()
+        _unlink([self._part_path, self._journal_path])
+
+    def _hash_part(self):
+        sha1 = hashlib.sha1()
+        with open(self._part_path, 'rb') as f:
+            while block := f.read(BUFFER_SIZE):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+    # requests
+
+    def _validators(self, resp: aiohttp.ClientResponse):
+        self._journal.etag = resp.headers.get('ETag')
+        self._journal.last_modified = resp.headers.get('Last-Modified')
+
+    def _range_headers(self, r: RangeState):
+        end = '' if r.end < 0 else str(r.end - 1)
+        headers = {**IDENTITY_ENCODING, 'Range': f'bytes={r.offset()}-{end}'}
+        validator = self._journal.etag or self._journal.last_modified
+        if validator:
+            headers['If-Range'] = validator
+        return headers
+
+    def _check_partial(self, resp: aiohttp.ClientResponse, r: RangeState):
+        """
+        A 206 response must continue the range at its offset, for a file of the size of the journal
+        The unknown sizes are read from its Content-Range
+        @raise RestartDownload: the body can't be written at the offset of the range
+        """
+        content_range = parse_content_range(resp.headers.get('Content-Range'))
+        if content_range is None or not _is_identity(resp):
+            raise RestartDownload()
+        start, _, total = content_range
+        if start != r.offset():
+            raise RestartDownload()
+        if total >= 0 and self._journal.total >= 0 and total != self._journal.total:
+            raise RestartDownload()
+        if total >= 0 and self._journal.total < 0:
+            self._journal.total = total
+        if r.end < 0:
+            r.end = self._journal.total
+
+    async def _flush(self, r: RangeState, block: bytearray):
+        await asyncio.to_thread(os.pwrite, self._fd, block, r.offset())
+        r.done += len(block)
+        await self._save_journal()
+
+    async def _consume(self, resp: aiohttp.ClientResponse, r: RangeState):
+        """
+        Write the body of a response at the offset of the range, the journal is saved after each block
+        """
+        buffer = bytearray()
+        try:
+            async for chunk in resp.content.iter_chunked(65536):
+                if r.end >= 0:
+                    chunk = chunk[:r.end - r.offset() - len(buffer)]
+                buffer += chunk
+                self.downloader._bytes_downloaded += len(chunk)
+                if self.throttle:
+                    await self.throttle(len(chunk))
+                if len(buffer) >= BUFFER_SIZE:
+                    block, buffer = buffer, bytearray()
+                    await self._flush(r, block)
+                if r.end >= 0 and r.offset() + len(buffer) >= r.end:
+                    break
+        finally:
+            # the bytes received before an error are kept
+            if buffer:
+                await self._flush(r, buffer)
+
+    async def _fetch_range(self, r: RangeState, resp: aiohttp.ClientResponse = None):
+        """
+        Fetch a range until it is complete, resuming after the connection errors
+        The caller holds the host slot of the requests
+        @param resp: response of the first request, already sent
+        """
+        session = http_session.get_session(http_session.MEDIA)
+        attempt = 0
+        while True:
+            try:
+                if resp is None:
+                    resp = await session.get(self.url, headers=self._range_headers(r), timeout=MEDIA_TIMEOUT)
+                async with resp:
+                    if resp.status == 200 and r.offset() > 0:
+                        # the server ignored the range or the file changed since the journal
+                        raise RestartDownload()
+                    if resp.status == 416:
+                        raise RestartDownload()
+                    resp.raise_for_status()
+                    if resp.status == 206:
+                        self._check_partial(resp, r)
+                    await self._consume(resp, r)
+
+                if r.end < 0:
+                    # size unknown, the end of the body is the end of the file
+                    r.end = r.offset()
+                    self._journal.total = r.end
+                    await self._save_journal()
+                if r.is_complete():
+                    return
+                raise aiohttp.ClientPayloadError(f'Incomplete range {r.offset()}/{r.end}')
+            except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                resp = None
+                attempt += 1
+                if attempt > self.retries:
+                    raise e
+                logger.warning(f'Resume {self.url} at {r.offset()} after {e.__class__.__name__} ({attempt})')
+                await asyncio.sleep(RETRY_DELAY * attempt)
+
+    def _host_slot(self):
+        return self.host_limiter.get(self.url) if self.host_limiter else nullcontext()
+
+    async def _fetch_range_in_slot(self, r: RangeState):
+        async with self._host_slot():
+            await self._fetch_range(r)
+
+    def _split(self, total: int):
+        size = -(-total // self.parallel)
+        return [RangeState(start=start, end=min(start + size, total)) for start in range(0, total, size)]
+
+    async def _start(self):
+        """
+        First request of a new download, selects one range or parallel ranges
+        @return: response to consume for the first range, None if the ranges are requested separately
+        """
+        session = http_session.get_session(http_session.MEDIA)
+        resp = await session.get(self.url, headers=IDENTITY_ENCODING, timeout=MEDIA_TIMEOUT)
+        if resp.status >= 400:
+            async with resp:
+                resp.raise_for_status()
+
+        self._journal = PartialJournal(url=self.url)
+        self._validators(resp)
+        # the Content-Length of a compressed body is not the size of the file, the end of the body is
+        total = int(resp.headers.get('Content-Length', -1)) if _is_identity(resp) else -1
+        self._journal.total = total
+        accept_ranges = resp.headers.get('Accept-Ranges') == 'bytes' and _is_identity(resp)
+        if self.parallel > 1 and accept_ranges and total >= self.parallel_min_size:
+            resp.release()
+            self._journal.ranges = self._split(total)
+            resp = None
+        else:
+            self._journal.ranges = [RangeState(start=0, end=total)]
+        await self._save_journal()
+        return resp
+
+    def _report_start(self):
+        self.downloader._set_total(self._journal.total)
+        self.downloader._bytes_downloaded = self._journal.done()
+        self.downloader._ranges = len(self._journal.ranges)
+
+    async def _download(self, resume: bool):
+        self._journal = await asyncio.to_thread(self._load_journal) if resume else None
+        await asyncio.to_thread(self._open_part, self._journal is None)
+        try:
+            if self._journal is None:
+                # a single range is fetched with the first response, in the slot of the first request
+                async with self._host_slot():
+                    first_resp = await self._start()
+                    self._report_start()
+                    if first_resp is not None:
+                        await self._fetch_range(self._journal.ranges[0], first_resp)
+            else:
+                self.downloader._bytes_resumed = self._journal.done()
+                logger.info(f'Resume {self.url} from {self._journal.done()} / {self._journal.total} bytes')
+                self._report_start()
+
+            todo = [r for r in self._journal.ranges if not r.is_complete()]
+            tasks = [asyncio.create_task(self._fetch_range_in_slot(r)) for r in todo]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                # the other ranges must stop writing before the partial file is closed
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+        finally:
+            await asyncio.to_thread(self._close_part)
+
+    async def run(self) -> DownloadResult:
+        """
+        Download the file, resuming from the journal if present, and publish it in the store
+        The partial file and the journal are kept if the download fails
+        """
+        self.downloader._init_download(self.url)
+        try:
+            try:
+                await self._download(resume=True)
+            except RestartDownload:
+                logger.info(f'Restart {self.url}, the partial content can not be resumed')
+                await asyncio.to_thread(self._discard)
+                await self._download(resume=False)
+
+            sha1 = await asyncio.to_thread(self._hash_part)
+            existed = await asyncio.to_thread(self.store._publish, self._part_path, sha1, self.ext)
+            await asyncio.to_thread(self._journal_path.unlink)
+        finally:
+            self.downloader._stop_download()
+
+        return DownloadResult(filename=self.store.path(sha1, self.ext).__str__(), ext=self.ext, sha1=sha1,
+                              existed=existed)
@@ -1,17 +1,34 @@
-import hashlib
 import math
-import time
+from typing import Callable, Awaitable
 
 import aiofiles
-import aiohttp
-from aiopath import Path
+from aiohttp import ClientTimeout
 from pydantic import BaseModel
 
+from restweetution import http_session
+from restweetution.downloaders.media_store import MediaStore
+
 
 class DownloadResult(BaseModel):
     filename: str
     ext: str
     sha1: str | None = None
+    # the same content was already stored
+    existed: bool = False
+
+
+def url_ext(url: str):
+    name = url.rsplit('?', 1)[0].split('/')[-1]
+    if '.' not in name:
+        return 'unknown'
+    return name.split('.')[-1]
+
+
+# called with the size of each downloaded chunk, can wait to limit the bandwidth
+Throttle = Callable[[int], Awaitable]
+
+# no total timeout for large files, a stalled connection fails after sock_read seconds
+MEDIA_TIMEOUT = ClientTimeout(total=None, sock_connect=30, sock_read=60)
 
 
 class UrlDownloader:
@@ -20,12 +37,17 @@ class UrlDownloader:
         self._bytes_total = -1
         self._bytes_downloaded = 0
         self._current_url: str = ''
+        # resumable downloads: bytes found in the partial file, number of ranges fetched in parallel
+        self._bytes_resumed = 0
+        self._ranges = 0
 
     def _init_download(self, url: str):
         self._is_downloading = True
         self._current_url = url
         self._bytes_downloaded = 0
         self._bytes_total = -1
+        self._bytes_resumed = 0
+        self._ranges = 0
 
     def _stop_download(self):
         self._is_downloading = False
@@ -41,6 +63,9 @@ class UrlDownloader:
     def get_url(self):
         return self._current_url
 
+    def get_resume_info(self):
+        return self._bytes_resumed, self._ranges
+
     def print_progress(self):
         print(f'[{self.get_progress_percentage()}%] {self._bytes_downloaded} / {self._bytes_total} bytes')
 
@@ -53,72 +78,72 @@ class UrlDownloader:
         else:
             self._bytes_total = int(total)
 
-    async def download(self, src_url):
+    async def download(self, src_url, throttle: Throttle = None):
         try:
-            connector = aiohttp.TCPConnector(force_close=True, enable_cleanup_closed=True)
-            async with aiohttp.ClientSession(connector=connector) as session:
-                async with session.get(src_url) as resp:
-                    self._init_download(src_url)
-                    self._set_total(resp.headers.get("Content-Length"))
-                    data = await resp.content.read()
-                    self._bytes_downloaded = self._bytes_total
-                    self._stop_download()
-                    return data
+            session = http_session.get_session(http_session.MEDIA)
+            async with session.get(src_url, timeout=MEDIA_TIMEOUT) as resp:
+                # an error page must not be saved as the media, the download is retried later
+                resp.raise_for_status()
+                self._init_download(src_url)
+                self._set_total(resp.headers.get("Content-Length"))
+                data = await resp.content.read()
+                if throttle:
+                    await throttle(len(data))
+                self._bytes_downloaded = self._bytes_total
+                self._stop_download()
+                return data
         except Exception as e:
             self._stop_download()
             raise e
 
-    async def download_stream(self, src_url, chunk_size=65536):
+    async def download_stream(self, src_url, chunk_size=65536, throttle: Throttle = None):
         try:
-            connector = aiohttp.TCPConnector(force_close=True, enable_cleanup_closed=True)
-            async with aiohttp.ClientSession(connector=connector) as session:
-                async with session.get(src_url) as resp:
-                    self._init_download(src_url)
-                    self._set_total(resp.headers.get("Content-Length"))
-                    async for chunk in resp.content.iter_chunked(chunk_size):
-                        self._bytes_downloaded += len(chunk)
-                        yield chunk
+            session = http_session.get_session(http_session.MEDIA)
+            async with session.get(src_url, timeout=MEDIA_TIMEOUT) as resp:
+                # an error page must not be saved as the media, the download is retried later
+                resp.raise_for_status()
+                self._init_download(src_url)
+                self._set_total(resp.headers.get("Content-Length"))
+                async for chunk in resp.content.iter_chunked(chunk_size):
+                    self._bytes_downloaded += len(chunk)
+                    if throttle:
+                        await throttle(len(chunk))
+                    yield chunk
             self._stop_download()
         except Exception as e:
             self._stop_download()
             raise e
 
-    async def download_save(self, src_url, dest_file):
+    async def download_save(self, src_url, dest_file, throttle: Throttle = None):
         async with aiofiles.open(dest_file, 'wb') as fd:
-            data = await self.download(src_url)
+            data = await self.download(src_url, throttle=throttle)
             await fd.write(data)
             return data
 
-    async def download_save_stream(self, src_url, dest_file, chunk_size=65536):
+    async def download_save_stream(self, src_url, dest_file, chunk_size=65536, throttle: Throttle = None):
         async with aiofiles.open(dest_file, 'wb') as fd:
-            async for chunk in self.download_stream(src_url, chunk_size=chunk_size):
+            async for chunk in self.download_stream(src_url, chunk_size=chunk_size, throttle=throttle):
                 await fd.write(chunk)
                 yield chunk
 
-    async def download_save_sha1(self, src_url: str, dest_folder: str, ext: str = None, tmp_name: str = None):
-        # use a tmp name with help of the url
-        if tmp_name is None:
-            tmp_name = time.time().__str__() + '-' + src_url.split('/')[-1]
+    async def download_to_store(self, src_url: str, store: MediaStore, ext: str = None,
+                                throttle: Throttle = None) -> DownloadResult:
+        """
+        Download a file into a content addressed MediaStore
+        @param src_url: url of the file
+        @param store: destination store
+        @param ext: extension of the file, default from the url
+        @param throttle: called with the size of each chunk
+        @return: DownloadResult with the path of the stored file
+        """
         if ext is None:
-            if tmp_name.find('.'):
-                clean = tmp_name.rsplit('?', 1)[0]
-                ext = clean.split('.')[-1]
-            else:
-                ext = 'unknown'
-
-        filename = tmp_name + '.part'
-        dest_file = Path(dest_folder) / filename
-
-        sha1 = hashlib.sha1()
-        async for data in self.download_save_stream(src_url, dest_file, chunk_size=65536):
-            sha1.update(data)
-
-        sha1 = sha1.hexdigest()
+            ext = url_ext(src_url)
 
-        sha1_dest_file = Path(dest_folder)
-        sha1_dest_file = sha1_dest_file / sha1
-        sha1_dest_file = sha1_dest_file.with_suffix('.' + ext)
+        async with store.writer(ext) as writer:
+            async for chunk in self.download_stream(src_url, chunk_size=65536, throttle=throttle):
+                await writer.write(chunk)
 
-        await dest_file.rename(sha1_dest_file)
+        return DownloadResult(filename=writer.path.__str__(), ext=ext, sha1=writer.sha1, existed=writer.existed)
 
-        return DownloadResult(filename=sha1_dest_file.__str__(), ext=ext, sha1=sha1)
+    async def download_save_sha1(self, src_url: str, dest_folder: str, ext: str = None, throttle: Throttle = None):
+        return await self.download_to_store(src_url, MediaStore(dest_folder), ext=ext, throttle=throttle)
@@ -0,0 +1,111 @@
+"""
+Shared aiohttp sessions used by the Twitter API clients and the media downloaders
+Sessions are created on first use and kept open, their connectors keep the connections alive
+and cache the DNS resolutions, so consecutive requests to the same host reuse the TLS connection.
+ex:
+    from restweetution import http_session
+    session = http_session.get_session(http_session.MEDIA)
+    async with session.get(url) as resp:
+        ...
+    # on shutdown
+    await http_session.close_all()
+"""
+import asyncio
+import logging
+from typing import Dict, Tuple
+
+import aiohttp
+from pydantic import BaseModel
+
+logger = logging.getLogger('HttpSession')
+
+# session names
+TWITTER = 'twitter'
+# long lived stream connections, out of the TWITTER pool so that they don't hold its connections
+STREAM = 'stream'
+MEDIA = 'media'
+
+
+class SessionConfig(BaseModel):
+    """
+    TCPConnector options of a session
+    limit: max number of connections, limit_per_host: max number of connections to the same host, 0 for no limit
+    ttl_dns_cache: seconds a DNS resolution is kept, keepalive_timeout: seconds an idle connection is kept
+    """
+    limit: int = 100
+    limit_per_host: int = 10
+    ttl_dns_cache: int = 300
+    keepalive_timeout: float = 30
+
+
+DEFAULT_CONFIGS: Dict[str, SessionConfig] = {
+    TWITTER: SessionConfig(limit=50, limit_per_host=10),
+    STREAM: SessionConfig(limit=0, limit_per_host=0),
+    MEDIA: SessionConfig(limit=100, limit_per_host=8),
+}
+
+
+class SessionRegistry:
+    """
+    One ClientSession per name, recreated if it was closed or if the event loop changed
+    """
+
+    def __init__(self, configs: Dict[str, SessionConfig] = None):
+        self._configs: Dict[str, SessionConfig] = dict(DEFAULT_CONFIGS)
+        if configs:
+            self._configs.update(configs)
+        self._sessions: Dict[str, Tuple[asyncio.AbstractEventLoop, aiohttp.ClientSession]] = {}
+
+    def configure(self, name: str, config: SessionConfig):
+        """
+        Set the options of a session, applied the next time the session is created
+        """
+        self._configs[name] = config
+
+    def get_config(self, name: str) -> SessionConfig:
+        return self._configs.get(name) or SessionConfig()
+
+    def get_session(self, name: str) -> aiohttp.ClientSession:
+        """
+        Must be called from a coroutine, the session is bound to the running event loop
+        @param name: session name, ex: TWITTER, MEDIA
+        @return: the shared session
+        """
+        loop = asyncio.get_running_loop()
+        if name in self._sessions:
+            session_loop, session = self._sessions[name]
+            if not session.closed and session_loop is loop:
+                return session
+
+        config = self.get_config(name)
+        connector = aiohttp.TCPConnector(limit=config.limit,
+                                         limit_per_host=config.limit_per_host,
+                                         ttl_dns_cache=config.ttl_dns_cache,
+                                         keepalive_timeout=config.keepalive_timeout,
+                                         enable_cleanup_closed=True)
+        session = aiohttp.ClientSession(connector=connector)
+        self._sessions[name] = (loop, session)
+        logger.debug(f'New {name} session')
+        return session
+
+    async def close(self, name: str):
+        if name not in self._sessions:
+            return
+        _, session = self._sessions.pop(name)
+        if not session.closed:
+            await session.close()
+
+    async def close_all(self):
+        for name in list(self._sessions):
+            await self.close(name)
+
+
+registry = SessionRegistry()
+
+
+def get_session(name: str) -> aiohttp.ClientSession:
+    return registry.get_session(name)
+
+
+async def close_all():
+    await registry.close_all()
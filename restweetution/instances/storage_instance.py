@@ -10,7 +10,8 @@ class StorageInstance:
     def __init__(self, config: SystemConfig):
         self.storage = PostgresJSONBStorage(config.postgres_url)
         if config.media_dir_path:
-            self.media_downloader = MediaDownloader(root=config.media_dir_path, storage=self.storage)
+            self.media_downloader = MediaDownloader(root=config.media_dir_path, storage=self.storage,
+                                                   config=config.downloader)
         if config.elastic:
             self.elastic = ElasticStorage('elastic', **config.elastic.dict())
             self.elastic_dashboard = ViewExporter(view=TweetView2(), exporter=self.elastic)
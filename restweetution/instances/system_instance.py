@@ -18,6 +18,20 @@ class SystemInstance:
         self.system_config = system_config
         self.storage_instance = StorageInstance(system_config)
 
+    async def start(self):
+        """
+        Release the download tasks claimed by the previous run of this worker and resume them
+        """
+        media_downloader = getattr(self.storage_instance, 'media_downloader', None)
+        if media_downloader:
+            await self.storage_instance.storage.release_download_tasks(media_downloader.worker_id)
+            media_downloader.resume()
+
+    async def close(self):
+        media_downloader = getattr(self.storage_instance, 'media_downloader', None)
+        if media_downloader:
+            await media_downloader.close()
+
     async def emit_event(self, update):
         fire_and_forget(self.event(update))
 
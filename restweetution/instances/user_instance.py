@@ -7,10 +7,13 @@ from restweetution.collectors import Streamer
 from restweetution.collectors.searcher import Searcher
 from restweetution.instances.storage_instance import StorageInstance
 from restweetution.models.bulk_data import BulkData
-from restweetution.models.config.user_config import UserConfig, RuleConfig, CollectorConfig, CollectOptions
+from restweetution.downloaders.download_queue import PRIORITY_LIVE, PRIORITY_BACKFILL
+from restweetution.models.config.user_config import UserConfig, RuleConfig, CollectorConfig, CollectOptions, \
+    StreamerConfig
 from restweetution.models.instance_update import InstanceUpdate
 from restweetution.models.linked.linked_bulk_data import LinkedBulkData
 from restweetution.models.storage.downloaded_media import DownloadedMedia
+from restweetution.storages.postgres_jsonb_storage.bulk_rows import BulkRows
 from restweetution.utils import AsyncEvent, fire_and_forget
 
 logger = logging.getLogger('UserInterface')
@@ -61,7 +64,10 @@ class UserInstance:
     def _create_streamer(self):
         if self._streamer:
             raise Exception('Streamer already exist')
-        self._streamer = Streamer(bearer_token=self.user_config.bearer_token, storage=self.storage_instance.storage)
+        self._streamer = Streamer(bearer_token=self.user_config.bearer_token,
+                                  storage=self.storage_instance.storage,
+                                  parser_workers=self.user_config.streamer_state.parser_workers,
+                                  validate=self.user_config.streamer_state.validate_models)
         self._streamer.event_update.add(self._streamer_update)
         self._streamer.event_collect.add(self._on_collect(self.user_config.streamer_state))
 
@@ -83,11 +89,17 @@ class UserInstance:
         return self._streamer.has_conflict()
 
     def _on_collect(self, collect_config: CollectorConfig):
-        async def on_collect_event(bulk_data: BulkData):
+        async def on_collect_event(bulk_data: BulkData | BulkRows):
             collect_options = collect_config.collect_options
             media_downloader = self.storage_instance.media_downloader
             elastic_dashboard = self.storage_instance.elastic_dashboard
 
+            if not collect_options.download_media() and not collect_options.elastic_dashboard:
+                return
+            # the stream saves BulkRows, models are only built when the data is used
+            if isinstance(bulk_data, BulkRows):
+                bulk_data = bulk_data.to_bulk_data()
+
             if collect_options.download_media():
                 if not media_downloader:
                     logger.warning('No MediaDownloader set, tried to download media')
@@ -99,13 +111,15 @@ class UserInstance:
                     photos = [m for m in medias if m.type == 'photo']
                     videos = [m for m in medias if m.type == 'video']
                     gif = [m for m in medias if m.type == 'animated_gif']
+                    # live stream medias go before the searcher backfill
+                    priority = PRIORITY_LIVE if isinstance(collect_config, StreamerConfig) else PRIORITY_BACKFILL
 
                     if collect_options.download_photo:
-                        media_downloader.download_medias(medias=photos, callback=callback)
+                        media_downloader.download_medias(medias=photos, callback=callback, priority=priority)
                     if collect_options.download_video:
-                        media_downloader.download_medias(medias=videos, callback=callback)
+                        media_downloader.download_medias(medias=videos, callback=callback, priority=priority)
                     if collect_options.download_gif:
-                        media_downloader.download_medias(medias=gif, callback=callback)
+                        media_downloader.download_medias(medias=gif, callback=callback, priority=priority)
 
             if collect_options.elastic_dashboard and collect_options.elastic_dashboard_name:
                 if not elastic_dashboard:
@@ -174,6 +188,9 @@ class UserInstance:
     def streamer_get_count(self):
         return self._streamer.get_count()
 
+    def streamer_get_pipeline_status(self):
+        return self._streamer.get_pipeline_status()
+
     def _create_searcher(self):
         if self._searcher:
             raise Exception('Searcher already exist')
@@ -1,8 +1,9 @@
 from collections import defaultdict
 from datetime import datetime
+from itertools import chain
 from typing import List, Dict, DefaultDict, Set
 
-from restweetution.models.rule import Rule, RuleMatch
+from restweetution.models.rule import Rule, RuleMatch, CompactRuleMatch
 from restweetution.models.storage.custom_data import CustomData
 from restweetution.models.storage.downloaded_media import DownloadedMedia
 from restweetution.models.twitter import Media
@@ -21,7 +22,8 @@ class BulkData:
         self.medias: Dict[str, Media] = {}
         self.downloaded_medias: Dict[str, DownloadedMedia] = {}
         self.polls: Dict[str, Poll] = {}
-        self.rule_matches: DefaultDict[str, Dict[int, RuleMatch]] = defaultdict(dict)
+        # CompactRuleMatch when read from the storage
+        self.rule_matches: DefaultDict[str, Dict[int, RuleMatch | CompactRuleMatch]] = defaultdict(dict)
         self.custom_datas: Dict[str, CustomData] = {}
         self.timestamp: datetime | None = None
 
@@ -46,8 +48,15 @@ class BulkData:
                     self.rules[k].matches[c] = other.rules[k].matches[c]
         for k in other.downloaded_medias:
             self.downloaded_medias[k] = other.downloaded_medias[k]
-        for m in other.rule_matches:
-            self.rule_matches[m] = other.rule_matches[m]
+        for tweet_id in other.rule_matches:
+            matches = self.rule_matches[tweet_id]
+            for rule_id, match in other.rule_matches[tweet_id].items():
+                # an include match must not hide a direct hit of the same rule
+                if rule_id in matches and matches[rule_id].direct_hit and not match.direct_hit:
+                    continue
+                matches[rule_id] = match
+        if other.timestamp:
+            self.timestamp = other.timestamp
 
         return self
 
@@ -107,7 +116,7 @@ class BulkData:
                     self.rules[rule.id].matches[collected.tweet_id] = collected
             self.add_rule_matches(list(rule.matches.values()))
 
-    def add_rule_matches(self, matches: List[RuleMatch]):
+    def add_rule_matches(self, matches: List[RuleMatch | CompactRuleMatch]):
         for match in matches:
             self.rule_matches[match.tweet_id][match.rule_id] = match
 
@@ -156,8 +165,8 @@ class BulkData:
     def get_tweet_matches(self, tweet_id: str):
         return list(self.rule_matches[tweet_id].values())
 
-    def get_rule_matches(self):
-        return sum([list(match_list.values()) for match_list in self.rule_matches.values()], [])
+    def get_rule_matches(self) -> List[RuleMatch]:
+        return list(chain.from_iterable(match_list.values() for match_list in self.rule_matches.values()))
 
     def compute_media_to_tweets(self):
         res = defaultdict(set)
@@ -4,8 +4,10 @@ from typing import Optional
 from pydantic import BaseModel
 
 from restweetution.models.linked.storage_collection import StorageCollection
-from restweetution.storages.elastic_storage.elastic_storage import ElasticStorage
+from restweetution.storages.elastic_storage.elastic_storage import ElasticStorage, ElasticBulkConfig
+from restweetution.models.view_types import ViewType
 from restweetution.storages.exporter.csv_exporter import CSVExporter
+from restweetution.storages.exporter.parquet_exporter import ParquetExporter
 from restweetution.storages.postgres_jsonb_storage.postgres_jsonb_storage import PostgresJSONBStorage
 
 
@@ -13,11 +15,35 @@ class ElasticConfig(BaseModel):
     url: str
     user: str
     pwd: str
+    bulk: Optional[ElasticBulkConfig]
+
+
+class DownloaderConfig(BaseModel):
+    """
+    workers: number of concurrent downloads of each media queue
+    host_limit: max concurrent downloads from the same host, across the queues
+    max_bytes_per_second: global bandwidth budget of the downloads, None for no limit
+    resume_videos: videos and gifs keep their partial file to resume the download after an error or a restart
+    parallel_ranges: number of ranges fetched in parallel for the large videos
+    fingerprint_workers: processes computing the perceptual hashes of the downloaded photos, 0 to disable
+    worker_id: name of the process in the claims of the download tasks, default to the host name. On start the claims
+    with this name were left by the previous run and are released, give a different name to each downloading process
+    """
+    photo_workers: int = 8
+    video_workers: int = 2
+    gif_workers: int = 2
+    host_limit: int = 8
+    max_bytes_per_second: Optional[int]
+    resume_videos: bool = True
+    parallel_ranges: int = 4
+    fingerprint_workers: int = 2
+    worker_id: Optional[str]
 
 
 class SystemConfig(BaseModel):
     postgres_url: str
     media_dir_path: Optional[str]
+    downloader: Optional[DownloaderConfig]
     elastic: Optional[ElasticConfig]
     resource_root_dir: Optional[str]
     public_base_path: Optional[str]
@@ -36,14 +62,22 @@ class SystemConfig(BaseModel):
         return collection
 
     def build_elastic_exporter(self):
-        return ElasticStorage('', self.elastic.url, self.elastic.user, self.elastic.pwd)
+        return ElasticStorage('', self.elastic.url, self.elastic.user, self.elastic.pwd, bulk=self.elastic.bulk)
 
-    def build_csv_exporter(self, sub_folder: str = None):
+    def build_csv_exporter(self, sub_folder: str = None, compression: str = None):
         if not sub_folder:
             sub_folder = ''
         path = self.get_resource_path() / 'export_csv' / sub_folder
 
-        return CSVExporter(root_dir=path)
+        return CSVExporter(root_dir=path, compression=compression)
+
+    def build_parquet_exporter(self, sub_folder: str = None, view_type: ViewType = ViewType.TWEET,
+                               compression: str = None):
+        if not sub_folder:
+            sub_folder = ''
+        path = self.get_resource_path() / 'export_parquet' / sub_folder
+
+        return ParquetExporter(root_dir=path, view_type=view_type, compression=compression or 'zstd')
 
     def get_resource_path(self):
         if not self.resource_root_dir:
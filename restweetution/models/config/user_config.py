@@ -40,6 +40,8 @@ class CollectorConfig(BaseModel, ABC):
 
 class StreamerConfig(CollectorConfig):
     rules: List[RuleConfig] = []
+    parser_workers: int = 0  # number of processes parsing the stream, 0 parses on the event loop
+    validate_models: bool = False  # parse the stream with the pydantic models instead of the rows parser (debug)
 
 
 class SearcherConfig(CollectorConfig):
@@ -16,6 +16,8 @@ class LinkedBulkData(BulkData):
     def __init__(self):
         super().__init__()
         self.media_to_tweets = defaultdict(set)
+        # cursor of the next page when the data comes from a paginated query
+        self.cursor: str | None = None
 
     def add_tweets(self, tweets: List[Tweet]):
         super().add_tweets(tweets)
@@ -1,4 +1,5 @@
 import asyncio
+from itertools import chain
 from typing import Callable
 from typing import List
 
@@ -122,6 +123,7 @@ class StorageCollection:
 
     async def load_tweet_from_query(self, query: CollectionQuery):
         data = await self._storage.query_tweets(query)
+        self.data.cursor = data.cursor
 
         self.data.add_tweets(data.get_tweets())
         self.data.add_rule_matches(data.get_rule_matches())
@@ -135,6 +137,7 @@ class StorageCollection:
 
     async def load_media_from_query(self, query: CollectionQuery, load_rules=True, load_tweets=True):
         data = await self._storage.query_medias(query)
+        self.data.cursor = data.cursor
 
         self.data.add_medias(data.get_medias())
         self.data.add_downloaded_medias(data.get_downloaded_medias())
@@ -170,7 +173,7 @@ class StorageCollection:
     async def load_medias_from_tweets(self, tweets: List[LinkedTweet] = None):
         if not tweets:
             tweets = self.data.get_linked_tweets(list(self.data.tweets.keys()))
-        media_keys = sum([t.tweet.get_media_keys() for t in tweets], [])
+        media_keys = list(chain.from_iterable(t.tweet.get_media_keys() for t in tweets))
 
         medias = await self.load_medias(media_keys)
         return medias
@@ -178,7 +181,7 @@ class StorageCollection:
     async def load_polls_from_tweets(self, tweets: List[LinkedTweet]):
         if not tweets:
             tweets = self.data.get_linked_tweets(list(self.data.tweets.keys()))
-        poll_ids = sum([(t.tweet.get_poll_ids()) for t in tweets], [])
+        poll_ids = list(chain.from_iterable(t.tweet.get_poll_ids() for t in tweets))
 
         polls = await self.load_polls(poll_ids)
         return polls
@@ -207,14 +210,15 @@ class StorageCollection:
             self.load_replied_from_tweets(tweets),
             self.load_author_from_tweets(tweets)
         )
-        loaded = sum(res, [])
+        loaded = list(chain.from_iterable(res))
         return loaded
 
     async def load_rules_from_tweets(self, tweets: List[LinkedTweet] = None):
         if not tweets:
             tweets = self.data.get_linked_tweets(list(self.data.tweets.keys()))
 
-        rule_ids = sum([[m.rule_id for m in self.data.rule_matches[t.tweet.id].values()] for t in tweets], [])
+        matches = self.data.rule_matches
+        rule_ids = list({rule_id for t in tweets if t.tweet.id in matches for rule_id in matches[t.tweet.id]})
         rule_ids = self.loaded.only_new_rules(rule_ids)
 
         rules = await self.load_rules(rule_ids)
@@ -239,7 +243,7 @@ class StorageCollection:
             self.load_quoted_tweet_from_tweets(tweets),
             self.load_conversation_tweet_from_tweets(tweets)
         )
-        loaded = sum([r for r in res if r], [])
+        loaded = list(chain.from_iterable(r for r in res if r))
         return loaded
 
     async def _load_tweet_from_tweets(self, tweets: List[LinkedTweet], id_fn: Callable):
@@ -268,7 +272,8 @@ class StorageCollection:
         if not medias:
             medias = self.data.get_linked_medias(list(self.data.medias.keys()))
 
-        tweet_ids = sum([list(self.data.media_to_tweets[m.media.media_key]) for m in medias], [])
+        media_to_tweets = self.data.media_to_tweets
+        tweet_ids = list(set(chain.from_iterable(media_to_tweets.get(m.media.media_key, ()) for m in medias)))
         tweet_ids = self.loaded.only_new_tweets(tweet_ids)
         tweets = await self.load_tweets(tweet_ids)
 
@@ -0,0 +1,34 @@
+from pydantic import BaseModel
+
+
+class StageMetrics(BaseModel):
+    """
+    Counters for one stage of a pipeline (parsing, flushing, etc..)
+    Times are in seconds
+    """
+    count: int = 0
+    items: int = 0
+    total_time: float = 0
+    last_time: float = 0
+    max_time: float = 0
+    last_size: int = 0
+    max_size: int = 0
+
+    def add(self, elapsed: float, size: int = 1):
+        self.count += 1
+        self.items += size
+        self.total_time += elapsed
+        self.last_time = elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.last_size = size
+        self.max_size = max(self.max_size, size)
+
+    def mean_time(self):
+        if not self.count:
+            return 0
+        return self.total_time / self.count
+
+    def mean_size(self):
+        if not self.count:
+            return 0
+        return self.items / self.count
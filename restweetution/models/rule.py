@@ -23,6 +23,36 @@ class RuleMatch(BaseModel):
     tweet: Optional[Tweet]
 
 
+class CompactRuleMatch:
+    """
+    Rule match read from the storage, same attributes as RuleMatch without the pydantic model
+    The tweet queries return the matches as parallel arrays (rule_id, direct_hit, collected_at),
+    a tweet can be matched by dozens of rules
+    """
+    __slots__ = ('tweet_id', 'rule_id', 'direct_hit', 'collected_at', 'tweet')
+
+    def __init__(self, tweet_id: str, rule_id: int, direct_hit: bool = False, collected_at: datetime = None):
+        self.tweet_id = tweet_id
+        self.rule_id = rule_id
+        self.direct_hit = bool(direct_hit)
+        self.collected_at = collected_at
+        self.tweet = None
+
+    @classmethod
+    def from_arrays(cls, tweet_id: str, rule_ids: List[int], direct_hits: List[bool], collected_ats: List[datetime]):
+        return [cls(tweet_id, *m) for m in zip(rule_ids, direct_hits, collected_ats)]
+
+    def dict(self, **kwargs):
+        return {'collected_at': self.collected_at, 'direct_hit': self.direct_hit, 'tweet_id': self.tweet_id,
+                'rule_id': self.rule_id, 'tweet': self.tweet}
+
+    def to_rule_match(self) -> RuleMatch:
+        return RuleMatch(**self.dict())
+
+    def __repr__(self):
+        return f'CompactRuleMatch(tweet_id={self.tweet_id!r}, rule_id={self.rule_id}, direct_hit={self.direct_hit})'
+
+
 class Rule(BaseModel):
     id: Optional[int]  # database given
     tag: Optional[str]  # Tag that can be shared with other rules
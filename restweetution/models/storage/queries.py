@@ -40,6 +40,8 @@ class CollectionQuery(CollectionCountQuery):
     offset: int = None
     order: int = 0
     tweet_ids: List[str] = None
+    # opaque keyset pagination token returned with the previous page, use instead of offset
+    cursor: str = None
 
 
 class ViewQuery(BaseModel):
@@ -0,0 +1,111 @@
+"""
+JSON serialization used across the package
+Uses orjson or msgspec when they are installed and falls back to the standard json module
+ex:
+    from restweetution import serializer
+    data = serializer.loads(line)
+    txt = serializer.dumps(data)
+"""
+import json
+import logging
+from typing import Any, Callable, Dict
+
+logger = logging.getLogger('Serializer')
+
+
+class JSONBackend:
+    """
+    loads accepts str or bytes, dumps always returns a str
+    Objects that are not JSON serializable are converted with str()
+    """
+    name = 'json'
+
+    def loads(self, data: str | bytes) -> Any:
+        return json.loads(data)
+
+    def dumps(self, data: Any) -> str:
+        return json.dumps(data, default=str)
+
+
+class OrjsonBackend(JSONBackend):
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+        # datetimes are passed to default=str to keep the same output as the json backend
+        self._option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def loads(self, data: str | bytes) -> Any:
+        return self._orjson.loads(data)
+
+    def dumps(self, data: Any) -> str:
+        return self._orjson.dumps(data, default=str, option=self._option).decode()
+
+
+class MsgspecBackend(JSONBackend):
+    """
+    msgspec decodes the data. Its encoder has no passthrough option for the datetimes, they would be encoded in
+    another format than str(), so dumps uses orjson when it is installed, else the json module
+    """
+    name = 'msgspec'
+
+    def __init__(self):
+        import msgspec
+        self._decoder = msgspec.json.Decoder()
+        try:
+            self._dumps = OrjsonBackend().dumps
+        except ImportError:
+            self._dumps = super().dumps
+
+    def loads(self, data: str | bytes) -> Any:
+        return self._decoder.decode(data)
+
+    def dumps(self, data: Any) -> str:
+        return self._dumps(data)
+
+
+BACKENDS: Dict[str, Callable[[], JSONBackend]] = {
+    'orjson': OrjsonBackend,
+    'msgspec': MsgspecBackend,
+    'json': JSONBackend
+}
+
+_backend: JSONBackend | None = None
+
+
+def set_backend(name: str = None):
+    """
+    Select the backend used by loads and dumps
+    @param name: one of BACKENDS, if None the first installed backend is used
+    @return: the selected backend
+    """
+    global _backend
+    if name:
+        if name not in BACKENDS:
+            raise ValueError(f'Unknown JSON backend: {name}, must be one of {list(BACKENDS)}')
+        _backend = BACKENDS[name]()
+        return _backend
+
+    for key, backend in BACKENDS.items():
+        try:
+            _backend = backend()
+            break
+        except ImportError:
+            continue
+    logger.debug(f'Using {_backend.name} JSON backend')
+    return _backend
+
+
+def get_backend() -> JSONBackend:
+    if _backend is None:
+        set_backend()
+    return _backend
+
+
+def loads(data: str | bytes) -> Any:
+    return get_backend().loads(data)
+
+
+def dumps(data: Any) -> str:
+    return get_backend().dumps(data)
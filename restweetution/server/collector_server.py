@@ -1,6 +1,5 @@
 import asyncio
 import datetime
-import json
 import logging
 import math
 import os
@@ -14,7 +13,8 @@ from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from starlette.websockets import WebSocket, WebSocketDisconnect
 
-from restweetution import config_loader
+from restweetution import config_loader, serializer, http_session
+from restweetution.downloaders.download_queue import PRIORITY_BACKFILL
 from restweetution.instances.system_instance import SystemInstance
 from restweetution.models.config.user_config import RuleConfig, UserConfig, CollectOptions
 from restweetution.models.instance_update import InstanceUpdate
@@ -63,14 +63,14 @@ async def send_updates(update: InstanceUpdate):
     global last_streamer_update
     if update.source == 'searcher':
         update.data = await searcher_info(update.user_id)
-        await manager.broadcast(json.dumps(update.dict(), default=str))
+        await manager.broadcast(serializer.dumps(update.dict()))
     if update.source == 'streamer':
         now = time.time()
         if int(now - last_streamer_update) < 3:
             return
         last_streamer_update = now
         update.data = await streamer_info(update.user_id)
-        await manager.broadcast(json.dumps(update.dict(), default=str))
+        await manager.broadcast(serializer.dumps(update.dict()))
 
 
 async def send_downloader_update(interval: int):
@@ -78,7 +78,7 @@ async def send_downloader_update(interval: int):
         try:
             status = restweet.get_media_downloader_status()
             update = InstanceUpdate(source='downloader', data=status.dict())
-            await manager.broadcast(json.dumps(update.dict(), default=str))
+            await manager.broadcast(serializer.dumps(update.dict()))
         except Exception as e:
             logger.warning(e.__str__())
         await asyncio.sleep(interval)
@@ -87,6 +87,7 @@ async def send_downloader_update(interval: int):
 async def launch():
     global restweet
     restweet = SystemInstance(sys_conf)
+    await restweet.start()
     await restweet.load_user_configs()
     restweet.event.add(send_updates)
 
@@ -96,6 +97,13 @@ async def launch():
 launch_task = loop.create_task(launch())
 
 
+@app.on_event('shutdown')
+async def shutdown():
+    if restweet:
+        await restweet.close()
+    await http_session.close_all()
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
@@ -143,7 +151,7 @@ async def del_users(names: List[str]):
 
 @app.get('/debug/tasks')
 async def get_tasks_nb():
-    return json.dumps(global_task_list, default=str)
+    return serializer.dumps(global_task_list)
 
 
 # @app.get("/downloader")
@@ -194,6 +202,7 @@ async def streamer_info(user_id):
             "running": user.streamer_is_running(),
             "active_rules": user.streamer_get_rules(),
             "count": user.streamer_get_count(),
+            "pipeline": user.streamer_get_pipeline_status(),
             "collect_options": user.streamer_get_collect_options(),
             "conflict": user.streamer_has_conflict()
         }
@@ -454,7 +463,7 @@ async def download_medias(media_keys: List[str]):
     if not medias:
         return HTTPException(400, 'No medias found in DB with given media_keys')
 
-    downloader.download_medias(medias)
+    downloader.download_medias(medias, priority=PRIORITY_BACKFILL)
 
     return f'Trigger download for {len(medias)} medias'
 
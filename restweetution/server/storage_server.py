@@ -1,9 +1,8 @@
 import asyncio
-import json
 import logging
 import os
 from time import time
-from typing import List
+from typing import List, Optional
 
 from fastapi import FastAPI, HTTPException
 from fastapi.exceptions import RequestValidationError
@@ -14,7 +13,7 @@ from starlette.requests import Request
 from starlette.responses import JSONResponse
 from starlette.websockets import WebSocket, WebSocketDisconnect
 
-from restweetution import config_loader
+from restweetution import config_loader, serializer
 from restweetution.data_view.media_view2 import MediaView2
 from restweetution.data_view.tweet_view2 import TweetView2
 from restweetution.models.linked.storage_collection import StorageCollection
@@ -50,6 +49,7 @@ class ExportRequest(BaseModel):
     id: str  # id of the exported data for future identification
     fields: List[str]
     query: ViewQuery
+    compression: Optional[str] = None  # csv: gzip or zstd, parquet: zstd (default), snappy, gzip or none
 
 
 class Error(HTTPException):
@@ -86,7 +86,7 @@ async def send_update(interval: int):
         try:
             task_update = get_tasks()
             update = {'source': 'export_tasks', 'data': task_update}
-            await manager.broadcast(json.dumps(update, default=str))
+            await manager.broadcast(serializer.dumps(update))
         except Exception as e:
             logger.warning(e.__str__())
         await asyncio.sleep(interval)
@@ -134,6 +134,7 @@ async def get_view_media(query: CollectionQuery, tweet_filter: TweetFilter = Non
     medias = await coll.load_media_from_query(query)
 
     view = MediaView2.compute(medias)
+    view.cursor = coll.data.cursor
 
     logger.info(f'media_view took {round(time() - old, 2)} seconds')
 
@@ -147,13 +148,18 @@ async def get_view_tweet(query: CollectionQuery, tweet_filter: TweetFilter = Non
     tweet_filter = tweet_filter if tweet_filter else TweetFilter()
     query.limit = query.limit if query.limit and 0 < query.limit < 100 else 100
 
-    data = await storage.query_tweets_sample(query=query)
+    if query.cursor or query.order:
+        # keyset pagination, the next page is requested with the returned cursor
+        data = await storage.query_tweets(query=query, tweet_filter=tweet_filter)
+    else:
+        data = await storage.query_tweets_sample(query=query)
     coll = StorageCollection(storage, data)
     # await coll.load_tweet_from_query(query)
     tweet_ids = [t.id for t in coll.data.get_tweets()]
     await coll.load_all_from_tweets()
 
     view = TweetView2.compute(coll.data.get_linked_tweets(tweet_ids))
+    view.cursor = data.cursor
 
     logger.info(f'tweet_view took {round(time() - old, 2)} seconds')
 
@@ -202,7 +208,7 @@ async def export_tweets(request: ExportRequest):
         if len(path) == 2:
             sub_folder = path[0]
 
-        exporter = sys_conf.build_csv_exporter(sub_folder=sub_folder)
+        exporter = sys_conf.build_csv_exporter(sub_folder=sub_folder, compression=request.compression)
 
         if not key.endswith('.csv'):
             key = key + '.csv'
@@ -211,6 +217,24 @@ async def export_tweets(request: ExportRequest):
         task.name = 'CSV Export'
         on_finish = convert_path
 
+    if request.export_type == 'parquet':
+        path = request.id.split('/')
+        sub_folder = None
+        if len(path) > 2:
+            raise ValueError('The requested id for the Parquet export can contain only one --> / <--')
+        if len(path) == 2:
+            sub_folder = path[0]
+
+        exporter = sys_conf.build_parquet_exporter(sub_folder=sub_folder, view_type=request.query.view_type,
+                                                   compression=request.compression)
+
+        if not key.endswith('.parquet'):
+            key = key + '.parquet'
+        export_query = ExportQuery(key=key, query=request.query, fields=request.fields)
+        task = ViewExportFileTask(storage=storage, query=export_query, exporter=exporter)
+        task.name = 'Parquet Export'
+        on_finish = convert_path
+
     if request.export_type == 'elastic':
         exporter = exporter_elastic
         export_query = ExportQuery(key=key, query=request.query, fields=request.fields)
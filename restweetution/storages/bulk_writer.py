@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Optional
+
+from pydantic import BaseModel
+
+from restweetution.errors import handle_error, StorageError
+from restweetution.models.bulk_data import BulkData
+from restweetution.models.metrics import StageMetrics
+from restweetution.storages.postgres_jsonb_storage.bulk_rows import BulkRows
+from restweetution.storages.postgres_jsonb_storage.postgres_jsonb_storage import PostgresJSONBStorage
+
+logger = logging.getLogger('BulkWriter')
+
+
+class BulkWriterStatus(BaseModel):
+    pending: int
+    in_flight: int
+    blocked_count: int
+    flush: StageMetrics
+
+
+class BulkWriter:
+    def __init__(self,
+                 storage: PostgresJSONBStorage,
+                 callback: Callable = None,
+                 max_tweets: int = 500,
+                 max_delay: float = 0.2,
+                 max_pending: int = 5000):
+        """
+        Coalescing stage in front of storage.save_bulk
+        Incoming BulkData are merged together and flushed in one transaction when the batch reaches
+        max_tweets or when the oldest buffered data is older than max_delay seconds.
+        put() waits while the batch is full or while more than max_pending tweets are buffered or being saved,
+        this gives backpressure to the producer.
+        The data can be BulkData or BulkRows, but the same type must be used for all put() calls
+        """
+        self._storage = storage
+        self._callback = callback
+        self._max_tweets = max_tweets
+        self._max_delay = max_delay
+        self._max_pending = max_pending
+
+        self._buffer: BulkData | BulkRows | None = None
+        self._buffer_start: float | None = None
+        self._in_flight = 0
+
+        self._has_data = asyncio.Event()
+        self._is_full = asyncio.Event()
+        self._space = asyncio.Condition()
+
+        self._flush_task: Optional[asyncio.Task] = None
+        self._blocked_count = 0
+        self._metrics = StageMetrics()
+
+    def status(self):
+        return BulkWriterStatus(pending=self._buffered(), in_flight=self._in_flight, blocked_count=self._blocked_count,
+                                flush=self._metrics)
+
+    def _buffered(self):
+        if self._buffer is None:
+            return 0
+        return len(self._buffer.tweets)
+
+    def _pending(self):
+        return self._buffered() + self._in_flight
+
+    def _has_space(self):
+        return self._buffered() < self._max_tweets and self._pending() < self._max_pending
+
+    def is_running(self):
+        return self._flush_task is not None and not self._flush_task.done()
+
+    def start(self):
+        if not self.is_running():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def put(self, data: BulkData | BulkRows):
+        """
+        Add data to the next batch, waits if too many tweets are pending
+        """
+        async with self._space:
+            if not self._has_space():
+                self._blocked_count += 1
+                await self._space.wait_for(self._has_space)
+
+        if self._buffer_start is None:
+            self._buffer_start = time.time()
+        if self._buffer is None:
+            self._buffer = data
+        else:
+            self._buffer += data
+
+        self._has_data.set()
+        if self._buffered() >= self._max_tweets:
+            self._is_full.set()
+        self.start()
+
+    async def flush(self):
+        """
+        Save the buffered data right away, also used on stop: the batch being saved by the flush loop is not cancelled
+        """
+        await self._flush_buffer()
+
+    async def _flush_loop(self):
+        while True:
+            await self._has_data.wait()
+            timeout = self._buffer_start + self._max_delay - time.time() if self._buffer_start else 0
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self._is_full.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            await self._flush_buffer()
+
+    async def _flush_buffer(self):
+        data = self._buffer
+        self._buffer = None
+        self._buffer_start = None
+        self._has_data.clear()
+        self._is_full.clear()
+
+        if data is None:
+            return
+        size = len(data.tweets)
+        if not size and not data.rule_matches:
+            return
+
+        self._in_flight += size
+        async with self._space:
+            self._space.notify_all()
+        old = time.time()
+        try:
+            await self._save(data)
+        finally:
+            self._in_flight -= size
+            self._metrics.add(time.time() - old, size)
+            async with self._space:
+                self._space.notify_all()
+
+        logger.debug(f'flushed {size} tweets in {self._metrics.last_time}')
+
+    @handle_error
+    async def _save(self, data: BulkData | BulkRows):
+        try:
+            await self._storage.save_bulk(data, callback=self._callback)
+        except Exception as e:
+            raise StorageError('Unexpected StorageManager bulk_save function error') from e
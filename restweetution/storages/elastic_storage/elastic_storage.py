@@ -1,9 +1,10 @@
 import asyncio
 import logging
-from typing import List
+from typing import List, Dict, Iterable
 
 from elasticsearch import AsyncElasticsearch
 from elasticsearch import helpers
+from pydantic import BaseModel
 
 from restweetution.models.bulk_data import BulkData
 from restweetution.models.rule import Rule
@@ -18,6 +19,7 @@ from restweetution.storages.storage import Storage
 
 es_logger = logging.getLogger('elastic_transport')
 es_logger.setLevel(logging.WARNING)
+logger = logging.getLogger('ElasticStorage')
 
 STORAGE_TYPE = 'elastic'
 STORAGE_PREFIX = 'storage_'
@@ -29,15 +31,34 @@ USER_INDEX = STORAGE_PREFIX + 'user'
 RULE_INDEX = STORAGE_PREFIX + 'rule'
 
 
+# number of failed documents kept in the BulkIndexError
+MAX_REPORTED_ERRORS = 10
+
+
 def CUSTOM_INDEX(key):
     return 'custom_data_' + key
 
 
+class ElasticBulkConfig(BaseModel):
+    """
+    chunk_size: max number of documents of a bulk request, max_chunk_bytes: max size of a bulk request
+    concurrency: number of bulk requests in flight
+    max_retries: retries of the documents rejected with 429, after initial_backoff seconds doubled up to max_backoff
+    """
+    chunk_size: int = 500
+    max_chunk_bytes: int = 10 * 1024 * 1024
+    concurrency: int = 4
+    max_retries: int = 5
+    initial_backoff: float = 2
+    max_backoff: float = 60
+
+
 class ElasticStorage(Storage):
-    def __init__(self, name: str, url: str, user: str, pwd: str, **kwargs):
+    def __init__(self, name: str, url: str, user: str, pwd: str, bulk: ElasticBulkConfig | Dict = None, **kwargs):
         """
         Storage for Elasticsearch stack
         :param name: Name of the storage. Human friendly identifier
+        :param bulk: Optional. Chunks, concurrency and retries of the bulk requests
         """
 
         super().__init__(name=name, **kwargs)
@@ -46,6 +67,9 @@ class ElasticStorage(Storage):
         self.url = url
         self.user = user
         self.pwd = pwd
+        self.bulk_config = ElasticBulkConfig.parse_obj(bulk) if bulk else ElasticBulkConfig()
+        # index -> refresh_interval before begin_export, None for the default
+        self._refresh_intervals: Dict[str, str | None] = {}
 
     def __del__(self):
         asyncio.ensure_future(self.close())
@@ -59,7 +83,8 @@ class ElasticStorage(Storage):
             'name': self.name,
             'url': self.url,
             'user': self.user,
-            'pwd': self.pwd
+            'pwd': self.pwd,
+            'bulk': self.bulk_config.dict()
         }
 
     async def save_bulk(self, data: BulkData):
@@ -72,7 +97,7 @@ class ElasticStorage(Storage):
         actions.extend(self._place_to_bulk_actions(list(data.places.values())))
         actions.extend(self._custom_data_to_bulk_actions(list(data.custom_datas.values())))
 
-        await helpers.async_bulk(self.es, actions)
+        await self._bulk(actions)
 
     # Private
 
@@ -119,9 +144,7 @@ class ElasticStorage(Storage):
         await self.save_tweets([tweet])
 
     async def save_tweets(self, tweets: List[Tweet]):
-        for tweet in tweets:
-            await self.es.index(index="tweet", id=tweet.id, document=tweet.dict())
-        await self.es.indices.refresh(index="tweet")
+        await self._bulk(SaveAction(index="tweet", id_=tweet.id, doc=tweet.dict()) for tweet in tweets)
 
     async def get_tweets(self, ids: List[str] = None, no_ids=None) -> List[TweetResponse]:
         pass
@@ -136,21 +159,41 @@ class ElasticStorage(Storage):
 
         for r in to_save:
             self.rules[r.id] = True
-            await self.es.index(index="rule", id=r.id, document=r.dict())
-        await self.es.indices.refresh(index="rule")
+        await self._bulk(SaveAction(index="rule", id_=r.id, doc=r.dict()) for r in to_save)
 
     async def save_users(self, users: List[User]):
-        for user in users:
-            await self.es.index(index="user", id=user.id, document=user.dict())
-        await self.es.indices.refresh(index="user")
+        await self._bulk(SaveAction(index="user", id_=user.id, doc=user.dict()) for user in users)
 
     async def save_medias(self, medias: List[Media]):
-        for media in medias:
-            await self.es.index(index="media", id=media.media_key, document=media.dict())
-        await self.es.indices.refresh(index="media")
+        await self._bulk(SaveAction(index="media", id_=media.media_key, doc=media.dict()) for media in medias)
 
     async def save_custom_datas(self, datas: List[CustomData]):
-        await helpers.async_bulk(self.es, self._custom_data_to_bulk_actions(datas))
+        await self._bulk(self._custom_data_to_bulk_actions(datas))
+
+    async def begin_export(self, key: str):
+        """
+        Disable the refresh of the export index until end_export, the segments are not rebuilt after each chunk
+        """
+        index = CUSTOM_INDEX(key)
+        try:
+            if not await self.es.indices.exists(index=index):
+                await self.es.indices.create(index=index)
+            settings = await self.es.indices.get_settings(index=index, name='index.refresh_interval')
+            self._refresh_intervals[index] = settings[index]['settings'].get('index', {}).get('refresh_interval')
+            await self.es.indices.put_settings(index=index, settings={'index': {'refresh_interval': '-1'}})
+        except Exception as e:
+            logger.warning(f'Failed to disable the refresh of {index}: {e}')
+
+    async def end_export(self, key: str):
+        """
+        Restore the refresh interval of the export index and refresh it
+        """
+        index = CUSTOM_INDEX(key)
+        if index not in self._refresh_intervals:
+            return
+        interval = self._refresh_intervals.pop(index)
+        await self.es.indices.put_settings(index=index, settings={'index': {'refresh_interval': interval}})
+        await self.es.indices.refresh(index=index)
 
     async def get_custom_datas(self, key: str) -> List[CustomData]:
         docs = await self._get_documents(CUSTOM_INDEX(key))
@@ -175,5 +218,51 @@ class ElasticStorage(Storage):
         for media in medias:
             yield UpdateAction(index=MEDIA_INDEX, id_=media.media_key, doc=media.dict(), delete=delete)
 
-    async def _bulk(self, actions):
-        await helpers.async_bulk(self.es, actions)
+    async def _bulk(self, actions: Iterable[Dict]):
+        """
+        Send the actions with async_streaming_bulk, bulk_config.concurrency streams share the actions
+        so that many bulk requests are in flight. The documents rejected with 429 are retried with a backoff.
+        @raise BulkIndexError: if some documents failed
+        """
+        config = self.bulk_config
+        concurrency = max(config.concurrency, 1)
+        queue = asyncio.Queue(maxsize=config.chunk_size * concurrency)
+        errors = []
+        failed = 0
+
+        async def produce():
+            for action in actions:
+                await queue.put(action)
+            for _ in range(concurrency):
+                await queue.put(None)
+
+        async def queue_actions():
+            while (action := await queue.get()) is not None:
+                yield action
+
+        async def consume():
+            nonlocal failed
+            async for ok, item in helpers.async_streaming_bulk(self.es, queue_actions(),
+                                                               chunk_size=config.chunk_size,
+                                                               max_chunk_bytes=config.max_chunk_bytes,
+                                                               max_retries=config.max_retries,
+                                                               initial_backoff=config.initial_backoff,
+                                                               max_backoff=config.max_backoff,
+                                                               raise_on_error=False,
+                                                               yield_ok=False):
+                failed += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append(item)
+
+        tasks = [asyncio.create_task(produce()), *[asyncio.create_task(consume()) for _ in range(concurrency)]]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # the producer would wait forever on the full queue
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        if errors:
+            raise helpers.BulkIndexError(f'{failed} document(s) failed to index.', errors)
@@ -1,50 +1,165 @@
+import asyncio
+import csv
+import gzip
+import io
 import os
 from collections import defaultdict
-from typing import List, DefaultDict
+from typing import List, DefaultDict, Dict, Optional
 
-import aiofiles
-from aiocsv import AsyncWriter
 from aiopath import AsyncPath
 
 from restweetution.models.storage.custom_data import CustomData
 from restweetution.storages.exporter.exporter import FileExporter
 
 STORAGE_TYPE = 'csv'
+# compression -> file extension
+COMPRESSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+# rows are encoded in memory and written by blocks of about BUFFER_SIZE bytes
+BUFFER_SIZE = 4 * 1024 * 1024
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+class CSVExportSession:
+    """
+    One open file for the whole export of a key
+    The columns are fixed by the first row (the header), the rows are encoded in a buffer and written in a thread
+    with the compression of the file, by blocks of buffer_size bytes
+    ex:
+        session = CSVExportSession(path, compression='gzip')
+        await session.open()
+        await session.write_rows([header, *rows])
+        await session.close()
+    """
+
+    def __init__(self, path: str, compression: str = None, buffer_size: int = BUFFER_SIZE):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f'Unknown compression {compression}, use one of {list(COMPRESSIONS)}')
+        self.path = path
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.columns: Optional[List[str]] = None
+        self.rows_count = 0
+        self._file = None
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, dialect='excel')
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if self.compression == 'gzip':
+            # a new gzip member is appended if the file exists
+            return gzip.open(self.path, 'ab', compresslevel=GZIP_LEVEL)
+        if self.compression == 'zstd':
+            import zstandard
+            return zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1).stream_writer(open(self.path, 'ab'))
+        return open(self.path, 'ab')
+
+    async def open(self):
+        self._file = await asyncio.to_thread(self._open)
+
+    def is_open(self):
+        return self._file is not None
+
+    async def write_rows(self, rows: List[Dict]):
+        """
+        @param rows: dicts, the keys of the first row are the columns, keys starting with _ are ignored
+        """
+        if not rows:
+            return
+        if self.columns is None:
+            self.columns = [k for k in rows[0].keys() if not k.startswith('_')]
+            if not self.columns:
+                raise ValueError(f'The header of {self.path} has no column')
+        columns = self.columns
+        writerow = self._writer.writerow
+        for row in rows:
+            writerow([row.get(c) for c in columns])
+        self.rows_count += len(rows)
+        if self._buffer.tell() >= self.buffer_size:
+            await self._flush()
+
+    async def _flush(self):
+        data = self._buffer.getvalue()
+        if not data:
+            return
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        await asyncio.to_thread(self._file.write, data.encode('utf-8'))
+
+    async def close(self):
+        if not self._file:
+            return
+        try:
+            await self._flush()
+        finally:
+            await asyncio.to_thread(self._file.close)
+            self._file = None
 
 
 class CSVExporter(FileExporter):
     async def clear_key(self, key: str):
-        path = self.get_root() / key
+        path = AsyncPath(self.get_path(key))
         await path.unlink(missing_ok=True)
 
     def get_root(self) -> AsyncPath:
         return self._root
 
-    def __init__(self, root_dir, name='csv', **kwargs):
+    def get_path(self, key: str) -> AsyncPath:
+        return self._root / (key + COMPRESSIONS[self.compression])
+
+    def __init__(self, root_dir, name='csv', compression: str = None, **kwargs):
+        """
+        @param root_dir: folder of the csv files, one file per key
+        @param compression: None, 'gzip' or 'zstd' (requires the zstandard package)
+        """
         super().__init__(name)
+        if compression not in COMPRESSIONS:
+            raise ValueError(f'Unknown compression {compression}, use one of {list(COMPRESSIONS)}')
         self._root = AsyncPath(root_dir)
         self.root_dir = root_dir
+        self.compression = compression
+        self._sessions: Dict[str, CSVExportSession] = {}
 
     def get_config(self):
         return {
             'type': STORAGE_TYPE,
             'name': self.name,
-            'root_dir': self.root_dir
+            'root_dir': self.root_dir,
+            'compression': self.compression
         }
 
+    async def begin_export(self, key: str):
+        """
+        Open the file of the key until end_export, the rows of save_custom_datas are buffered
+        """
+        if key in self._sessions:
+            return
+        session = CSVExportSession(str(self.get_path(key)), compression=self.compression)
+        await session.open()
+        self._sessions[key] = session
+
+    async def end_export(self, key: str):
+        session = self._sessions.pop(key, None)
+        if session:
+            await session.close()
+
     async def save_custom_datas(self, datas: List[CustomData]):
         key_group: DefaultDict[str, List[CustomData]] = defaultdict(list)
         for data in datas:
             key_group[data.key].append(data)
 
         for key in key_group:
-            rows = key_group[key]
-            filename = key
-            await self._root.mkdir(parents=True, exist_ok=True)
-            path = self._root / filename
-            async with aiofiles.open(path, mode="a", encoding="utf-8", newline="") as afp:
-                writer = AsyncWriter(afp, dialect="excel")
-                await writer.writerows([[row.data[key] for key in row.data.keys() if not key.startswith('_')] for row in rows])
+            rows = [row.data for row in key_group[key]]
+            if key in self._sessions:
+                await self._sessions[key].write_rows(rows)
+                continue
+            # without begin_export the rows are appended with a short session
+            session = CSVExportSession(str(self.get_path(key)), compression=self.compression)
+            await session.open()
+            try:
+                await session.write_rows(rows)
+            finally:
+                await session.close()
 
     @staticmethod
     def uniquify(path):
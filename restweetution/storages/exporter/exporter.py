@@ -13,10 +13,25 @@ class Exporter(ABC):
     async def save_custom_datas(self, datas: List[CustomData]):
         raise NotImplementedError('save_custom_datas')
 
+    async def begin_export(self, key: str):
+        """
+        Called before the first save_custom_datas of an export, ex: to disable the index refresh
+        """
+        pass
+
+    async def end_export(self, key: str):
+        """
+        Called after the last save_custom_datas of an export, even if it failed
+        """
+        pass
+
 
 class FileExporter(Exporter, ABC):
     def get_root(self) -> AsyncPath:
         raise NotImplementedError('get_root is not implemented')
 
+    def get_path(self, key: str) -> AsyncPath:
+        return self.get_root() / key
+
     async def clear_key(self, key: str):
         raise NotImplementedError('clear key is not implemented')
@@ -0,0 +1,209 @@
+import asyncio
+import os
+from collections import defaultdict
+from typing import List, DefaultDict, Dict, Optional, Any
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from aiopath import AsyncPath
+
+from restweetution.data_view import tweet_view2 as tv
+from restweetution.data_view.fields import MediaFields as MField
+from restweetution.data_view.fields import TweetFields as TField
+from restweetution.models.storage.custom_data import CustomData
+from restweetution.models.view_types import ViewType
+from restweetution.storages.exporter.exporter import FileExporter
+
+STORAGE_TYPE = 'parquet'
+COMPRESSIONS = ['zstd', 'snappy', 'gzip', 'none']
+# rows of a parquet row group, the chunks are buffered until a row group is full
+ROW_GROUP_SIZE = 100000
+
+STRINGS = pa.list_(pa.string())
+
+# arrow type of the view fields, the fields not listed are strings
+TWEET_VIEW_TYPES: Dict[str, pa.DataType] = {
+    tv.CREATED_AT: pa.timestamp('us', tz='UTC'),
+    tv.MEDIA_KEYS: STRINGS,
+    tv.MEDIA_SHA1S: STRINGS,
+    tv.MEDIA_FORMAT: STRINGS,
+    tv.MEDIA_TYPES: STRINGS,
+    tv.MEDIA_FILES: STRINGS,
+    tv.POLL_IDS: STRINGS,
+    tv.CONTEXT_DOMAINS: STRINGS,
+    tv.CONTEXT_ENTITIES: STRINGS,
+    tv.ANNOTATIONS: STRINGS,
+    tv.CASHTAGS: STRINGS,
+    tv.HASHTAGS: STRINGS,
+    tv.MENTIONS: STRINGS,
+    tv.URLS: STRINGS,
+    tv.COORDINATES: pa.list_(pa.float64()),
+    tv.POSSIBLY_SENSITIVE: pa.bool_(),
+    tv.RETWEET_COUNT: pa.int64(),
+    tv.REPLY_COUNT: pa.int64(),
+    tv.LIKE_COUNT: pa.int64(),
+    tv.QUOTE_COUNT: pa.int64(),
+    tv.REFERENCED_TWEETS_TYPES: STRINGS,
+    tv.REFERENCED_TWEETS_IDS: STRINGS,
+    tv.REFERENCED_TWEETS_AUTHOR_IDS: STRINGS,
+    tv.REFERENCED_TWEETS_AUTHOR_USERNAMES: STRINGS,
+    tv.WITHHELD_COPYRIGHT: pa.bool_(),
+    tv.WITHHELD_COUNTRY_CODES: STRINGS,
+    tv.RULE_TAGS: STRINGS,
+    tv.DIRECT_HIT: pa.bool_(),
+}
+
+MEDIA_VIEW_TYPES: Dict[str, pa.DataType] = {
+    MField.MEDIA_KEY: pa.string(),
+    TField.ID: STRINGS,
+    TField.TEXT: STRINGS,
+    TField.AUTHOR_ID: STRINGS,
+}
+
+VIEW_TYPES = {
+    ViewType.TWEET: TWEET_VIEW_TYPES,
+    ViewType.MEDIA: MEDIA_VIEW_TYPES,
+}
+
+
+def _to_str(value: Any):
+    if value is None or isinstance(value, str):
+        return value
+    return str(value)
+
+
+def to_arrow_array(values: List[Any], type_: pa.DataType) -> pa.Array:
+    """
+    Build a column, the values of the string and list of strings columns are converted with str
+    """
+    if type_ == pa.string():
+        values = [_to_str(v) for v in values]
+    elif type_ == STRINGS:
+        values = [[_to_str(v) for v in lst] if lst is not None else None for lst in values]
+    return pa.array(values, type=type_)
+
+
+class ParquetExportSession:
+    """
+    One parquet file written by row groups
+    The first row is the header, its keys are the columns of the file (like the CSV export)
+    Each chunk of rows becomes an arrow RecordBatch, the batches are written as one row group
+    once row_group_size rows are buffered, in a thread
+    """
+
+    def __init__(self, path: str, types: Dict[str, pa.DataType] = None, compression: str = 'zstd',
+                 row_group_size: int = ROW_GROUP_SIZE):
+        self.path = path
+        self.types = types if types else {}
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.schema: Optional[pa.Schema] = None
+        self.rows_count = 0
+        self._writer: Optional[pq.ParquetWriter] = None
+        self._batches: List[pa.RecordBatch] = []
+        self._buffered = 0
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        return pq.ParquetWriter(self.path, self.schema, compression=self.compression)
+
+    async def write_rows(self, rows: List[Dict]):
+        """
+        @param rows: dicts, the first row of the session is the header, keys starting with _ are ignored
+        """
+        if not rows:
+            return
+        if self.schema is None:
+            columns = [k for k in rows[0].keys() if not k.startswith('_')]
+            if not columns:
+                raise ValueError(f'The header of {self.path} has no column')
+            self.schema = pa.schema([pa.field(c, self.types.get(c, pa.string())) for c in columns])
+            self._writer = await asyncio.to_thread(self._open)
+            rows = rows[1:]
+            if not rows:
+                return
+
+        arrays = [to_arrow_array([row.get(f.name) for row in rows], f.type) for f in self.schema]
+        self._batches.append(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        self._buffered += len(rows)
+        self.rows_count += len(rows)
+        if self._buffered >= self.row_group_size:
+            await self._flush()
+
+    async def _flush(self):
+        if not self._batches:
+            return
+        table = pa.Table.from_batches(self._batches, schema=self.schema)
+        self._batches, self._buffered = [], 0
+        await asyncio.to_thread(self._writer.write_table, table, row_group_size=self.row_group_size)
+
+    async def close(self):
+        if not self._writer:
+            return
+        try:
+            await self._flush()
+        finally:
+            await asyncio.to_thread(self._writer.close)
+            self._writer = None
+
+
+class ParquetExporter(FileExporter):
+    def __init__(self, root_dir, name='parquet', view_type: ViewType = ViewType.TWEET, compression: str = 'zstd',
+                 row_group_size: int = ROW_GROUP_SIZE, **kwargs):
+        """
+        Export of the views in parquet files, one file per key, the list fields are list columns
+        @param root_dir: folder of the files
+        @param view_type: exported view, selects the types of the columns
+        @param compression: one of COMPRESSIONS
+        @param row_group_size: number of rows of a row group
+        """
+        super().__init__(name)
+        if compression not in COMPRESSIONS:
+            raise ValueError(f'Unknown compression {compression}, use one of {COMPRESSIONS}')
+        self._root = AsyncPath(root_dir)
+        self.root_dir = root_dir
+        self.view_type = view_type
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self._sessions: Dict[str, ParquetExportSession] = {}
+
+    def get_root(self) -> AsyncPath:
+        return self._root
+
+    def get_config(self):
+        return {
+            'type': STORAGE_TYPE,
+            'name': self.name,
+            'root_dir': self.root_dir,
+            'view_type': self.view_type.value,
+            'compression': self.compression,
+            'row_group_size': self.row_group_size
+        }
+
+    async def clear_key(self, key: str):
+        await self.get_path(key).unlink(missing_ok=True)
+
+    async def begin_export(self, key: str):
+        if key in self._sessions:
+            return
+        self._sessions[key] = ParquetExportSession(str(self.get_path(key)), types=VIEW_TYPES.get(self.view_type),
+                                                   compression=self.compression,
+                                                   row_group_size=self.row_group_size)
+
+    async def end_export(self, key: str):
+        session = self._sessions.pop(key, None)
+        if session:
+            await session.close()
+
+    async def save_custom_datas(self, datas: List[CustomData]):
+        """
+        Must be called between begin_export and end_export, a parquet file can't be appended
+        """
+        key_group: DefaultDict[str, List[CustomData]] = defaultdict(list)
+        for data in datas:
+            key_group[data.key].append(data)
+
+        for key in key_group:
+            if key not in self._sessions:
+                raise ValueError(f'No export session for {key}, call begin_export first')
+            await self._sessions[key].write_rows([row.data for row in key_group[key]])
@@ -0,0 +1,197 @@
+"""
+Compact row representation of the data sent by the Twitter API
+Raw JSON objects are converted straight into tuples in the column order of the tables,
+without building the pydantic models. Used by the stream to skip the model round trip before save_bulk
+"""
+import datetime
+from typing import Dict, List, Tuple, Iterable
+
+from sqlalchemy import Table, TIMESTAMP
+from sqlalchemy.dialects.postgresql import JSONB
+
+from restweetution.models.bulk_data import BulkData
+from restweetution.models.rule import RuleMatch
+from restweetution.models.twitter import Tweet, Media, User, Poll, Place
+from restweetution.storages.postgres_jsonb_storage.models import TWEET, MEDIA, USER, POLL, PLACE
+from restweetution.storages.postgres_jsonb_storage.utils import primary_keys
+
+
+def parse_datetime(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    return datetime.datetime.fromisoformat(value)
+
+
+class RowLayout:
+    """
+    Column order of a table, the row tuples follow this order
+    """
+    __slots__ = ('table', 'model', 'columns', 'key', 'key_index', 'timestamp_indexes', 'json_indexes')
+
+    def __init__(self, table: Table, model):
+        self.table = table
+        self.model = model
+        self.columns: Tuple[str, ...] = tuple(c.name for c in table.columns)
+        self.key = primary_keys(table)[0]
+        self.key_index = self.columns.index(self.key)
+        self.timestamp_indexes = [i for i, c in enumerate(table.columns) if isinstance(c.type, TIMESTAMP)]
+        self.json_indexes = [i for i, c in enumerate(table.columns) if isinstance(c.type, JSONB)]
+
+    def to_row(self, data: Dict) -> tuple:
+        row = [data.get(c) for c in self.columns]
+        for i in self.timestamp_indexes:
+            if row[i] is not None:
+                row[i] = parse_datetime(row[i])
+        return tuple(row)
+
+
+LAYOUTS: Dict[str, RowLayout] = {
+    'tweets': RowLayout(TWEET, Tweet),
+    'medias': RowLayout(MEDIA, Media),
+    'users': RowLayout(USER, User),
+    'polls': RowLayout(POLL, Poll),
+    'places': RowLayout(PLACE, Place),
+}
+
+# keys of the includes object of the Twitter API
+INCLUDES_KEYS = {
+    'tweets': 'tweets',
+    'media': 'medias',
+    'users': 'users',
+    'polls': 'polls',
+    'places': 'places',
+}
+
+TWEET_CREATED_AT_INDEX = LAYOUTS['tweets'].columns.index('created_at')
+TWEET_ATTACHMENTS_INDEX = LAYOUTS['tweets'].columns.index('attachments')
+
+
+class TableRows:
+    """
+    Rows of one table indexed by primary key
+    fields keeps the union of the fields present in the raw objects, like the fields set of the pydantic models
+    only those fields are updated on conflict
+    The layout is referenced by name to keep the pickled rows small when they are sent from a process pool
+    """
+    __slots__ = ('name', 'rows', 'fields')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.rows: Dict[str, tuple] = {}
+        self.fields = set()
+
+    @property
+    def layout(self) -> RowLayout:
+        return LAYOUTS[self.name]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __bool__(self):
+        return bool(self.rows)
+
+    def add(self, data: Dict):
+        layout = LAYOUTS[self.name]
+        row = layout.to_row(data)
+        self.rows[row[layout.key_index]] = row
+        self.fields.update(data.keys())
+
+    def update(self, other):
+        self.rows.update(other.rows)
+        self.fields.update(other.fields)
+
+    def get_fields(self):
+        return [c for c in self.layout.columns if c in self.fields]
+
+    def get_dicts(self) -> List[Dict]:
+        columns = self.layout.columns
+        return [dict(zip(columns, row)) for row in self.rows.values()]
+
+    def get_models(self):
+        model = self.layout.model
+        fields = self.fields
+        return [model(**{k: v for k, v in d.items() if k in fields}) for d in self.get_dicts()]
+
+
+class BulkRows:
+    """
+    Rows equivalent of BulkData, can be given to PostgresJSONBStorage.save_bulk
+    rule_matches maps (rule_id, tweet_id) to (collected_at, direct_hit)
+    """
+
+    def __init__(self):
+        self.tables: Dict[str, TableRows] = {name: TableRows(name) for name in LAYOUTS}
+        self.rule_matches: Dict[Tuple[int, str], Tuple[datetime.datetime, bool]] = {}
+        self.timestamp: datetime.datetime | None = None
+
+    @property
+    def tweets(self):
+        return self.tables['tweets'].rows
+
+    def __add__(self, other):
+        for name, table_rows in other.tables.items():
+            if table_rows:
+                self.tables[name].update(table_rows)
+        for key, match in other.rule_matches.items():
+            # an include match must not hide a direct hit of the same rule
+            if key in self.rule_matches and self.rule_matches[key][1] and not match[1]:
+                continue
+            self.rule_matches[key] = match
+        if other.timestamp:
+            self.timestamp = other.timestamp
+        return self
+
+    def add_response(self, data: Dict):
+        """
+        Add the tweet and the includes of a raw tweet response
+        @param data: dict with data, includes, etc.. keys like sent by the Twitter API
+        """
+        self.tables['tweets'].add(data['data'])
+        includes = data.get('includes')
+        if includes:
+            for key, name in INCLUDES_KEYS.items():
+                for item in includes.get(key, ()):
+                    self.tables[name].add(item)
+
+    def add_rule_matches(self, rule_ids: Iterable[int], tweet_ids: Iterable[str], collected_at: datetime.datetime,
+                         direct_hit=False):
+        for rule_id in rule_ids:
+            for tweet_id in tweet_ids:
+                key = (rule_id, tweet_id)
+                if not direct_hit and key in self.rule_matches:
+                    continue
+                self.rule_matches[key] = (collected_at, direct_hit)
+
+    def get_tweet_created_at(self, tweet_id: str):
+        row = self.tweets.get(tweet_id)
+        if not row:
+            return None
+        return row[TWEET_CREATED_AT_INDEX]
+
+    def get_tweet_media(self) -> List[Tuple[str, str]]:
+        """
+        @return: (tweet_id, media_key) pairs of the tweets attachments
+        """
+        return [
+            (tweet_id, media_key)
+            for tweet_id, row in self.tweets.items() if row[TWEET_ATTACHMENTS_INDEX]
+            for media_key in row[TWEET_ATTACHMENTS_INDEX].get('media_keys') or ()
+        ]
+
+    def get_rule_match_dicts(self) -> List[Dict]:
+        return [
+            dict(rule_id=rule_id, tweet_id=tweet_id, collected_at=collected_at, direct_hit=direct_hit)
+            for (rule_id, tweet_id), (collected_at, direct_hit) in self.rule_matches.items()
+        ]
+
+    def to_bulk_data(self) -> BulkData:
+        """
+        Build the pydantic models, only needed when the data is used after the save (downloads, dashboards..)
+        """
+        bulk_data = BulkData()
+        bulk_data.add(**{name: table_rows.get_models() for name, table_rows in self.tables.items() if table_rows})
+        bulk_data.add_rule_matches([RuleMatch(**m) for m in self.get_rule_match_dicts()])
+        bulk_data.timestamp = self.timestamp
+        return bulk_data
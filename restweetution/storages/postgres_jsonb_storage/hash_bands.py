@@ -0,0 +1,44 @@
+"""
+Storage of the 64 bits perceptual hashes of restweetution.downloaders.media_hash, without its image dependencies
+The hashes are stored as signed 64 bits integers (postgres BIGINT), see to_signed / to_unsigned.
+Multi-index hashing: the hash is split in HASH_BANDS bands of BAND_BITS bits indexed separately. Two hashes within
+the distance r have at least one band within r // HASH_BANDS (pigeonhole), so the candidates of a search are the
+rows with one band among the variants of the query band.
+"""
+import itertools
+from typing import List
+
+HASH_BITS = 64
+HASH_BANDS = 4
+BAND_BITS = HASH_BITS // HASH_BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+
+
+def to_signed(value: int) -> int:
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def to_unsigned(value: int) -> int:
+    return value + (1 << HASH_BITS) if value < 0 else value
+
+
+def hash_bands(value: int) -> List[int]:
+    """
+    @param value: unsigned hash
+    @return: HASH_BANDS integers of BAND_BITS bits, most significant first
+    """
+    return [(value >> (BAND_BITS * (HASH_BANDS - 1 - i))) & BAND_MASK for i in range(HASH_BANDS)]
+
+
+def band_variants(band: int, radius: int) -> List[int]:
+    """
+    @return: the band values within the hamming distance radius of band
+    """
+    variants = [band]
+    for r in range(1, radius + 1):
+        for bits in itertools.combinations(range(BAND_BITS), r):
+            variant = band
+            for bit in bits:
+                variant ^= 1 << bit
+            variants.append(variant)
+    return variants
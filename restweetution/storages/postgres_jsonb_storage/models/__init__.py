@@ -10,3 +10,8 @@ from .update import *
 from .restweet_user import *
 from .data import *
 from .downloaded_media import *
+from .tweet_media import *
+from .rule_day_count import *
+from .download_task import *
+from .media_hash import *
+from .partitioned import *
@@ -0,0 +1,22 @@
+from sqlalchemy import Column, Table, String, Integer, TIMESTAMP, Boolean, Index, func
+
+from restweetution.storages.postgres_jsonb_storage.models import meta_data
+
+# durable media download queue, a row is deleted when its DownloadedMedia is saved
+# claimed_at and claimed_by (worker id of the process) are set while a worker downloads the media,
+# next_attempt_at delays the retries
+DOWNLOAD_TASK = Table(
+    "download_task",
+    meta_data,
+    Column("media_key", String, primary_key=True),
+    Column("queue", String, nullable=False),
+    Column("priority", Integer, nullable=False, default=0),
+    Column("attempts", Integer, nullable=False, default=0),
+    Column("next_attempt_at", TIMESTAMP(timezone=True), nullable=False, server_default=func.now()),
+    Column("claimed_at", TIMESTAMP(timezone=True)),
+    Column("claimed_by", String),
+    Column("failed", Boolean, nullable=False, default=False),
+    Column("last_error", String),
+    Column("created_at", TIMESTAMP(timezone=True), nullable=False, server_default=func.now()),
+    Index("ix_download_task_claim", "queue", "priority", "next_attempt_at"),
+)
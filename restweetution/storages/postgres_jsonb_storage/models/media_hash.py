@@ -0,0 +1,21 @@
+from sqlalchemy import Column, Table, String, Integer, BigInteger, Index
+
+from restweetution.storages.postgres_jsonb_storage.models import meta_data
+
+# perceptual hashes of the downloaded photos, by sha1 of the file
+# phash_0..3 are the 16 bits bands of phash, each indexed for the multi-index hamming search
+MEDIA_HASH = Table(
+    "media_hash",
+    meta_data,
+    Column("sha1", String, primary_key=True),
+    Column("ahash", BigInteger),
+    Column("phash", BigInteger),
+    Column("phash_0", Integer),
+    Column("phash_1", Integer),
+    Column("phash_2", Integer),
+    Column("phash_3", Integer),
+    Index("ix_media_hash_phash_0", "phash_0"),
+    Index("ix_media_hash_phash_1", "phash_1"),
+    Index("ix_media_hash_phash_2", "phash_2"),
+    Index("ix_media_hash_phash_3", "phash_3"),
+)
@@ -0,0 +1,56 @@
+from sqlalchemy import MetaData, Table, Column, PrimaryKeyConstraint, ForeignKeyConstraint, Index
+
+from restweetution.storages.postgres_jsonb_storage.models.meta_data import meta_data
+
+# tables range partitioned by month in a partitioned database, with their partition key
+# collected_tweet.tweet_created_at is the created_at of the tweet, a tweet and its matches are in the same month
+PARTITION_KEYS = {
+    'tweet': 'created_at',
+    'collected_tweet': 'tweet_created_at'
+}
+
+# a foreign key to a partitioned table must include the partition key
+PARTITIONED_FOREIGN_KEYS = {
+    'collected_tweet': [(['tweet_id', 'tweet_created_at'], ['tweet.id', 'tweet.created_at'])]
+}
+
+
+def partitioned_meta_data() -> MetaData:
+    """
+    Copy of the models where the tables of PARTITION_KEYS are partitioned by range on their key
+    The partition key is added to their primary key and is NOT NULL
+    The other foreign keys to a partitioned table are dropped (tweet_update.tweet_id), like tweet_media.tweet_id
+    """
+    meta = MetaData()
+    for table in meta_data.sorted_tables:
+        if table.name in PARTITION_KEYS or _references_partitioned(table):
+            _partitioned_copy(table, meta)
+        else:
+            table.to_metadata(meta)
+    return meta
+
+
+def _references_partitioned(table: Table):
+    return any(fk.column.table.name in PARTITION_KEYS for fk in table.foreign_keys)
+
+
+def _partitioned_copy(table: Table, meta: MetaData) -> Table:
+    key = PARTITION_KEYS.get(table.name)
+    columns = [Column(c.name, c.type, nullable=c.nullable and c.name != key) for c in table.columns]
+
+    primary_key = [c.name for c in table.primary_key]
+    if key:
+        primary_key.append(key)
+
+    foreign_keys = [
+        ForeignKeyConstraint([fk.parent.name for fk in constraint.elements],
+                             [fk.target_fullname for fk in constraint.elements])
+        for constraint in table.foreign_key_constraints
+        if constraint.referred_table.name not in PARTITION_KEYS
+    ]
+    foreign_keys += [ForeignKeyConstraint(*fk) for fk in PARTITIONED_FOREIGN_KEYS.get(table.name, [])]
+
+    indexes = [Index(i.name, *[c.name for c in i.columns], unique=i.unique, **i.dialect_kwargs) for i in table.indexes]
+
+    kwargs = {'postgresql_partition_by': f'RANGE ({key})'} if key else {}
+    return Table(table.name, meta, *columns, PrimaryKeyConstraint(*primary_key), *foreign_keys, *indexes, **kwargs)
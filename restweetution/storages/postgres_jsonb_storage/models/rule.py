@@ -1,6 +1,6 @@
 import datetime
 
-from sqlalchemy import Column, Table, String, TIMESTAMP, Boolean, ForeignKey, Integer
+from sqlalchemy import Column, Table, String, TIMESTAMP, Boolean, ForeignKey, Integer, Index, text
 
 from restweetution.storages.postgres_jsonb_storage.models import meta_data
 
@@ -19,8 +19,15 @@ RULE_MATCH = Table(
     meta_data,
     Column("rule_id", ForeignKey("rule.id"), primary_key=True),
     Column("tweet_id", ForeignKey("tweet.id"), primary_key=True),
-    Column("tweet_created_at", nullable=False),
+    Column("tweet_created_at", TIMESTAMP(timezone=True), nullable=False),
 
     Column("collected_at", TIMESTAMP(timezone=True), nullable=False),
-    Column("direct_hit", Boolean)
+    Column("direct_hit", Boolean),
+    # rule matches of a tweet, the primary key starts with rule_id
+    Index("ix_collected_tweet_tweet_id", "tweet_id"),
+    # tweets of a rule in a date range, filtered on the denormalized tweet_created_at without joining tweet
+    Index("ix_collected_tweet_rule_date", "rule_id", "tweet_created_at", "tweet_id"),
+    # same for the direct hits only, the queries filter with direct_hit IS true
+    Index("ix_collected_tweet_rule_date_direct_hit", "rule_id", "tweet_created_at", "tweet_id",
+          postgresql_where=text("direct_hit IS true"))
 )
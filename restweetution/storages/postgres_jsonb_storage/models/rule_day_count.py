@@ -0,0 +1,24 @@
+from sqlalchemy import Column, Table, Integer, Date, Boolean, BigInteger
+
+from restweetution.storages.postgres_jsonb_storage.models import meta_data
+
+# number of collected_tweet rows per rule and UTC day of tweet_created_at
+# has_media: the tweet has tweet_media rows, the counts move when a tweet gets its first media
+# maintained by save_bulk in the same transaction as the rule matches
+RULE_DAY_COUNT = Table(
+    "rule_day_count",
+    meta_data,
+    Column("rule_id", Integer, primary_key=True),
+    Column("day", Date, primary_key=True),
+    Column("direct_hit", Boolean, primary_key=True),
+    Column("has_media", Boolean, primary_key=True),
+    Column("n", BigInteger, nullable=False, default=0),
+)
+
+# rules whose rule_day_count rows are complete: created without matches or rebuilt by rebuild_rule_day_count
+# the matches of the other rules were saved before the aggregate existed, they are counted on collected_tweet
+RULE_DAY_COUNT_COMPLETE = Table(
+    "rule_day_count_complete",
+    meta_data,
+    Column("rule_id", Integer, primary_key=True),
+)
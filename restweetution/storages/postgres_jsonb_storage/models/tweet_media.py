@@ -0,0 +1,12 @@
+from sqlalchemy import Column, Table, String
+
+from restweetution.storages.postgres_jsonb_storage.models import meta_data
+
+# normalized tweet.attachments.media_keys, filled by save_bulk
+# no foreign keys: medias can be saved after the tweets referencing them
+TWEET_MEDIA = Table(
+    "tweet_media",
+    meta_data,
+    Column("tweet_id", String, primary_key=True),
+    Column("media_key", String, primary_key=True, index=True),
+)
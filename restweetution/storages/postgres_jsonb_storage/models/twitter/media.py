@@ -8,7 +8,7 @@ MEDIA = Table(
     meta_data,
     Column("media_key", String, primary_key=True),
     Column("type", String),
-    Column("url", String),
+    Column("url", String, index=True),
     Column("preview_image_url", String),
     Column("duration_ms", Integer),
     Column("height", Integer),
@@ -1,5 +1,5 @@
 from sqlalchemy import Boolean
-from sqlalchemy import Table, Column, String, TIMESTAMP
+from sqlalchemy import Table, Column, String, TIMESTAMP, Index
 from sqlalchemy.dialects.postgresql import JSONB
 
 from restweetution.storages.postgres_jsonb_storage.models.meta_data import meta_data
@@ -10,7 +10,7 @@ TWEET = Table(
     Column("id", String, primary_key=True),
     Column('text', String),
     Column('author_id', String),
-    Column('created_at', TIMESTAMP(timezone=True), index=True),
+    Column('created_at', TIMESTAMP(timezone=True)),
     Column('conversation_id', String),
     Column("in_reply_to_user_id", String),
     Column("lang", String),
@@ -30,5 +30,8 @@ TWEET = Table(
     Column("organic_metrics", JSONB),
     Column("promoted_metrics", JSONB),
 
-    Column("withheld", JSONB)
+    Column("withheld", JSONB),
+
+    # keyset pagination on (created_at, id), also serves the created_at ranges
+    Index("ix_tweet_created_at_id", "created_at", "id")
 )
\ No newline at end of file
@@ -1,38 +1,63 @@
-import asyncio
 import datetime
 import logging
 import time
-from typing import List, TypeVar, Callable, Dict
+from collections import Counter
+from typing import List, TypeVar, Callable, Dict, Tuple, Iterable, Set
 
 from pydantic import BaseModel
-from sqlalchemy import update, bindparam, Table, delete, join, func, true
-from sqlalchemy.dialects.postgresql import insert, array
+from sqlalchemy import update, bindparam, Table, delete, join, func, true, text, table as light_table, column, or_, \
+    and_, distinct, case, exists
+from sqlalchemy.dialects.postgresql import insert, JSONB
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.future import select
+from sqlalchemy.schema import CreateIndex
 
+from restweetution import serializer
 from restweetution.models.bulk_data import BulkData
 from restweetution.models.config.user_config import UserConfig
 from restweetution.models.extended_types import ExtendedMedia
 from restweetution.models.linked.linked_bulk_data import LinkedBulkData
-from restweetution.models.rule import Rule, RuleMatch
+from restweetution.models.rule import Rule, RuleMatch, CompactRuleMatch
 from restweetution.models.storage.custom_data import CustomData
 from restweetution.models.storage.downloaded_media import DownloadedMedia
 from restweetution.models.storage.error import ErrorModel
 from restweetution.models.storage.queries import CollectionQuery, TweetFilter, ViewQuery
 from restweetution.models.twitter import Tweet, Media, User, Poll, Place
 from restweetution.models.view_types import ViewType
+from restweetution.storages.postgres_jsonb_storage.bulk_rows import BulkRows, TableRows
+from restweetution.storages.postgres_jsonb_storage.hash_bands import HASH_BANDS, hash_bands, band_variants, \
+    to_signed, to_unsigned
 from restweetution.storages.postgres_jsonb_storage.models import RULE, ERROR, meta_data, RESTWEET_USER, TWEET, MEDIA, \
-    USER, POLL, PLACE, RULE_MATCH, DOWNLOADED_MEDIA
+    USER, POLL, PLACE, RULE_MATCH, DOWNLOADED_MEDIA, TWEET_MEDIA, RULE_DAY_COUNT, DOWNLOAD_TASK, \
+    MEDIA_HASH, partitioned_meta_data, PARTITION_KEYS, RULE_DAY_COUNT_COMPLETE
 from restweetution.storages.postgres_jsonb_storage.models.data import DATA
 from restweetution.storages.postgres_jsonb_storage.subqueries import media_keys_stmt, media_keys_with_tweet_id_stmt, \
     stmt_query_count_tweets, stmt_tweet_media_ids, stmt_query_tweets, stmt_query_medias, stmt_query_count_medias, \
-    stmt_get_rule_matches, stmt_query_tweets_sample
+    stmt_get_rule_matches, stmt_query_tweets_sample, tweet_keyset_columns, stmt_tweet_ids_with_media_keys, \
+    stmt_query_count_rule_days, stmt_rebuild_rule_day_count, stmt_find_downloaded_medias, stmt_claim_download_tasks, \
+    stmt_unhashed_photos, stmt_find_similar_hashes, stmt_stream_tweets, stmt_stream_medias, tweet_date_column, \
+    stmt_index_validity, tweet_match_join, stmt_partition_keys, stmt_create_partition, stmt_referencing_foreign_keys, \
+    stmt_table_indexes, partition_name, stmt_lock_rule_days
 from restweetution.storages.postgres_jsonb_storage.utils import res_to_dicts, update_dict, where_in_builder, \
-    select_builder, primary_keys, offset_limit, date_from_to, select_join_builder
+    select_builder, primary_keys, offset_limit, date_from_to, select_join_builder, keyset, encode_cursor, to_utc, \
+    utc_day, day_start, server_cursor, month_start, next_month, in_array
 from restweetution.storages.system_storage import SystemStorage
-from restweetution.utils import clean_dict, safe_dict, fire_and_forget
+from restweetution.utils import clean_dict, safe_dict, fire_and_forget, safe_json
 
 STORAGE_TYPE = 'postgres'
+# save_bulk modes, 'insert' uses INSERT .. ON CONFLICT, 'copy' uses COPY into a staging table then merges
+SAVE_MODES = ['insert', 'copy']
+# above this number of rows for one table, save_bulk uses the copy mode by default
+COPY_ROW_THRESHOLD = 2000
+# a claimed download task not acked after this delay is claimed again
+DOWNLOAD_CLAIM_LEASE = datetime.timedelta(hours=1)
+# rows fetched by one round trip of the cursor of the export streams
+STREAM_FETCH_SIZE = 1000
+# partition_tables renames the tables to migrate with this suffix, until their rows are copied
+UNPARTITIONED_SUFFIX = '_unpartitioned'
+# indexes of the previous versions of the models, dropped by ensure_indexes
+# ix_tweet_created_at is a prefix of ix_tweet_created_at_id
+OBSOLETE_INDEXES = ['ix_tweet_created_at']
 logger = logging.getLogger('PostgresJSONBStorage')
 
 
@@ -44,41 +69,226 @@ class PostgresJSONBStorage(SystemStorage):
         super().__init__(name)
 
         self._url = url
-        self._engine = create_async_engine(url, echo=False)
-        self._count_estimate_task: asyncio.Task | None = None
-        self._count_estimate_continue_flag = False
-
-    def _count_estimate_is_running(self):
-        return self._count_estimate_task and not self._count_estimate_task.done()
-
-    def _count_estimate_task_start(self):
-        self._count_estimate_continue_flag = True
-        if self._count_estimate_is_running():
-            return
-        self._count_estimate_task = asyncio.create_task(self._count_estimate_task_routine())
-
-    async def _count_estimate_task_routine(self):
-        while self._count_estimate_continue_flag:
-            print('start loop')
-            self._count_estimate_continue_flag = False
-            elapsed_time = await self.update_count_estimate()
-            sleep_time = max(10, int(elapsed_time) * 5)
-            print(f'continue: {self._count_estimate_continue_flag}')
-            if not self._count_estimate_continue_flag:
-                return
-            await asyncio.sleep(sleep_time)
+        self._engine = create_async_engine(url, echo=False, json_serializer=serializer.dumps,
+                                           json_deserializer=serializer.loads)
+        # partitioned tables and their partition key, read from the database by get_partition_keys
+        self._partition_keys: Dict[str, str] | None = None
+        # months whose partitions exist for all the partitioned tables
+        self._partition_months: Set[datetime.date] = set()
 
     def get_engine(self):
         return self._engine
 
-    async def reset_database(self):
+    async def reset_database(self, partitioned=False):
         async with self._engine.begin() as conn:
             await conn.run_sync(meta_data.drop_all)
-            await conn.run_sync(meta_data.create_all)
+            await conn.run_sync((partitioned_meta_data() if partitioned else meta_data).create_all)
+        self._reset_partition_cache()
+
+    async def build_tables(self, partitioned=False):
+        """
+        @param partitioned: create tweet and collected_tweet range partitioned by month on the tweet date,
+        save_bulk creates the partitions. Applies to new tables only, use partition_tables for an existing database
+        """
+        async with self._engine.begin() as conn:
+            await conn.run_sync((partitioned_meta_data() if partitioned else meta_data).create_all)
+            # create_all skips existing tables, indexes added later to the models are created here
+            await conn.run_sync(self._create_missing_indexes)
+        self._reset_partition_cache()
+        if partitioned and not await self.get_partition_keys():
+            logger.warning('The tables already exist and are not partitioned, run scripts/partition_tables.py')
+
+    @staticmethod
+    def _create_missing_indexes(conn):
+        for table in meta_data.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+    async def ensure_indexes(self, concurrently=True) -> List[str]:
+        """
+        Create the indexes of the models missing from the database, for a live database where build_tables
+        would lock the writes of the collector during the index builds
+        The missing tables are created first with their indexes, the existing tables are not locked
+        The invalid indexes left by an interrupted concurrent build are dropped and built again,
+        the OBSOLETE_INDEXES are dropped
+        @param concurrently: CREATE INDEX CONCURRENTLY, slower but the tables stay writable. Not supported by postgres
+        on the partitioned tables
+        @return: names of the created indexes
+        """
+        partition_keys = await self.get_partition_keys()
+        async with self._engine.begin() as conn:
+            await conn.run_sync((partitioned_meta_data() if partition_keys else meta_data).create_all)
+        async with self._engine.connect() as conn:
+            # CREATE INDEX CONCURRENTLY can't run inside a transaction
+            conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+            res = await conn.execute(stmt_index_validity())
+            valid = {r.name: r.valid for r in res}
+            for name in OBSOLETE_INDEXES:
+                if name in valid:
+                    # postgres can't drop the index of a partitioned table concurrently
+                    concurrent = concurrently and not partition_keys
+                    logger.info(f'Drop the obsolete index {name}')
+                    await conn.execute(text(f'DROP INDEX {"CONCURRENTLY " if concurrent else ""}{name}'))
+            created = []
+            for table in meta_data.sorted_tables:
+                concurrent = concurrently and table.name not in partition_keys
+                for index in table.indexes:
+                    if valid.get(index.name):
+                        continue
+                    if index.name in valid:
+                        logger.warning(f'Rebuild the invalid index {index.name}')
+                        await conn.execute(text(f'DROP INDEX {"CONCURRENTLY " if concurrent else ""}{index.name}'))
+                    sql = str(CreateIndex(index).compile(dialect=conn.dialect))
+                    if concurrent:
+                        sql = sql.replace('INDEX', 'INDEX CONCURRENTLY', 1)
+                    logger.info(f'Create index {index.name} on {table.name}')
+                    await conn.execute(text(sql))
+                    created.append(index.name)
+            return created
+
+    def _reset_partition_cache(self):
+        self._partition_keys = None
+        self._partition_months = set()
+
+    async def get_partition_keys(self) -> Dict[str, str]:
+        """
+        @return: partitioned tables of the database and their partition key, empty if the database is not partitioned
+        """
+        if self._partition_keys is None:
+            async with self._engine.connect() as conn:
+                res = await conn.execute(stmt_partition_keys())
+                self._partition_keys = {r.name: r.key for r in res}
+        return self._partition_keys
+
+    async def _is_partitioned(self) -> bool:
+        return TWEET.name in await self.get_partition_keys()
+
+    async def _ensure_partitions(self, dates: Iterable[datetime.datetime]):
+        """
+        Create the missing monthly partitions of the tweet dates of a batch, in their own transaction before the batch
+        is saved: CREATE TABLE .. PARTITION OF locks the partitioned table until commit
+        The partitions of a month are created for all the partitioned tables, a tweet and its matches have the same date
+        """
+        partition_keys = await self.get_partition_keys()
+        if not partition_keys:
+            return
+        months = {month_start(d) for d in dates if d} - self._partition_months
+        if not months:
+            return
+        async with self._engine.begin() as conn:
+            # collectors saving tweets of the same new month would race on the partition creation
+            await conn.execute(select(func.pg_advisory_xact_lock(func.hashtext('partitions'))))
+            for table in partition_keys:
+                for month in sorted(months):
+                    await conn.execute(stmt_create_partition(table, month))
+        self._partition_months |= months
+
+    async def partition_tables(self, drop_old=True) -> int:
+        """
+        Migrate the tweet and collected_tweet tables of an existing database to tables partitioned by month
+        The tables are renamed with UNPARTITIONED_SUFFIX and their rows are copied one month per transaction,
+        call it again to resume an interrupted migration: the months already copied are skipped
+        The collectors must be stopped: their rule_day_count updates would count the matches not copied yet as new
+        @param drop_old: drop the renamed tables once copied
+        @return: number of copied tweets
+        """
+        names = list(PARTITION_KEYS)
+        olds = {name: name + UNPARTITIONED_SUFFIX for name in names}
+        async with self._engine.begin() as conn:
+            exists_new = await conn.scalar(select(func.to_regclass(TWEET.name))) is not None
+            exists_old = await conn.scalar(select(func.to_regclass(olds[TWEET.name]))) is not None
+
+        if not exists_new:
+            await self.build_tables(partitioned=True)
+            return 0
+        if TWEET.name not in await self.get_partition_keys():
+            await self._rename_unpartitioned(names, olds)
+        elif not exists_old:
+            logger.info('The tables are already partitioned')
+            return 0
+
+        old_tweet = light_table(olds[TWEET.name], *[column(c.name) for c in TWEET.columns])
+        old_match = light_table(olds[RULE_MATCH.name], *[column(c.name) for c in RULE_MATCH.columns])
+        async with self._engine.begin() as conn:
+            res = await conn.execute(select(func.min(old_tweet.c.created_at), func.max(old_tweet.c.created_at)))
+            first, last = res.one()
+
+        total = 0
+        month = month_start(first) if first else None
+        while month and month <= month_start(last):
+            await self._ensure_partitions([day_start(month)])
+            async with self._engine.begin() as conn:
+                done = await conn.scalar(select(text('true')).select_from(
+                    light_table(partition_name(TWEET.name, month))).limit(1))
+                if done:
+                    logger.info(f'partition_tables: {month} already copied')
+                    month = next_month(month)
+                    continue
+                in_month = [old_tweet.c.created_at >= day_start(month),
+                            old_tweet.c.created_at < day_start(next_month(month))]
+
+                columns = [c.name for c in TWEET.columns]
+                stmt = insert(TWEET).from_select(columns, select(*[old_tweet.c[c] for c in columns]).where(*in_month))
+                count = (await conn.execute(stmt)).rowcount
+
+                # the tweet_created_at of the matches is taken from the tweet, the composite foreign key requires it
+                matches = select(old_match.c.rule_id, old_match.c.tweet_id, old_tweet.c.created_at,
+                                 old_match.c.collected_at, old_match.c.direct_hit)
+                matches = matches.select_from(old_match.join(old_tweet, old_tweet.c.id == old_match.c.tweet_id))
+                stmt = insert(RULE_MATCH).from_select(
+                    ['rule_id', 'tweet_id', 'tweet_created_at', 'collected_at', 'direct_hit'],
+                    matches.where(*in_month))
+                await conn.execute(stmt)
+            total += count
+            logger.info(f'partition_tables: {month} {count} tweets, total {total}')
+            month = next_month(month)
+
+        async with self._engine.begin() as conn:
+            if drop_old:
+                await conn.execute(text(f'DROP TABLE "{olds[RULE_MATCH.name]}", "{olds[TWEET.name]}"'))
+            # autovacuum does not analyze the partitioned tables themselves, only their partitions
+            await conn.execute(text(f'ANALYZE "{TWEET.name}", "{RULE_MATCH.name}"'))
+        return total
 
-    async def build_tables(self):
+    async def _rename_unpartitioned(self, names: List[str], olds: Dict[str, str]):
+        """
+        Rename the tables and their indexes with UNPARTITIONED_SUFFIX and create the partitioned tables
+        """
         async with self._engine.begin() as conn:
-            await conn.run_sync(meta_data.create_all)
+            res = await conn.execute(select(func.count()).select_from(TWEET).where(TWEET.c.created_at.is_(None)))
+            missing = res.scalar()
+            if missing:
+                raise ValueError(f'{missing} tweets have no created_at, it is the partition key')
+            res = await conn.execute(
+                select(func.count()).select_from(RULE_MATCH.join(TWEET))
+                .where(RULE_MATCH.c.tweet_created_at.is_distinct_from(TWEET.c.created_at))
+            )
+            fixed = res.scalar()
+            if fixed:
+                logger.warning(f'{fixed} matches have a tweet_created_at different from the tweet date, they are '
+                               f'copied with the tweet date, run scripts/rebuild_rule_day_count.py after')
+
+            # the foreign keys from the other tables (tweet_update) can't reference a partitioned table by tweet id
+            for r in (await conn.execute(stmt_referencing_foreign_keys(names))).all():
+                logger.info(f'Drop the foreign key {r.name} of {r.table_name}')
+                await conn.execute(text(f'ALTER TABLE "{r.table_name}" DROP CONSTRAINT "{r.name}"'))
+            for name in names:
+                for index in (await conn.execute(stmt_table_indexes(name))).scalars().all():
+                    await conn.execute(text(f'ALTER INDEX "{index}" RENAME TO "{index}{UNPARTITIONED_SUFFIX}"'))
+                await conn.execute(text(f'ALTER TABLE "{name}" RENAME TO "{olds[name]}"'))
+
+            meta = partitioned_meta_data()
+            await conn.run_sync(meta.create_all, tables=[meta.tables[name] for name in names])
+        self._reset_partition_cache()
+        logger.info(f'Renamed {", ".join(names)} with {UNPARTITIONED_SUFFIX}, created the partitioned tables')
+
+    def _conflict_keys(self, table: Table) -> List[str]:
+        """
+        ON CONFLICT target of an upsert, the primary key of a partitioned table includes its partition key
+        """
+        keys = primary_keys(table)
+        key = (self._partition_keys or {}).get(table.name)
+        return [*keys, key] if key else keys
 
     TRule = TypeVar('TRule', bound=Rule)
 
@@ -104,6 +314,12 @@ class PostgresJSONBStorage(SystemStorage):
             for r in rules:
                 r.id = query_to_rule[r.query].id
 
+            # the aggregate of a rule without matches is complete, the save_bulk updates keep it so
+            no_matches = select(RULE.c.id).where(RULE.c.id.in_([r.id for r in res]),
+                                                 ~exists().where(RULE_MATCH.c.rule_id == RULE.c.id))
+            stmt = insert(RULE_DAY_COUNT_COMPLETE).from_select(['rule_id'], no_matches)
+            await conn.execute(stmt.on_conflict_do_nothing())
+
             return rules
 
     async def save_error(self, error: ErrorModel):
@@ -179,33 +395,162 @@ class PostgresJSONBStorage(SystemStorage):
 
             await conn.execute(stmt, values)
 
-    async def update_count_estimate(self, rule_ids: List[int] = None):
-        old = time.time()
+    async def rebuild_rule_day_count(self):
+        """
+        Recompute the rule_day_count aggregate and the rules count_estimate from the collected_tweet table
+        Only needed for the matches saved before the aggregate existed, save_bulk keeps it up to date
+        The rules are marked complete, their counts are then read from the aggregate
+        """
         async with self._engine.begin() as conn:
-            stmt = select(RULE_MATCH.c.rule_id, func.count(RULE_MATCH.c.tweet_id).label('count'))
-            stmt = where_in_builder(stmt, (RULE_MATCH.c.rule_id, rule_ids))
-            stmt = stmt.group_by(RULE_MATCH.c.rule_id)
+            # waits for the running save_bulk and blocks the next ones until the rebuild is committed
+            await conn.execute(select(func.pg_advisory_xact_lock(func.hashtext(RULE_DAY_COUNT.name))))
+            await conn.execute(delete(RULE_DAY_COUNT))
+            await conn.execute(stmt_rebuild_rule_day_count())
+            stmt = insert(RULE_DAY_COUNT_COMPLETE).from_select(['rule_id'], select(RULE.c.id))
+            await conn.execute(stmt.on_conflict_do_nothing())
+            await conn.execute(
+                update(RULE).values(count_estimate=select(func.coalesce(func.sum(RULE_DAY_COUNT.c.n), 0))
+                                    .where(RULE_DAY_COUNT.c.rule_id == RULE.c.id)
+                                    .scalar_subquery())
+            )
 
-            res = await conn.execute(stmt)
-            res = res_to_dicts(res)
+    async def save_downloaded_medias(self, downloaded_medias: List[DownloadedMedia], ack=False):
+        """
+        @param downloaded_medias: DownloadedMedia to save
+        @param ack: delete their download tasks in the same transaction
+        """
+        async with self._engine.begin() as conn:
+            await self._save_downloaded_medias(conn, downloaded_medias)
+            if ack:
+                media_keys = [d.media_key for d in downloaded_medias]
+                await conn.execute(delete(DOWNLOAD_TASK).where(DOWNLOAD_TASK.c.media_key.in_(media_keys)))
 
-            if not res:
-                return time.time() - old
+    async def add_download_tasks(self, tasks: List[Dict]):
+        """
+        Add medias to the durable download queue
+        A media already queued keeps its highest priority, a failed one is retried from zero
+        @param tasks: dicts with media_key, queue and priority
+        """
+        if not tasks:
+            return
+        async with self._engine.begin() as conn:
+            stmt = insert(DOWNLOAD_TASK)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=primary_keys(DOWNLOAD_TASK),
+                set_=dict(priority=func.least(DOWNLOAD_TASK.c.priority, stmt.excluded.priority),
+                          attempts=case((DOWNLOAD_TASK.c.failed, 0), else_=DOWNLOAD_TASK.c.attempts),
+                          next_attempt_at=func.least(DOWNLOAD_TASK.c.next_attempt_at, func.now()),
+                          failed=False)
+            )
+            await conn.execute(stmt, tasks)
 
-            stmt = update(RULE).where(RULE.c.id == bindparam('rule_key'))
+    async def claim_download_tasks(self, queue: str, limit: int, worker_id: str = None,
+                                   lease: datetime.timedelta = DOWNLOAD_CLAIM_LEASE):
+        """
+        Claim the next download tasks of a queue, by priority then retry time
+        Concurrent claims skip the locked rows, claims older than lease are considered abandoned
+        @param worker_id: process claiming the tasks, see release_download_tasks
+        @return: claimed tasks as dicts with media_key, priority and attempts (this claim included)
+        """
+        async with self._engine.begin() as conn:
+            res = await conn.execute(stmt_claim_download_tasks(queue, limit, lease, worker_id))
+            return res_to_dicts(res)
 
-            values = [dict(
-                rule_key=estimate['rule_id'],
-                count_estimate=estimate['count']
-            ) for estimate in res]
+    async def retry_download_task(self, media_key: str, delay: float = None, error: str = None):
+        """
+        Release a claimed task after a failed download
+        @param delay: seconds before the next attempt, None marks the task as failed
+        """
+        async with self._engine.begin() as conn:
+            values = dict(claimed_at=None, claimed_by=None, last_error=error)
+            if delay is None:
+                values['failed'] = True
+            else:
+                values['next_attempt_at'] = func.now() + datetime.timedelta(seconds=delay)
+            await conn.execute(update(DOWNLOAD_TASK).where(DOWNLOAD_TASK.c.media_key == media_key).values(values))
 
-            await conn.execute(stmt, values)
+    async def delete_download_tasks(self, media_keys: List[str]):
+        async with self._engine.begin() as conn:
+            await conn.execute(delete(DOWNLOAD_TASK).where(DOWNLOAD_TASK.c.media_key.in_(media_keys)))
 
-            return time.time() - old
+    async def save_media_hashes(self, hashes: List[Dict]):
+        """
+        @param hashes: dicts with sha1, ahash and phash (unsigned, None if the file is not a readable image)
+        """
+        if not hashes:
+            return
+        rows = []
+        for h in hashes:
+            row = dict(sha1=h['sha1'], ahash=None, phash=None, phash_0=None, phash_1=None, phash_2=None, phash_3=None)
+            if h.get('phash') is not None:
+                row['ahash'] = to_signed(h['ahash'])
+                row['phash'] = to_signed(h['phash'])
+                for i, band in enumerate(hash_bands(h['phash'])):
+                    row[f'phash_{i}'] = band
+            rows.append(row)
+        async with self._engine.begin() as conn:
+            stmt = insert(MEDIA_HASH)
+            stmt = stmt.on_conflict_do_update(index_elements=primary_keys(MEDIA_HASH),
+                                              set_={k: stmt.excluded[k] for k in rows[0] if k != 'sha1'})
+            await conn.execute(stmt, rows)
 
-    async def save_downloaded_medias(self, downloaded_medias: List[DownloadedMedia]):
+    async def get_media_hashes(self, sha1s: List[str]) -> Dict[str, Tuple[int, int]]:
+        """
+        @return: sha1 -> (ahash, phash) unsigned, None for the files that are not readable images
+        """
         async with self._engine.begin() as conn:
-            await self._save_downloaded_medias(conn, downloaded_medias)
+            stmt = select(MEDIA_HASH.c.sha1, MEDIA_HASH.c.ahash, MEDIA_HASH.c.phash).where(MEDIA_HASH.c.sha1.in_(sha1s))
+            res = await conn.execute(stmt)
+            return {r.sha1: (to_unsigned(r.ahash), to_unsigned(r.phash)) if r.phash is not None else None for r in res}
+
+    async def get_unhashed_photos(self, limit: int = 1000, after: str = None) -> List[Tuple[str, str]]:
+        """
+        @param after: last sha1 of the previous page
+        @return: (sha1, format) of downloaded photos without perceptual hash, ordered by sha1
+        """
+        async with self._engine.begin() as conn:
+            res = await conn.execute(stmt_unhashed_photos(limit, after))
+            return [(r.sha1, r.format) for r in res]
+
+    async def find_similar_medias(self, phash: int, max_distance: int = HASH_BANDS - 1, limit: int = 100):
+        """
+        Near duplicate search by hamming distance of the perceptual hashes, with the multi-index of the phash bands
+        Below HASH_BANDS the candidates are exact band matches, the cost grows fast for larger distances
+        @param phash: unsigned perceptual hash of the query image
+        @param max_distance: max hamming distance
+        @param limit: max number of results
+        @return: dicts with sha1, phash (unsigned), distance and media_keys, closest first
+        """
+        radius = max_distance // HASH_BANDS
+        variants = [band_variants(band, radius) for band in hash_bands(phash)]
+        async with self._engine.begin() as conn:
+            res = await conn.execute(stmt_find_similar_hashes(to_signed(phash), variants, max_distance, limit))
+            res = res_to_dicts(res)
+            for r in res:
+                r['phash'] = to_unsigned(r['phash'])
+                r['media_keys'] = [k for k in r['media_keys'] if k]
+            return res
+
+    async def release_download_tasks(self, worker_id: str):
+        """
+        Release the claims of a worker, called on startup: the downloads of its previous run were interrupted
+        The claims of the other processes are kept, the abandoned ones expire after the claim lease
+        """
+        async with self._engine.begin() as conn:
+            stmt = update(DOWNLOAD_TASK).where(DOWNLOAD_TASK.c.claimed_by == worker_id)
+            stmt = stmt.values(claimed_at=None, claimed_by=None)
+            res = await conn.execute(stmt)
+            return res.rowcount
+
+    async def count_download_tasks(self, queue: str = None):
+        """
+        @return: number of tasks waiting or claimed, failed tasks excluded
+        """
+        async with self._engine.begin() as conn:
+            stmt = select(func.count()).select_from(DOWNLOAD_TASK).where(DOWNLOAD_TASK.c.failed.is_(False))
+            if queue:
+                stmt = stmt.where(DOWNLOAD_TASK.c.queue == queue)
+            return (await conn.execute(stmt)).scalar()
 
     @staticmethod
     async def _save_downloaded_medias(conn, downloaded_medias: List[DownloadedMedia]):
@@ -237,44 +582,88 @@ class PostgresJSONBStorage(SystemStorage):
                 res = [DownloadedMedia(**r) for r in res]
             return res
 
-    async def save_bulk(self, data: BulkData, callback: Callable = None, override=False, ignore_tweets=False):
+    async def find_downloaded_medias(self, media_keys: List[str] = None, urls: List[str] = None):
+        """
+        Batch lookup of the already downloaded medias, by media_key or by url
+        @return: DownloadedMedia with the media (media_key, type and url only)
+        """
+        if not media_keys and not urls:
+            return []
         async with self._engine.begin() as conn:
+            res = await conn.execute(stmt_find_downloaded_medias(media_keys, urls))
+            res = res_to_dicts(res)
+            return [DownloadedMedia(media_key=r['media_key'], sha1=r['sha1'], format=r['format'],
+                                    media=Media(media_key=r['media_key'], type=r['type'], url=r['url'])) for r in res]
+
+    async def save_bulk(self, data: BulkData | BulkRows, callback: Callable = None, override=False,
+                        ignore_tweets=False, mode: str = None):
+        """
+        Save all the objects of a BulkData in one transaction
+        @param data: BulkData to save, or BulkRows for data that was not parsed into pydantic models
+        @param callback: called with the data once saved
+        @param override: override existing rule matches
+        @param ignore_tweets: do not save the tweets, only the other objects
+        @param mode: 'insert' or 'copy'. Default uses 'copy' for tables with more than COPY_ROW_THRESHOLD rows
+        """
+        if mode and mode not in SAVE_MODES:
+            raise ValueError(f'save_bulk mode <<{mode}>> is not valid, use one of {SAVE_MODES}')
+
+        if isinstance(data, BulkRows):
+            await self._ensure_partitions(data.get_tweet_created_at(tweet_id) for tweet_id in data.tweets)
+            matches = await self._rule_match_rows_values(data)
+        else:
+            await self._ensure_partitions(t.created_at for t in data.get_tweets())
+            matches = await self._rule_match_values(data.get_rule_matches(), data.tweets)
+
+        async with self._engine.begin() as conn:
+            if isinstance(data, BulkRows):
+                await self._save_rows(conn, data, matches, override=override, ignore_tweets=ignore_tweets, mode=mode)
+                if callback:
+                    fire_and_forget(callback(data))
+                return
+
+            tweet_media = []
+            if data.tweets and not ignore_tweets:
+                tweet_media = [(t.id, k) for t in data.get_tweets() for k in t.get_media_keys()]
+            first_media = await self._lock_batch(conn, matches, list({t for t, _ in tweet_media}))
 
             if data.tweets and not ignore_tweets:
                 old = time.time()
-                await self._upsert_table(conn, TWEET, data.get_tweets())
+                await self._upsert_table(conn, TWEET, data.get_tweets(), mode)
+                await self._save_tweet_media(conn, tweet_media, first_media, mode)
                 logger.debug(f'save tweet: {time.time() - old}')
             if data.medias:
                 old = time.time()
-                await self._upsert_table(conn, MEDIA, data.get_medias())
+                await self._upsert_table(conn, MEDIA, data.get_medias(), mode)
                 logger.debug(f'save media: {time.time() - old}')
             if data.users:
                 old = time.time()
-                await self._upsert_table(conn, USER, data.get_users())
+                await self._upsert_table(conn, USER, data.get_users(), mode)
                 logger.debug(f'save users: {time.time() - old}')
             if data.polls:
                 old = time.time()
-                await self._upsert_table(conn, POLL, data.get_polls())
+                await self._upsert_table(conn, POLL, data.get_polls(), mode)
                 logger.debug(f'save polls: {time.time() - old}')
             if data.places:
-                # old = time.time()
-                await self._upsert_table(conn, PLACE, data.get_places())
+                old = time.time()
+                await self._upsert_table(conn, PLACE, data.get_places(), mode)
                 logger.debug(f'save places: {time.time() - old}')
 
-            matches = data.get_rule_matches()
             if matches:
-                await self._save_rule_match(conn, matches, data.tweets, override=override)
+                await self._save_rule_match_values(conn, matches, override=override, mode=mode)
             # if data.downloaded_medias:
             #     await self._save_downloaded_medias(conn, data.get_downloaded_medias())
-            self._count_estimate_task_start()
             if callback:
                 fire_and_forget(callback(data))
 
-    async def _save_rule_match(self, conn, matches: List[RuleMatch], tweets: Dict[str, Tweet] = None, override=False):
+    async def _rule_match_values(self, matches: List[RuleMatch], tweets: Dict[str, Tweet] = None) -> List[Dict]:
+        """
+        Rule matches as dicts with the columns of the collected_tweet table
+        @param tweets: tweets of the matches, the missing ones are read from the db
+        """
         if not matches:
-            return
-        if not tweets:
-            tweets = {}
+            return []
+        tweets = dict(tweets) if tweets else {}
         missing_ids = set([m.tweet_id for m in matches]) - set(tweets.keys())
         if missing_ids:
             print('missing ids for rule_match (missing tweets in bulkdata)')
@@ -282,23 +671,39 @@ class PostgresJSONBStorage(SystemStorage):
             for tweet in missing_tweets:
                 tweets[tweet.id] = tweet
 
-        direct_hits = []
-        includes = []
+        values = []
         for match in matches:
             match_data = match.dict()
             match_data['tweet_created_at'] = tweets[match.tweet_id].created_at
-            # print(match_data['tweet_created_at'])
-            if match.direct_hit:
+            values.append(match_data)
+        return values
+
+    async def _save_rule_match_values(self, conn, matches: List[Dict], override=False, mode: str = None):
+        """
+        Save rule matches given as dicts with the columns of the collected_tweet table
+        Their rule_day_count keys must be locked by _lock_batch
+        """
+        await self._update_rule_day_count(conn, matches, override=override)
+
+        direct_hits = []
+        includes = []
+        for match_data in matches:
+            if match_data['direct_hit']:
                 direct_hits.append(match_data)
             else:
                 includes.append(match_data)
+
+        if self._use_copy(matches, mode):
+            await self._copy_rule_match(conn, [*direct_hits, *includes], override=override)
+            return
+
         if override:
             all_matches = [*direct_hits, *includes]
             if not all_matches:
                 return
             stmt = insert(RULE_MATCH)
             stmt = stmt.on_conflict_do_update(
-                index_elements=primary_keys(RULE_MATCH),
+                index_elements=self._conflict_keys(RULE_MATCH),
                 set_=stmt.excluded)
             await conn.execute(stmt, all_matches)
             return
@@ -306,25 +711,327 @@ class PostgresJSONBStorage(SystemStorage):
         if direct_hits:
             stmt = insert(RULE_MATCH)
             stmt = stmt.on_conflict_do_update(
-                index_elements=primary_keys(RULE_MATCH),
+                index_elements=self._conflict_keys(RULE_MATCH),
                 set_=dict(direct_hit=stmt.excluded.direct_hit)
             )
             await conn.execute(stmt, direct_hits)
         if includes:
             stmt = insert(RULE_MATCH)
-            stmt = stmt.on_conflict_do_nothing(index_elements=primary_keys(RULE_MATCH))
+            stmt = stmt.on_conflict_do_nothing(index_elements=self._conflict_keys(RULE_MATCH))
             await conn.execute(stmt, includes)
 
     @staticmethod
-    async def _upsert_table(conn, table: Table, rows: List[BaseModel]):
+    async def _lock_batch(conn, matches: List[Dict], tweet_ids: List[str]) -> List:
+        """
+        Lock the (rule_id, day) keys of rule_day_count changed by a batch until the end of the transaction,
+        before anything of the batch is saved
+        Two batches with the same match wait for each other, otherwise the match could be counted twice.
+        All the keys are locked by one ordered statement so that two batches can't deadlock
+        The shared lock is held against rebuild_rule_day_count
+        @param matches: rule matches of the batch, dicts with the columns of the collected_tweet table
+        @param tweet_ids: tweets whose tweet_media are saved by the batch, their matches may move to has_media
+        @return: collected_tweet rows of the tweet_ids without tweet_media, to move to the has_media counts
+        once their media are saved (_save_tweet_media)
+        """
+        keys = {(m['rule_id'], utc_day(m['tweet_created_at'])) for m in matches}
+        without_media = None
+        if tweet_ids:
+            without_media = select(RULE_MATCH.c.rule_id, RULE_MATCH.c.tweet_created_at, RULE_MATCH.c.direct_hit)
+            without_media = without_media.where(in_array(RULE_MATCH.c.tweet_id, tweet_ids))
+            without_media = without_media.where(~exists().where(TWEET_MEDIA.c.tweet_id == RULE_MATCH.c.tweet_id))
+            # usually empty, the tweets are new or their media were saved with their matches
+            keys.update((m.rule_id, utc_day(m.tweet_created_at)) for m in await conn.execute(without_media))
+
+        await conn.execute(select(func.pg_advisory_xact_lock_shared(func.hashtext(RULE_DAY_COUNT.name))))
+        if keys:
+            await conn.execute(stmt_lock_rule_days(keys))
+        if without_media is None:
+            return []
+        # read again once locked, the media may have been saved by a batch we waited for
+        return list(await conn.execute(without_media))
+
+    @classmethod
+    async def _update_rule_day_count(cls, conn, matches: List[Dict], override=False):
+        """
+        Apply the changes of a batch of rule matches to rule_day_count and rule.count_estimate
+        Must run before the matches are saved and after the tweet_media of their tweets: the existing matches are
+        read to count only the new ones, and to move the include matches upgraded to direct hits (or overridden)
+        to their new key
+        """
+        if not matches:
+            return
+
+        tweet_ids = list({m['tweet_id'] for m in matches})
+        rule_ids = list({m['rule_id'] for m in matches})
+        res = await conn.execute(
+            select(RULE_MATCH.c.rule_id, RULE_MATCH.c.tweet_id, RULE_MATCH.c.tweet_created_at, RULE_MATCH.c.direct_hit)
+            .where(RULE_MATCH.c.rule_id.in_(rule_ids), in_array(RULE_MATCH.c.tweet_id, tweet_ids))
+        )
+        existing = {(r.rule_id, r.tweet_id): (utc_day(r.tweet_created_at), bool(r.direct_hit)) for r in res}
+        stmt = select(distinct(TWEET_MEDIA.c.tweet_id)).where(in_array(TWEET_MEDIA.c.tweet_id, tweet_ids))
+        res = await conn.execute(stmt)
+        with_media = set(res.scalars())
+
+        deltas = Counter()
+        new_matches = Counter()
+        for m in matches:
+            rule_id = m['rule_id']
+            # the existing matches are counted on the current has_media, _save_tweet_media moves them
+            has_media = m['tweet_id'] in with_media
+            day = utc_day(m['tweet_created_at'])
+            direct_hit = bool(m['direct_hit'])
+
+            old = existing.get((rule_id, m['tweet_id']))
+            if old is None:
+                deltas[(rule_id, day, direct_hit, has_media)] += 1
+                new_matches[rule_id] += 1
+                continue
+            old_day, old_direct_hit = old
+            if not override:
+                day, direct_hit = old_day, old_direct_hit or direct_hit
+            if (day, direct_hit) != old:
+                deltas[(rule_id, old_day, old_direct_hit, has_media)] -= 1
+                deltas[(rule_id, day, direct_hit, has_media)] += 1
+
+        await cls._add_rule_day_counts(conn, deltas)
+        if new_matches:
+            stmt = update(RULE).where(RULE.c.id == bindparam('rule_key'))
+            stmt = stmt.values(count_estimate=func.coalesce(RULE.c.count_estimate, 0) + bindparam('delta'))
+            await conn.execute(stmt, [dict(rule_key=k, delta=n) for k, n in new_matches.items()])
+
+    async def _save_rows(self, conn, data: BulkRows, matches: List[Dict], override=False, ignore_tweets=False,
+                         mode: str = None):
+        """
+        save_bulk for BulkRows, the row tuples are copied as they are or converted to dicts for insert
+        @param matches: rule matches of the data, from _rule_match_rows_values
+        """
+        tweet_media = [] if ignore_tweets else data.get_tweet_media()
+        first_media = await self._lock_batch(conn, matches, list({t for t, _ in tweet_media}))
+
+        for name, table_rows in data.tables.items():
+            if not table_rows or (ignore_tweets and name == 'tweets'):
+                continue
+            old = time.time()
+            await self._upsert_table_rows(conn, table_rows, mode)
+            if name == 'tweets':
+                await self._save_tweet_media(conn, tweet_media, first_media, mode)
+            logger.debug(f'save {name}: {time.time() - old}')
+
+        if matches:
+            await self._save_rule_match_values(conn, matches, override=override, mode=mode)
+
+    async def _rule_match_rows_values(self, data: BulkRows) -> List[Dict]:
+        """
+        Rule matches of BulkRows as dicts with the columns of the collected_tweet table
+        """
+        matches = data.get_rule_match_dicts()
+        if not matches:
+            return []
+
+        missing_ids = set()
+        for match in matches:
+            match['tweet_created_at'] = data.get_tweet_created_at(match['tweet_id'])
+            if match['tweet_created_at'] is None:
+                missing_ids.add(match['tweet_id'])
+        if missing_ids:
+            logger.warning(f'{len(missing_ids)} tweets of rule matches missing in the bulk rows, read from the db')
+            created_at = {t.id: t.created_at for t in await self.get_tweets(fields=['id', 'created_at'],
+                                                                             ids=list(missing_ids))}
+            for match in matches:
+                if match['tweet_created_at'] is None:
+                    match['tweet_created_at'] = created_at[match['tweet_id']]
+        return matches
+
+    @classmethod
+    async def _save_tweet_media(cls, conn, tweet_media: List[Tuple[str, str]], first_media: List, mode: str = None):
+        """
+        Save the (tweet_id, media_key) pairs in the tweet_media table, existing pairs are ignored
+        @param first_media: matches of the tweets without media, returned by _lock_batch
+        """
+        if not tweet_media:
+            return
+        index_elements = primary_keys(TWEET_MEDIA)
+        if cls._use_copy(tweet_media, mode):
+            columns = ['tweet_id', 'media_key']
+            staging = await cls._copy_records_to_staging(conn, TWEET_MEDIA, columns, tweet_media)
+            stmt = insert(TWEET_MEDIA).from_select(columns, select(*[staging.c[c] for c in columns]))
+            await conn.execute(stmt.on_conflict_do_nothing(index_elements=index_elements))
+        else:
+            # executemany, a multi rows VALUES would go over the 32767 parameters of postgres on large bulks
+            stmt = insert(TWEET_MEDIA).on_conflict_do_nothing(index_elements=index_elements)
+            await conn.execute(stmt, [dict(tweet_id=t, media_key=m) for t, m in tweet_media])
+        await cls._move_to_media_counts(conn, first_media)
+
+    @classmethod
+    async def _move_to_media_counts(cls, conn, matches: List):
+        """
+        Move the rule_day_count of matches from has_media false to true, keeps the aggregate equal to a rebuild
+        """
+        deltas = Counter()
+        for m in matches:
+            key = (m.rule_id, utc_day(m.tweet_created_at), bool(m.direct_hit))
+            deltas[(*key, False)] -= 1
+            deltas[(*key, True)] += 1
+        await cls._add_rule_day_counts(conn, deltas)
+
+    @staticmethod
+    async def _add_rule_day_counts(conn, deltas: Counter):
+        """
+        @param deltas: changes of n by (rule_id, day, direct_hit, has_media)
+        """
+        values = [dict(rule_id=k[0], day=k[1], direct_hit=k[2], has_media=k[3], n=n) for k, n in deltas.items() if n]
+        if values:
+            stmt = insert(RULE_DAY_COUNT)
+            stmt = stmt.on_conflict_do_update(index_elements=primary_keys(RULE_DAY_COUNT),
+                                              set_=dict(n=RULE_DAY_COUNT.c.n + stmt.excluded.n))
+            await conn.execute(stmt, values)
+
+    async def backfill_tweet_media(self, chunk_size=10000):
+        """
+        Fill the tweet_media table from tweet.attachments for the tweets saved before it existed
+        Tweets are processed by chunks of chunk_size in id order, one transaction per chunk
+        The rule_day_count of their matches are moved to has_media like in save_bulk
+        @return: number of tweets processed
+        """
+        last_id = ''
+        total = 0
+        while True:
+            async with self._engine.begin() as conn:
+                batch = select(TWEET.c.id).where(TWEET.c.id > last_id)
+                batch = batch.order_by(TWEET.c.id).limit(chunk_size).subquery('batch')
+
+                res = await conn.execute(select(func.max(batch.c.id), func.count()))
+                batch_last_id, count = res.one()
+                if not count:
+                    return total
+
+                # the chunk is fixed by its bounds, the LIMIT subquery is not evaluated again for the insert
+                media_keys = func.jsonb_array_elements_text(TWEET.c.attachments['media_keys'])
+                with_media = (
+                    select(TWEET.c.id)
+                    .where(TWEET.c.id > last_id, TWEET.c.id <= batch_last_id)
+                    .where(func.jsonb_typeof(TWEET.c.attachments['media_keys']) == 'array')
+                )
+                first_media = await self._lock_batch(conn, [], list((await conn.execute(with_media)).scalars()))
+                pairs = with_media.with_only_columns(TWEET.c.id, media_keys)
+                stmt = insert(TWEET_MEDIA).from_select(['tweet_id', 'media_key'], pairs)
+                stmt = stmt.on_conflict_do_nothing(index_elements=primary_keys(TWEET_MEDIA))
+                await conn.execute(stmt)
+                await self._move_to_media_counts(conn, first_media)
+
+            last_id = batch_last_id
+            total += count
+            logger.info(f'backfill tweet_media: {total} tweets')
+
+    async def _upsert_table_rows(self, conn, table_rows: TableRows, mode: str = None):
+        layout = table_rows.layout
+        table = layout.table
+        stmt = insert(table)
+        set_ = {f: stmt.excluded[f] for f in table_rows.get_fields()}
+
+        if self._use_copy(table_rows.rows, mode):
+            json_indexes = layout.json_indexes
+            records = []
+            for row in table_rows.rows.values():
+                row = list(row)
+                for i in json_indexes:
+                    if row[i] is not None:
+                        row[i] = safe_json(row[i])
+                records.append(row)
+            staging = await self._copy_records_to_staging(conn, table, layout.columns, records)
+
+            stmt = insert(table).from_select(layout.columns, select(*[staging.c[c] for c in layout.columns]))
+            stmt = stmt.on_conflict_do_update(index_elements=self._conflict_keys(table), set_=set_)
+            await conn.execute(stmt)
+            return
+
+        stmt = stmt.on_conflict_do_update(index_elements=self._conflict_keys(table), set_=set_)
+        await conn.execute(stmt, table_rows.get_dicts())
+
+    async def _copy_rule_match(self, conn, matches: List[Dict], override=False):
+        """
+        Merge rule matches through a staging table
+        Direct hits of the batch upgrade existing matches, includes never downgrade them
+        """
+        staging, columns = await self._copy_to_staging(conn, RULE_MATCH, matches)
+
+        keys = self._conflict_keys(RULE_MATCH)
+        stmt = insert(RULE_MATCH).from_select(columns, select(*[staging.c[c] for c in columns]))
+        if override:
+            set_ = {c: stmt.excluded[c] for c in columns if c not in keys}
+        else:
+            set_ = dict(direct_hit=or_(RULE_MATCH.c.direct_hit, stmt.excluded.direct_hit))
+        stmt = stmt.on_conflict_do_update(index_elements=keys, set_=set_)
+        await conn.execute(stmt)
+
+    @staticmethod
+    def _use_copy(rows: List, mode: str = None):
+        if mode:
+            return mode == 'copy'
+        return len(rows) >= COPY_ROW_THRESHOLD
+
+    async def _upsert_table(self, conn, table: Table, rows: List[BaseModel], mode: str = None):
+        if self._use_copy(rows, mode):
+            await self._copy_upsert_table(conn, table, rows)
+            return
+
         stmt = insert(table)
         stmt = stmt.on_conflict_do_update(
-            index_elements=primary_keys(table),
+            index_elements=self._conflict_keys(table),
             set_=update_dict(stmt, rows)
         )
         values = [r.dict() for r in rows]
         await conn.execute(stmt, values)
 
+    async def _copy_upsert_table(self, conn, table: Table, rows: List[BaseModel]):
+        """
+        Bulk load rows with COPY into a staging table, then merge them in the table with one INSERT .. SELECT
+        Like _upsert_table, only the fields set on the models are updated on conflict
+        """
+        staging, columns = await self._copy_to_staging(conn, table, [r.dict() for r in rows])
+
+        stmt = insert(table).from_select(columns, select(*[staging.c[c] for c in columns]))
+        stmt = stmt.on_conflict_do_update(
+            index_elements=self._conflict_keys(table),
+            set_=update_dict(stmt, rows)
+        )
+        await conn.execute(stmt)
+
+    @classmethod
+    async def _copy_to_staging(cls, conn, table: Table, values: List[Dict]):
+        """
+        Copy rows to a temporary staging table shaped like the table
+        Temporary tables are not WAL logged and are private to the connection, the rows are deleted on commit
+        @return: the staging table and the copied columns
+        """
+        columns = [c.name for c in table.columns if c.name in values[0]]
+        json_columns = {c.name for c in table.columns if isinstance(c.type, JSONB)}
+
+        records = [
+            tuple(safe_json(v[c]) if c in json_columns and v[c] is not None else v[c] for c in columns)
+            for v in values
+        ]
+        staging = await cls._copy_records_to_staging(conn, table, columns, records)
+        return staging, columns
+
+    @staticmethod
+    async def _copy_records_to_staging(conn, table: Table, columns: List[str] | Tuple[str], records: List):
+        """
+        Copy records, already in the order of columns, to the temporary staging table of the table
+        @return: the staging table
+        """
+        staging_name = 'staging_' + table.name
+
+        await conn.execute(text(
+            f'CREATE TEMPORARY TABLE IF NOT EXISTS {staging_name} (LIKE "{table.name}" INCLUDING DEFAULTS) '
+            f'ON COMMIT DELETE ROWS'
+        ))
+
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table(staging_name, records=records, columns=list(columns))
+
+        return light_table(staging_name, *[column(c) for c in columns])
+
     async def get_tweets(self,
                          fields: List[str] = None,
                          ids: List[str] = None,
@@ -334,7 +1041,8 @@ class PostgresJSONBStorage(SystemStorage):
                          limit: int = None,
                          rule_ids: List[int] = None,
                          direct_hit: bool = False,
-                         desc: bool = False) -> List[Tweet]:
+                         desc: bool = False,
+                         cursor: str = None) -> List[Tweet]:
         res = await self.get_tweets_raw(fields=fields,
                                         ids=ids,
                                         date_from=date_from,
@@ -342,7 +1050,8 @@ class PostgresJSONBStorage(SystemStorage):
                                         offset=offset,
                                         limit=limit,
                                         rule_ids=rule_ids,
-                                        desc=desc)
+                                        desc=desc,
+                                        cursor=cursor)
         res = [Tweet(**r) for r in res]
         return res
 
@@ -354,21 +1063,24 @@ class PostgresJSONBStorage(SystemStorage):
                              offset: int = None,
                              limit: int = None,
                              rule_ids: List[int] = None,
-                             desc: bool = False) -> List[Dict]:
+                             desc: bool = False,
+                             cursor: str = None) -> List[Dict]:
+        """
+        Tweets ordered by (created_at, id)
+        @param cursor: keyset cursor, the next page cursor is encode_cursor([last['created_at'], last['id']])
+        """
+        partitioned = await self._is_partitioned()
         async with self._engine.begin() as conn:
-            stmt = select_builder(TWEET, ['id'], fields)
+            stmt = select_builder(TWEET, ['id', 'created_at'], fields)
 
             if rule_ids:
-                stmt = stmt.select_from(join(TWEET, RULE_MATCH))
+                stmt = stmt.select_from(join(TWEET, RULE_MATCH, tweet_match_join(partitioned=partitioned)))
                 stmt = stmt.where(RULE_MATCH.c.rule_id.in_(rule_ids))
 
             stmt = where_in_builder(stmt, True, (TWEET.c.id, ids))
             stmt = date_from_to(stmt, TWEET.c.created_at, date_from, date_to)
             stmt = offset_limit(stmt, offset, limit)
-            if desc:
-                stmt = stmt.order_by(TWEET.c.created_at.order())
-            else:
-                stmt = stmt.order_by(TWEET.c.created_at.asc())
+            stmt = keyset(stmt, tweet_keyset_columns(), cursor, desc=desc)
             res = await conn.execute(stmt)
             res = res_to_dicts(res)
             return res
@@ -383,19 +1095,27 @@ class PostgresJSONBStorage(SystemStorage):
                                    direct_hit: bool = False,
                                    order: int = 0,
                                    offset: int = None,
-                                   limit: int = None):
+                                   limit: int = None,
+                                   partitioned: bool = False):
         stmt = select_join_builder((TWEET, tweet_fields), (RULE_MATCH, collected_fields))
+        if partitioned:
+            # prunes the partitions of the joined table
+            stmt = stmt.where(RULE_MATCH.c.tweet_created_at == TWEET.c.created_at)
 
         stmt = where_in_builder(stmt, True, (TWEET.c.id, ids), (RULE_MATCH.c.rule_id, rule_ids))
         if direct_hit:
-            stmt = stmt.where(RULE_MATCH.c.direct_hit)
+            stmt = stmt.where(RULE_MATCH.c.direct_hit.is_(True))
 
-        stmt = date_from_to(stmt, TWEET.c.created_at, date_from, date_to)
+        # with rule_ids the range and the order are read from ix_collected_tweet_rule_date
+        date = RULE_MATCH.c.tweet_created_at if rule_ids else TWEET.c.created_at
+        stmt = date_from_to(stmt, date, date_from, date_to)
+        if rule_ids and partitioned:
+            stmt = date_from_to(stmt, TWEET.c.created_at, date_from, date_to)
         stmt = offset_limit(stmt, offset, limit)
         if order < 0:
-            stmt = stmt.order_by(TWEET.c.created_at.desc())
+            stmt = stmt.order_by(date.desc())
         elif order > 0:
-            stmt = stmt.order_by(TWEET.c.created_at.asc())
+            stmt = stmt.order_by(date.asc())
         return stmt
 
     async def get_collected_tweets(self,
@@ -409,9 +1129,10 @@ class PostgresJSONBStorage(SystemStorage):
                                    order: int = 0,
                                    offset: int = None,
                                    limit: int = None) -> List[RuleMatch]:
+        partitioned = await self._is_partitioned()
         async with self._engine.begin() as conn:
             stmt = self._get_collected_tweets_stmt(tweet_fields, collected_fields, ids, date_from, date_to, rule_ids,
-                                                   direct_hit, order, offset, limit)
+                                                   direct_hit, order, offset, limit, partitioned)
             res = await conn.execute(stmt)
             res = res_to_dicts(res)
             res = [RuleMatch(**r, tweet=Tweet(**r)) for r in res]
@@ -429,9 +1150,10 @@ class PostgresJSONBStorage(SystemStorage):
                                           offset: int = None,
                                           limit: int = None,
                                           chunk_size=1000):
+        partitioned = await self._is_partitioned()
         async with self._engine.begin() as conn:
             stmt = self._get_collected_tweets_stmt(tweet_fields, collected_fields, ids, date_from, date_to, rule_ids,
-                                                   direct_hit, order, offset, limit)
+                                                   direct_hit, order, offset, limit, partitioned)
             conn = await conn.execution_options(yield_per=chunk_size, stream_results=True)
             conn = await conn.stream(stmt)
             async for res in conn.partitions(chunk_size):
@@ -447,13 +1169,15 @@ class PostgresJSONBStorage(SystemStorage):
         async with self._engine.begin() as conn:
             stmt = select(func.count().label('count'))
             if rule_ids:
-                stmt = stmt.select_from(join(TWEET, RULE_MATCH))
+                # collected_tweet alone, the date is the denormalized tweet_created_at
+                stmt = stmt.select_from(RULE_MATCH)
                 stmt = stmt.where(RULE_MATCH.c.rule_id.in_(rule_ids))
-                if direct_hit and rule_ids:
-                    stmt = stmt.where(RULE_MATCH.c.direct_hit == true())
+                if direct_hit:
+                    stmt = stmt.where(RULE_MATCH.c.direct_hit.is_(True))
+                stmt = date_from_to(stmt, RULE_MATCH.c.tweet_created_at, date_from, date_to)
             else:
                 stmt = stmt.select_from(TWEET)
-            stmt = date_from_to(stmt, TWEET.c.created_at, date_from, date_to)
+                stmt = date_from_to(stmt, TWEET.c.created_at, date_from, date_to)
             res = await conn.execute(stmt)
             res = res_to_dicts(res)
             res = res[0]['count']
@@ -461,12 +1185,9 @@ class PostgresJSONBStorage(SystemStorage):
 
     async def get_rule_matches(self, tweet_ids: List[str], rule_ids: List[int]):
         async with self._engine.begin() as conn:
-            stmt = select(RULE_MATCH)
-            stmt = where_in_builder(stmt, (RULE_MATCH.c.tweet_id, tweet_ids), (RULE_MATCH.c.rule_id, rule_ids))
+            stmt = stmt_get_rule_matches(rule_ids=rule_ids, tweet_ids=tweet_ids)
             res = await conn.execute(stmt)
-            res = res_to_dicts(res)
-            res = [RuleMatch(**r) for r in res]
-            return res
+            return [CompactRuleMatch(r.tweet_id, r.rule_id, r.direct_hit, r.collected_at) for r in res]
 
     async def get_users(self, fields: List[str] = None, ids: List[str] = None) -> List[User]:
         res = await self.get_users_raw(fields=fields, ids=ids)
@@ -484,7 +1205,7 @@ class PostgresJSONBStorage(SystemStorage):
     async def get_tweets_with_media_keys(self, media_keys: List[str], fields: List[str] = None):
         async with self._engine.begin() as conn:
             stmt = select_builder(TWEET, ['id'], fields)
-            stmt = stmt.where(TWEET.c.attachments['media_keys'].has_any(array(tuple(media_keys))))
+            stmt = stmt.where(TWEET.c.id.in_(stmt_tweet_ids_with_media_keys(media_keys)))
             res = await conn.execute(stmt)
             res = res_to_dicts(res)
             res = [Tweet(**r) for r in res]
@@ -619,11 +1340,54 @@ class PostgresJSONBStorage(SystemStorage):
             if not tweet_filter:
                 tweet_filter = TweetFilter()
 
+            if query.rule_ids and len(set(query.rule_ids)) == 1:
+                count = await self._count_tweets_from_days(conn, query, tweet_filter)
+                if count is not None:
+                    return count
+
             stmt = stmt_query_count_tweets(query, tweet_filter)
             res = await conn.execute(stmt)
             res = res_to_dicts(res)
             return res[0]['count']
 
+    @staticmethod
+    async def _count_tweets_from_days(conn, query: CollectionQuery, tweet_filter: TweetFilter):
+        """
+        Count the tweets of a single rule with the rule_day_count aggregate
+        Full days of the date range are summed from the aggregate, the partial days at the edges are counted
+        on the tweets
+        @return: the count, or None when the range is inside a single day or the aggregate of the rule is not complete,
+        and the exact count must be used
+        """
+        stmt = select(RULE_DAY_COUNT_COMPLETE.c.rule_id).where(RULE_DAY_COUNT_COMPLETE.c.rule_id == query.rule_ids[0])
+        if not (await conn.execute(stmt)).first():
+            return None
+
+        date_from = to_utc(query.date_from)
+        date_to = to_utc(query.date_to)
+        # full days are [day_from, day_to)
+        day_from = utc_day(date_from) if date_from else None
+        if date_from and date_from > day_start(day_from):
+            day_from += datetime.timedelta(days=1)
+        day_to = utc_day(date_to) if date_to else None
+        if day_from and day_to and day_from > day_to:
+            return None
+
+        stmt = stmt_query_count_rule_days(query.rule_ids[0], day_from, day_to, direct_hit=query.direct_hit,
+                                          has_media=bool(tweet_filter.media))
+        count = (await conn.execute(stmt)).scalar()
+
+        edges = []
+        date = tweet_date_column(query)
+        if date_from and date_from < day_start(day_from):
+            edges.append(and_(date >= date_from, date < day_start(day_from)))
+        if date_to:
+            edges.append(and_(date >= day_start(day_to), date <= date_to))
+        if edges:
+            stmt = stmt_query_count_tweets(query.copy(update=dict(date_from=None, date_to=None)), tweet_filter)
+            count += (await conn.execute(stmt.where(or_(*edges)))).scalar()
+        return count
+
     async def query_count_medias(self, query: CollectionQuery, tweet_filter: TweetFilter = None):
         async with self._engine.begin() as conn:
             if not tweet_filter:
@@ -635,70 +1399,89 @@ class PostgresJSONBStorage(SystemStorage):
             return res[0]['count']
 
     async def query_tweets(self, query: CollectionQuery, tweet_filter: TweetFilter = None):
+        partitioned = await self._is_partitioned()
         async with self._engine.begin() as conn:
             if not tweet_filter:
                 tweet_filter = TweetFilter()
 
-            stmt = stmt_query_tweets(query, tweet_filter)
+            stmt = stmt_query_tweets(query, tweet_filter, partitioned)
             print(stmt)
             res = await conn.execute(stmt)
-            res = res_to_dicts(res)
-
-            tweets = [Tweet(**r['tweet']) for r in res]
-            matches = [r['rule_match'] for r in res]
-            rule_matches = []
-            for m in matches:
-                rule_matches.extend(m)
-            rule_matches = [RuleMatch(**m) for m in rule_matches]
-
-            res_data = LinkedBulkData()
-            res_data.add_tweets(tweets)
-            res_data.add_rule_matches(rule_matches)
+            res_data = self._tweet_rows_to_data(res)
+            if query.cursor or query.order:
+                res_data.cursor = self._next_cursor(list(res_data.tweets.values()), self._tweet_key, query.limit)
 
             # linked_tweets = res_data.get_linked_tweets()
 
             return res_data
 
+    @staticmethod
+    def _tweet_rows_to_data(rows) -> LinkedBulkData:
+        """
+        Tweets and rule matches of the rows of the tweet queries (stmt_query_tweets, stmt_stream_tweets, ...)
+        The rows start with the typed tweet columns, the rule matches are the arrays of agg_rule_matches
+        """
+        tweet_columns = [c.name for c in TWEET.c]
+        tweets = []
+        rule_matches = []
+        for r in rows:
+            tweet = Tweet(**dict(zip(tweet_columns, r)))
+            tweets.append(tweet)
+            if r.match_rule_ids:
+                rule_matches.extend(CompactRuleMatch.from_arrays(tweet.id, r.match_rule_ids, r.match_direct_hits,
+                                                                 r.match_collected_ats))
+
+        res_data = LinkedBulkData()
+        res_data.add_tweets(tweets)
+        res_data.add_rule_matches(rule_matches)
+        return res_data
+
+    @staticmethod
+    def _tweet_key(tweet: Tweet):
+        return [tweet.created_at, tweet.id]
+
+    @staticmethod
+    def _media_key(media: Media):
+        return [media.media_key]
+
+    @staticmethod
+    def _next_cursor(items: List, key: Callable, limit: int = None):
+        """
+        Cursor of the page following items
+        @param items: items of the page, in the keyset order
+        @param key: returns the keyset values of an item
+        @param limit: page size, no cursor is returned for an incomplete page
+        """
+        if not items or (limit and len(items) < limit):
+            return None
+        return encode_cursor(key(items[-1]))
+
     async def query_tweets_sample(self, query: CollectionQuery):
+        partitioned = await self._is_partitioned()
         async with self._engine.begin() as conn:
-            stmt = stmt_query_tweets_sample(query)
+            stmt = stmt_query_tweets_sample(query, partitioned)
             res = await conn.execute(stmt)
-            res = res_to_dicts(res)
-
-            tweets = [Tweet(**r['tweet']) for r in res]
-            matches = [r['rule_match'] for r in res]
-            rule_matches = []
-            for m in matches:
-                rule_matches.extend(m)
-            rule_matches = [RuleMatch(**m) for m in rule_matches]
-
-            res_data = LinkedBulkData()
-            res_data.add_tweets(tweets)
-            res_data.add_rule_matches(rule_matches)
+            res_data = self._tweet_rows_to_data(res)
 
             # linked_tweets = res_data.get_linked_tweets()
 
             return res_data
 
     async def query_tweets_stream(self, query: CollectionQuery, tweet_filter: TweetFilter = None, chunk_size=10):
-        async with self._engine.connect() as conn:
-            if not tweet_filter:
-                tweet_filter = TweetFilter()
-            stmt = stmt_query_tweets(query, tweet_filter)
-            conn = await conn.stream(stmt)
-            async for res in conn.partitions(chunk_size):
-                res = res_to_dicts(res)
-
-                tweets = [Tweet(**r['tweet']) for r in res]
-                matches = [r['rule_match'] for r in res]
-                rule_matches = []
-                for m in matches:
-                    rule_matches.extend(m)
-                rule_matches = [RuleMatch(**m) for m in rule_matches]
-
-                res_data = LinkedBulkData()
-                res_data.add_tweets(tweets)
-                res_data.add_rule_matches(rule_matches)
+        """
+        Stream the tweets of a collection with their rule matches, in the (created_at, id) order
+        The rows are read through a named cursor, by STREAM_FETCH_SIZE rows at least,
+        the first chunk comes without waiting for the whole collection
+        Each chunk has the cursor of the next one
+        """
+        if not tweet_filter:
+            tweet_filter = TweetFilter()
+        stmt = stmt_stream_tweets(query, tweet_filter, await self._is_partitioned())
+        async with self._engine.begin() as conn:
+            async for res in server_cursor(conn, stmt, chunk_size, STREAM_FETCH_SIZE):
+                res_data = self._tweet_rows_to_data(res)
+                # cursor to resume the stream after this chunk
+                res_data.cursor = self._next_cursor(list(res_data.tweets.values()), self._tweet_key)
                 yield res_data
 
     async def get_rule_matches_stream(self, rule_ids: List[int] = None, chunk_size=100):
@@ -740,6 +1523,8 @@ class PostgresJSONBStorage(SystemStorage):
             data = LinkedBulkData()
             data.media_to_tweets = media_to_tweets
             data.add_medias(medias)
+            if query.cursor or query.order:
+                data.cursor = self._next_cursor(medias, self._media_key, query.limit)
 
             if downloaded:
                 d_medias = await self.get_downloaded_medias(media_keys=[m.media_key for m in medias])
@@ -748,28 +1533,29 @@ class PostgresJSONBStorage(SystemStorage):
             return data
 
     async def query_medias_stream(self, query: CollectionQuery, downloaded=True, chunk_size=10):
+        """
+        Stream the medias of a collection with their tweet ids, in the media_key order
+        The downloaded files come from the same query (LEFT JOIN on downloaded_media)
+        The rows are read through a named cursor, like query_tweets_stream
+        """
+        stmt = stmt_stream_medias(query)
         async with self._engine.begin() as conn:
-            stmt = stmt_query_medias(query, TweetFilter(media=True))
-            conn = await conn.stream(stmt)
-            async for res in conn.partitions(chunk_size):
-                res = res_to_dicts(res)
-
+            async for res in server_cursor(conn, stmt, chunk_size, STREAM_FETCH_SIZE):
                 media_to_tweets = {}
                 medias = []
+                d_medias = []
                 for r in res:
-                    media = Media(**r['media'])
+                    media = Media(**r.media)
                     medias.append(media)
-                    tweet_ids = r['tweet_ids']
-                    media_to_tweets[media.media_key] = set(tweet_ids)
+                    media_to_tweets[media.media_key] = set(r.tweet_ids)
+                    if downloaded and r.sha1:
+                        d_medias.append(DownloadedMedia(media_key=media.media_key, sha1=r.sha1, format=r.format))
 
                 data = LinkedBulkData()
                 data.media_to_tweets = media_to_tweets
                 data.add_medias(medias)
-
-                if downloaded:
-                    d_medias = await self.get_downloaded_medias(media_keys=[m.media_key for m in medias])
-                    data.add_downloaded_medias(d_medias)
-
+                data.add_downloaded_medias(d_medias)
+                data.cursor = self._next_cursor(medias, self._media_key)
                 yield data
 
     async def get_rules(self,
@@ -2,125 +2,215 @@
 SQL Statement builder functions.
 We want to keep most of SQL logic in this file
 """
-from typing import List
+import datetime
+from typing import List, Iterable, Tuple
 
-from sqlalchemy import func, join, text, distinct
-from sqlalchemy.dialects.postgresql import array
+from sqlalchemy import func, join, text, distinct, exists, cast, Date, false, true, union, update, or_, and_, \
+    bindparam, Integer
+from sqlalchemy.dialects.postgresql import insert, BIT, array_agg, ARRAY
 from sqlalchemy.future import select
 
 from restweetution.models.storage.queries import CollectionQuery, TweetFilter
-from restweetution.storages.postgres_jsonb_storage.models import TWEET, RULE_MATCH, MEDIA
-from restweetution.storages.postgres_jsonb_storage.utils import date_from_to, offset_limit, where_in_builder
+from restweetution.storages.postgres_jsonb_storage.models import TWEET, RULE_MATCH, MEDIA, TWEET_MEDIA, \
+    RULE_DAY_COUNT, DOWNLOADED_MEDIA, DOWNLOAD_TASK, MEDIA_HASH
+from restweetution.storages.postgres_jsonb_storage.utils import date_from_to, offset_limit, where_in_builder, \
+    keyset, day_start, next_month
+
+
+def tweet_date_column(query: CollectionQuery):
+    """
+    Column of the date filters of a collection: with rule_ids the denormalized collected_tweet.tweet_created_at,
+    served by ix_collected_tweet_rule_date without joining the tweet table
+    """
+    return RULE_MATCH.c.tweet_created_at if query.rule_ids else TWEET.c.created_at
+
+
+def tweet_match_join(from_=RULE_MATCH, partitioned=False):
+    """
+    Join condition of a tweet and its rule matches
+    @param from_: collected_tweet or an alias of its rows
+    @param partitioned: the tables are partitioned by month, the equal dates let postgres prune the partitions
+    of the other table. Only then is the match date the date of the tweet (part of the primary key)
+    """
+    if partitioned:
+        return and_(from_.c.tweet_id == TWEET.c.id, from_.c.tweet_created_at == TWEET.c.created_at)
+    return from_.c.tweet_id == TWEET.c.id
+
+
+def stmt_media_tweet(collection: CollectionQuery, *columns):
+    """
+    (tweet_id, media_key) pairs of the tweets of a collection, from the tweet_media table
+    @param collection: collection query, offset and limit are not applied
+    @param columns: selected columns, default tweet_id and media_key
+    """
+    if not columns:
+        columns = (TWEET_MEDIA.c.tweet_id, TWEET_MEDIA.c.media_key)
+    stmt = select(*columns)
+
+    from_ = TWEET_MEDIA
+    if collection.rule_ids:
+        from_ = from_.join(RULE_MATCH, RULE_MATCH.c.tweet_id == TWEET_MEDIA.c.tweet_id)
+    elif collection.date_from or collection.date_to:
+        from_ = from_.join(TWEET, TWEET.c.id == TWEET_MEDIA.c.tweet_id)
+    stmt = stmt.select_from(from_)
+
+    if collection.rule_ids:
+        stmt = stmt.where(RULE_MATCH.c.rule_id.in_(collection.rule_ids))
+        if collection.direct_hit:
+            stmt = stmt.where(RULE_MATCH.c.direct_hit.is_(True))
+    stmt = date_from_to(stmt, tweet_date_column(collection), collection.date_from, collection.date_to)
+    return stmt
 
 
 def media_keys_stmt(collection: CollectionQuery):
-    media_keys = select(
-        func.jsonb_array_elements_text(TWEET.c.attachments['media_keys']).label('media_key'),
-    )
-    media_keys = media_keys.select_from(join(RULE_MATCH, TWEET))
-    if collection.rule_ids:
-        media_keys = media_keys.filter(RULE_MATCH.c.rule_id.in_(collection.rule_ids))
-    media_keys = date_from_to(media_keys, TWEET.c.created_at, collection.date_from, collection.date_to)
+    media_keys = stmt_media_tweet(collection, TWEET_MEDIA.c.media_key)
     media_keys = offset_limit(media_keys, collection.offset, collection.limit)
-    media_keys = media_keys.group_by('media_key')
+    media_keys = media_keys.group_by(TWEET_MEDIA.c.media_key)
     media_keys = media_keys.subquery('media_keys')
 
     return media_keys
 
 
 def media_keys_with_tweet_id_stmt(collection: CollectionQuery):
-    media_keys = select(
-        func.string_agg(TWEET.c.id, ',').label('tweet_ids'),
-        func.jsonb_array_elements_text(TWEET.c.attachments['media_keys']).label('media_key'),
+    media_keys = stmt_media_tweet(
+        collection,
+        func.string_agg(distinct(TWEET_MEDIA.c.tweet_id), ',').label('tweet_ids'),
+        TWEET_MEDIA.c.media_key
     )
-    media_keys = media_keys.select_from(join(RULE_MATCH, TWEET))
-    if collection.rule_ids:
-        media_keys = media_keys.filter(RULE_MATCH.c.rule_id.in_(collection.rule_ids))
-    media_keys = date_from_to(media_keys, TWEET.c.created_at, collection.date_from, collection.date_to)
     media_keys = offset_limit(media_keys, collection.offset, collection.limit)
-    media_keys = media_keys.group_by('media_key')
+    media_keys = media_keys.group_by(TWEET_MEDIA.c.media_key)
     media_keys = media_keys.subquery('media_keys')
 
     return media_keys
 
 
-def stmt_query_tweets(query: CollectionQuery, filter_: TweetFilter):
-    stmt = select(
-        func.to_json(text('tweet.*')).label('tweet'),
-        func.json_agg(func.to_json(text('collected_tweet.*'))).label('rule_match')
-    )
+def stmt_has_media(tweet_id=None):
+    """
+    @param tweet_id: column of the tweet id, default tweet.id
+    """
+    tweet_id = TWEET.c.id if tweet_id is None else tweet_id
+    return exists().where(TWEET_MEDIA.c.tweet_id == tweet_id)
+
+
+def agg_rule_matches(from_=RULE_MATCH):
+    """
+    Rule matches of a tweet as parallel arrays, decoded without JSON or composite records:
+    match_rule_ids, match_direct_hits, match_collected_ats
+    @param from_: collected_tweet or an alias of its rows
+    """
+    return [
+        func.array_agg(from_.c.rule_id).label('match_rule_ids'),
+        func.array_agg(from_.c.direct_hit).label('match_direct_hits'),
+        func.array_agg(from_.c.collected_at).label('match_collected_ats')
+    ]
 
-    stmt = stmt.select_from(TWEET.join(RULE_MATCH))
+
+def stmt_query_tweets(query: CollectionQuery, filter_: TweetFilter, partitioned=False):
+    """
+    @param partitioned: the database is partitioned, see tweet_match_join
+    """
+    # typed columns instead of to_json(tweet.*): no JSON encoding in postgres and decoding in python
+    stmt = select(*TWEET.c, *agg_rule_matches())
+
+    stmt = stmt.select_from(TWEET.join(RULE_MATCH, tweet_match_join(partitioned=partitioned)))
 
     stmt = where_in_builder(stmt, True, (RULE_MATCH.c.rule_id, query.rule_ids), (TWEET.c.id, query.tweet_ids))
 
     if query.direct_hit and query.rule_ids:
         stmt = stmt.where(RULE_MATCH.c.direct_hit.is_(True))
     if filter_.media:
-        stmt = stmt.where(func.jsonb_array_length(TWEET.c.attachments['media_keys']) > 0)
+        stmt = stmt.where(stmt_has_media())
+
+    stmt = date_from_to(stmt, tweet_date_column(query), query.date_from, query.date_to)
+    if query.rule_ids and partitioned:
+        # redundant with the match date, prunes the tweet partitions
+        stmt = date_from_to(stmt, TWEET.c.created_at, query.date_from, query.date_to)
+    stmt = offset_limit(stmt, query.offset, query.limit)
+    if query.cursor or query.order:
+        # keyset pagination on (created_at, id), grouping on the same key keeps the index order
+        stmt = keyset(stmt, tweet_keyset_columns(), query.cursor, desc=query.order < 0)
+        stmt = stmt.group_by(TWEET.c.created_at, TWEET.c.id)
+    else:
+        # the primary key of a partitioned tweet table is (id, created_at)
+        stmt = stmt.group_by(TWEET.c.id, TWEET.c.created_at)
+    return stmt
+
+
+def stmt_stream_tweets(query: CollectionQuery, filter_: TweetFilter, partitioned=False):
+    """
+    Tweets of a collection for a streamed export, in the (created_at, id) order
+    No GROUP BY: the collection filter is an EXISTS on collected_tweet and the rule matches of a tweet are a
+    correlated (lateral) subquery, so postgres reads ix_tweet_created_at_id in order and returns the first rows at once
+    @param partitioned: the database is partitioned, see tweet_match_join
+    """
+    match_filters = [tweet_match_join(partitioned=partitioned)]
+    if query.rule_ids:
+        match_filters.append(RULE_MATCH.c.rule_id.in_(query.rule_ids))
+        if query.direct_hit:
+            match_filters.append(RULE_MATCH.c.direct_hit.is_(True))
+
+    # one aggregated row per tweet, the lateral join keeps the tweet order
+    rule_match = select(*agg_rule_matches()).select_from(RULE_MATCH).where(*match_filters).lateral('rule_match')
+
+    stmt = select(*TWEET.c, *rule_match.c)
+    stmt = stmt.select_from(TWEET.join(rule_match, true()))
+    in_collection = select(RULE_MATCH.c.tweet_id).where(*match_filters)
+    if query.rule_ids:
+        # redundant with the tweet date, lets the EXISTS use ix_collected_tweet_rule_date
+        in_collection = date_from_to(in_collection, RULE_MATCH.c.tweet_created_at, query.date_from, query.date_to)
+    stmt = stmt.where(in_collection.exists())
+    stmt = where_in_builder(stmt, True, (TWEET.c.id, query.tweet_ids))
+    if filter_.media:
+        stmt = stmt.where(stmt_has_media())
 
     stmt = date_from_to(stmt, TWEET.c.created_at, query.date_from, query.date_to)
     stmt = offset_limit(stmt, query.offset, query.limit)
-    if query.order < 0:
-        stmt = stmt.order_by(TWEET.c.created_at.desc())
-    elif query.order > 0:
-        stmt = stmt.order_by(TWEET.c.created_at.asc())
-    stmt = stmt.group_by(TWEET.c.id)
+    stmt = keyset(stmt, tweet_keyset_columns(), query.cursor, desc=query.order < 0)
     return stmt
 
 
-def stmt_query_tweets_sample(query: CollectionQuery):
+def tweet_keyset_columns():
+    return [TWEET.c.created_at, TWEET.c.id]
+
+
+def media_keyset_columns():
+    return [MEDIA.c.media_key]
+
+
+def stmt_query_tweets_sample(query: CollectionQuery, partitioned=False):
+    """
+    @param partitioned: the database is partitioned, see tweet_match_join
+    """
 
     stmt_matches = select(RULE_MATCH)
     stmt_matches = where_in_builder(stmt_matches, True, (RULE_MATCH.c.rule_id, query.rule_ids))
-    # stmt_matches = date_from_to(stmt_matches, TWEET.c.created_at, query.date_from, query.date_to)
+    stmt_matches = date_from_to(stmt_matches, RULE_MATCH.c.tweet_created_at, query.date_from, query.date_to)
     if query.direct_hit and query.rule_ids:
         stmt_matches = stmt_matches.where(RULE_MATCH.c.direct_hit.is_(True))
     stmt_matches = offset_limit(stmt_matches, query.offset, query.limit)
     matches = stmt_matches.alias('matches')
 
-    stmt = select(
-        func.to_json(text('tweet.*')).label('tweet'),
-        func.json_agg(func.to_json(text('matches.*'))).label('rule_match')
-    )
+    stmt = select(*TWEET.c, *agg_rule_matches(matches))
 
-    stmt = stmt.select_from(TWEET.join(matches, matches.c.tweet_id == TWEET.c.id))
-    stmt = stmt.group_by(TWEET.c.id)
+    stmt = stmt.select_from(TWEET.join(matches, tweet_match_join(matches, partitioned)))
+    stmt = stmt.group_by(TWEET.c.id, TWEET.c.created_at)
     return stmt
 
 
-def stmt_get_rule_matches(rule_ids: List[int]):
+def stmt_get_rule_matches(rule_ids: List[int] = None, tweet_ids: List[str] = None):
+    """
+    The lookups by tweet_ids alone use ix_collected_tweet_tweet_id
+    """
     stmt = select(RULE_MATCH)
-    if rule_ids:
-        stmt = where_in_builder(stmt, False, (RULE_MATCH.c.rule_id, rule_ids))
+    stmt = where_in_builder(stmt, True, (RULE_MATCH.c.rule_id, rule_ids), (RULE_MATCH.c.tweet_id, tweet_ids))
     return stmt
 
 
 def stmt_query_medias(query: CollectionQuery, filter_: TweetFilter):
-    media_tweet = select(
-        TWEET.c.id.label('tweet_id'),
-        func.jsonb_array_elements_text(TWEET.c.attachments['media_keys']).label('media_key')
-    )
-
-    media_tweet = media_tweet.select_from(TWEET.join(RULE_MATCH, isouter=True))
-
-    if query.rule_ids:
-        media_tweet = where_in_builder(media_tweet, True, (RULE_MATCH.c.rule_id, query.rule_ids))
+    media_tweet = stmt_media_tweet(query).alias('media_tweet')
 
-    if query.direct_hit and query.rule_ids:
-        media_tweet = media_tweet.where(RULE_MATCH.c.direct_hit.is_(True))
-    if filter_.media:
-        media_tweet = media_tweet.where(func.jsonb_array_length(TWEET.c.attachments['media_keys']) > 0)
-
-    media_tweet = date_from_to(media_tweet, TWEET.c.created_at, query.date_from, query.date_to)
-    if query.order < 0:
-        media_tweet = media_tweet.order_by(TWEET.c.created_at.desc())
-    elif query.order > 0:
-        media_tweet = media_tweet.order_by(TWEET.c.created_at.asc())
-
-    media_tweet = media_tweet.alias('media_tweet')
-
-    media_to_tweets = select(media_tweet.c.media_key, func.json_agg(media_tweet.c.tweet_id).label('tweet_ids'))
+    media_to_tweets = select(media_tweet.c.media_key,
+                             func.json_agg(distinct(media_tweet.c.tweet_id)).label('tweet_ids'))
     media_to_tweets = media_to_tweets.group_by(media_tweet.c.media_key)
     media_to_tweets = media_to_tweets.alias('media_to_tweets')
 
@@ -131,68 +221,275 @@ def stmt_query_medias(query: CollectionQuery, filter_: TweetFilter):
     )
     medias = medias.select_from(media_to_tweets.join(MEDIA, media_to_tweets.c.media_key == MEDIA.c.media_key))
     medias = offset_limit(medias, query.offset, query.limit)
+    if query.cursor or query.order:
+        # medias are grouped from the tweets, they are paged on their own key
+        medias = keyset(medias, media_keyset_columns(), query.cursor, desc=query.order < 0)
 
     return medias
 
 
-def stmt_query_count_medias(query: CollectionQuery, filter_: TweetFilter):
-    media_tweet = select(
-        TWEET.c.id.label('tweet_id'),
-        func.jsonb_array_elements_text(TWEET.c.attachments['media_keys']).label('media_key')
-    )
-
-    media_tweet = media_tweet.select_from(TWEET.join(RULE_MATCH, isouter=True))
-
-    if query.rule_ids:
-        media_tweet = where_in_builder(media_tweet, True, (RULE_MATCH.c.rule_id, query.rule_ids))
+def stmt_stream_medias(query: CollectionQuery):
+    """
+    Medias of a collection for a streamed export, in the media_key order, with their downloaded file if any
+    The tweets of a media are a correlated subquery and the collection filter an EXISTS on tweet_media,
+    the rows come in the order of the media primary key without a sort of the whole collection
+    """
+    same_media = TWEET_MEDIA.c.media_key == MEDIA.c.media_key
+    tweet_ids = stmt_media_tweet(query, func.json_agg(distinct(TWEET_MEDIA.c.tweet_id))).where(same_media)
+    in_collection = stmt_media_tweet(query, TWEET_MEDIA.c.tweet_id).where(same_media).exists()
 
-    if query.direct_hit and query.rule_ids:
-        media_tweet = media_tweet.where(RULE_MATCH.c.direct_hit.is_(True))
-    if filter_.media:
-        media_tweet = media_tweet.where(func.jsonb_array_length(TWEET.c.attachments['media_keys']) > 0)
+    medias = select(
+        func.to_json(text('media.*')).label('media'),
+        tweet_ids.scalar_subquery().label('tweet_ids'),
+        DOWNLOADED_MEDIA.c.sha1,
+        DOWNLOADED_MEDIA.c.format
+    )
+    medias = medias.select_from(MEDIA.outerjoin(DOWNLOADED_MEDIA, DOWNLOADED_MEDIA.c.media_key == MEDIA.c.media_key))
+    medias = medias.where(in_collection)
+    medias = offset_limit(medias, query.offset, query.limit)
+    medias = keyset(medias, media_keyset_columns(), query.cursor, desc=query.order < 0)
+    return medias
 
-    media_tweet = date_from_to(media_tweet, TWEET.c.created_at, query.date_from, query.date_to)
-    media_tweet = media_tweet.alias('media_tweet')
 
-    media_to_tweets = select(media_tweet.c.media_key, func.json_agg(media_tweet.c.tweet_id).label('tweet_ids'))
-    media_to_tweets = media_to_tweets.group_by(media_tweet.c.media_key)
-    media_to_tweets = media_to_tweets.alias('media_to_tweets')
+def stmt_query_count_medias(query: CollectionQuery, filter_: TweetFilter):
+    media_keys = stmt_media_tweet(query, TWEET_MEDIA.c.media_key).distinct().alias('media_keys')
 
     medias = select(
         func.count(MEDIA.c.media_key).label('count')
     )
-    medias = medias.select_from(media_to_tweets.join(MEDIA, media_to_tweets.c.media_key == MEDIA.c.media_key))
+    medias = medias.select_from(media_keys.join(MEDIA, media_keys.c.media_key == MEDIA.c.media_key))
     return medias
 
 
 def stmt_query_count_tweets(query: CollectionQuery, filter_: TweetFilter):
-    stmt = select(func.count().label('count'))
-    if query.rule_ids and len(query.rule_ids) > 1:
-        stmt = select(func.count(distinct(TWEET.c.id)).label('count'))
-
-    if query.rule_ids:
-        stmt = stmt.select_from(TWEET.join(RULE_MATCH))
+    """
+    With rule_ids the tweets are counted on collected_tweet only (ix_collected_tweet_rule_date),
+    the date filter is on tweet_date_column
+    """
+    if not query.rule_ids:
+        stmt = select(func.count().label('count')).select_from(TWEET)
+        if filter_.media:
+            stmt = stmt.where(stmt_has_media())
+        return date_from_to(stmt, TWEET.c.created_at, query.date_from, query.date_to)
+
+    if len(query.rule_ids) > 1:
+        stmt = select(func.count(distinct(RULE_MATCH.c.tweet_id)).label('count'))
     else:
-        stmt = stmt.select_from(TWEET)
-
-    if query.rule_ids:
-        stmt = where_in_builder(stmt, True, (RULE_MATCH.c.rule_id, query.rule_ids))
-        if query.direct_hit and query.rule_ids:
-            stmt = stmt.where(RULE_MATCH.c.direct_hit.is_(True))
-
+        stmt = select(func.count().label('count'))
+    stmt = stmt.select_from(RULE_MATCH)
+    stmt = where_in_builder(stmt, True, (RULE_MATCH.c.rule_id, query.rule_ids))
+    if query.direct_hit:
+        stmt = stmt.where(RULE_MATCH.c.direct_hit.is_(True))
     if filter_.media:
-        stmt = stmt.where(func.jsonb_array_length(TWEET.c.attachments['media_keys']) > 0)
+        stmt = stmt.where(stmt_has_media(RULE_MATCH.c.tweet_id))
+
+    stmt = date_from_to(stmt, RULE_MATCH.c.tweet_created_at, query.date_from, query.date_to)
+    return stmt
 
-    stmt = date_from_to(stmt, TWEET.c.created_at, query.date_from, query.date_to)
 
+def stmt_query_count_rule_days(rule_id: int, day_from: datetime.date = None, day_to: datetime.date = None,
+                               direct_hit=False, has_media=False):
+    """
+    Number of tweets of a rule from the rule_day_count aggregate, for the days in [day_from, day_to)
+    """
+    stmt = select(func.coalesce(func.sum(RULE_DAY_COUNT.c.n), 0).label('count'))
+    stmt = stmt.where(RULE_DAY_COUNT.c.rule_id == rule_id)
+    if day_from:
+        stmt = stmt.where(RULE_DAY_COUNT.c.day >= day_from)
+    if day_to:
+        stmt = stmt.where(RULE_DAY_COUNT.c.day < day_to)
+    if direct_hit:
+        stmt = stmt.where(RULE_DAY_COUNT.c.direct_hit.is_(True))
+    if has_media:
+        stmt = stmt.where(RULE_DAY_COUNT.c.has_media.is_(True))
     return stmt
 
 
+def stmt_rebuild_rule_day_count():
+    """
+    Fill rule_day_count from the collected_tweet table
+    """
+    matches = select(
+        RULE_MATCH.c.rule_id,
+        cast(func.timezone('UTC', RULE_MATCH.c.tweet_created_at), Date).label('day'),
+        func.coalesce(RULE_MATCH.c.direct_hit, false()).label('direct_hit'),
+        exists().where(TWEET_MEDIA.c.tweet_id == RULE_MATCH.c.tweet_id).label('has_media')
+    ).subquery('matches')
+    keys = [matches.c.rule_id, matches.c.day, matches.c.direct_hit, matches.c.has_media]
+    counts = select(*keys, func.count()).group_by(*keys)
+    return insert(RULE_DAY_COUNT).from_select(['rule_id', 'day', 'direct_hit', 'has_media', 'n'], counts)
+
+
 def stmt_tweet_media_ids(media_keys: List[str]):
-    table = (
-        select(func.jsonb_array_elements_text(TWEET.c.attachments['media_keys']).label('media_key'), TWEET.c.id)
-        .where(TWEET.c.attachments['media_keys'].has_any(array(tuple(media_keys))))
-        .subquery('tweet_media_ids')
+    stmt = (
+        select(TWEET_MEDIA.c.media_key, func.string_agg(TWEET_MEDIA.c.tweet_id, ',').label('tweet_ids'))
+        .where(TWEET_MEDIA.c.media_key.in_(media_keys))
+        .group_by(TWEET_MEDIA.c.media_key)
+    )
+    return stmt.subquery('tweet_media_ids')
+
+
+def stmt_tweet_ids_with_media_keys(media_keys: List[str]):
+    return select(TWEET_MEDIA.c.tweet_id).where(TWEET_MEDIA.c.media_key.in_(media_keys))
+
+
+def stmt_find_downloaded_medias(media_keys: List[str] = None, urls: List[str] = None):
+    """
+    Downloaded medias with one of the media_keys or one of the urls
+    The two lookups are separate index scans joined by a UNION, an OR across the join would scan it
+    """
+    columns = [MEDIA.c.media_key, MEDIA.c.type, MEDIA.c.url, DOWNLOADED_MEDIA.c.sha1, DOWNLOADED_MEDIA.c.format]
+    from_ = MEDIA.join(DOWNLOADED_MEDIA, DOWNLOADED_MEDIA.c.media_key == MEDIA.c.media_key)
+    stmts = []
+    if media_keys:
+        stmts.append(select(*columns).select_from(from_).where(DOWNLOADED_MEDIA.c.media_key.in_(media_keys)))
+    if urls:
+        stmts.append(select(*columns).select_from(from_).where(MEDIA.c.url.in_(urls)))
+    if len(stmts) == 1:
+        return stmts[0]
+    return union(*stmts)
+
+
+def stmt_claim_download_tasks(queue: str, limit: int, lease: datetime.timedelta, worker_id: str = None):
+    """
+    Claim up to limit tasks ready to download, FOR UPDATE SKIP LOCKED lets concurrent workers claim other rows
+    """
+    ready = (
+        select(DOWNLOAD_TASK.c.media_key)
+        .where(DOWNLOAD_TASK.c.queue == queue,
+               DOWNLOAD_TASK.c.failed.is_(False),
+               DOWNLOAD_TASK.c.next_attempt_at <= func.now(),
+               or_(DOWNLOAD_TASK.c.claimed_at.is_(None), DOWNLOAD_TASK.c.claimed_at < func.now() - lease))
+        .order_by(DOWNLOAD_TASK.c.priority, DOWNLOAD_TASK.c.next_attempt_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
     )
-    stmt = select(table.c.media_key, func.string_agg(table.c.id, ',').label('tweet_ids')).group_by(table.c.media_key)
+    return (
+        update(DOWNLOAD_TASK)
+        .where(DOWNLOAD_TASK.c.media_key.in_(ready.scalar_subquery()))
+        .values(claimed_at=func.now(), claimed_by=worker_id, attempts=DOWNLOAD_TASK.c.attempts + 1)
+        .returning(DOWNLOAD_TASK.c.media_key, DOWNLOAD_TASK.c.priority, DOWNLOAD_TASK.c.attempts)
+    )
+
+
+def stmt_unhashed_photos(limit: int, after: str = None):
+    """
+    (sha1, format) of the downloaded photos without media_hash row, ordered by sha1
+    @param after: keyset, last sha1 of the previous page
+    """
+    stmt = (
+        select(DOWNLOADED_MEDIA.c.sha1, DOWNLOADED_MEDIA.c.format)
+        .distinct(DOWNLOADED_MEDIA.c.sha1)
+        .select_from(DOWNLOADED_MEDIA.join(MEDIA, MEDIA.c.media_key == DOWNLOADED_MEDIA.c.media_key))
+        .where(MEDIA.c.type == 'photo', DOWNLOADED_MEDIA.c.sha1.isnot(None))
+        .where(~exists().where(MEDIA_HASH.c.sha1 == DOWNLOADED_MEDIA.c.sha1))
+        .order_by(DOWNLOADED_MEDIA.c.sha1)
+        .limit(limit)
+    )
+    if after:
+        stmt = stmt.where(DOWNLOADED_MEDIA.c.sha1 > after)
     return stmt
+
+
+def stmt_find_similar_hashes(phash: int, band_variants: List[List[int]], max_distance: int, limit: int):
+    """
+    Media hashes within max_distance of phash, closest first, with the media_keys of their file
+    The candidates are found with the phash_i indexes: one band must be among band_variants[i],
+    the exact distance is computed only on the candidates (bit_count needs postgres >= 14)
+    @param phash: signed perceptual hash
+    @param band_variants: accepted values of each band
+    """
+    distance = func.bit_count(cast(MEDIA_HASH.c.phash.op('#')(phash), BIT(64))).label('distance')
+    bands = [MEDIA_HASH.c.phash_0, MEDIA_HASH.c.phash_1, MEDIA_HASH.c.phash_2, MEDIA_HASH.c.phash_3]
+    candidates = (
+        select(MEDIA_HASH.c.sha1, MEDIA_HASH.c.phash, distance)
+        .where(or_(*[band.in_(variants) for band, variants in zip(bands, band_variants)]))
+        .subquery()
+    )
+    stmt = (
+        select(candidates.c.sha1, candidates.c.phash, candidates.c.distance,
+               array_agg(DOWNLOADED_MEDIA.c.media_key).label('media_keys'))
+        .select_from(candidates.join(DOWNLOADED_MEDIA, DOWNLOADED_MEDIA.c.sha1 == candidates.c.sha1, isouter=True))
+        .where(candidates.c.distance <= max_distance)
+        .group_by(candidates.c.sha1, candidates.c.phash, candidates.c.distance)
+        .order_by(candidates.c.distance)
+        .limit(limit)
+    )
+    return stmt
+
+
+def stmt_index_validity():
+    """
+    (name, valid) of the indexes of the current schema, an interrupted CREATE INDEX CONCURRENTLY leaves an invalid
+    index
+    """
+    return text(
+        'SELECT c.relname AS name, i.indisvalid AS valid FROM pg_index i '
+        'JOIN pg_class c ON c.oid = i.indexrelid '
+        'JOIN pg_namespace n ON n.oid = c.relnamespace '
+        'WHERE n.nspname = current_schema()'
+    )
+
+
+def stmt_partition_keys():
+    """
+    (name, key) of the range partitioned tables of the current schema
+    """
+    return text(
+        'SELECT c.relname AS name, a.attname AS key FROM pg_partitioned_table p '
+        'JOIN pg_class c ON c.oid = p.partrelid '
+        'JOIN pg_namespace n ON n.oid = c.relnamespace '
+        'JOIN pg_attribute a ON a.attrelid = p.partrelid AND a.attnum = p.partattrs[0] '
+        'WHERE n.nspname = current_schema()'
+    )
+
+
+def stmt_lock_rule_days(keys: Iterable[Tuple[int, datetime.date]]):
+    """
+    Transaction advisory locks of the (rule_id, day) keys of rule_day_count, all taken by one statement in the
+    keys order, so that two transactions locking some of the same keys can't deadlock
+    """
+    keys = sorted(set(keys))
+    return text(
+        'SELECT pg_advisory_xact_lock(k.rule_id, k.day) FROM '
+        '(SELECT rule_id, day FROM unnest(CAST(:rule_ids AS integer[]), CAST(:days AS integer[])) AS u(rule_id, day) '
+        'ORDER BY rule_id, day) AS k'
+    ).bindparams(bindparam('rule_ids', [k[0] for k in keys], type_=ARRAY(Integer)),
+                 bindparam('days', [k[1].toordinal() for k in keys], type_=ARRAY(Integer)))
+
+
+def stmt_referencing_foreign_keys(tables: List[str]):
+    """
+    (table_name, name) of the foreign keys to the tables from the other tables of the current schema
+    """
+    return text(
+        'SELECT r.relname AS table_name, c.conname AS name FROM pg_constraint c '
+        'JOIN pg_class r ON r.oid = c.conrelid '
+        'JOIN pg_class f ON f.oid = c.confrelid '
+        'JOIN pg_namespace n ON n.oid = f.relnamespace '
+        "WHERE c.contype = 'f' AND n.nspname = current_schema() AND f.relname IN :tables AND r.relname NOT IN :tables"
+    ).bindparams(bindparam('tables', value=tables, expanding=True))
+
+
+def stmt_table_indexes(table: str):
+    """
+    Names of the indexes of a table of the current schema
+    """
+    return text(
+        'SELECT indexname AS name FROM pg_indexes WHERE schemaname = current_schema() AND tablename = :table'
+    ).bindparams(table=table)
+
+
+def partition_name(table: str, month: datetime.date):
+    return f'{table}_y{month.year}m{month.month:02d}'
+
+
+def stmt_create_partition(table: str, month: datetime.date):
+    """
+    Partition of a UTC month of a table partitioned by month, DDL statements have no bind parameters
+    """
+    bounds = day_start(month).isoformat(), day_start(next_month(month)).isoformat()
+    return text(
+        f'CREATE TABLE IF NOT EXISTS "{partition_name(table, month)}" PARTITION OF "{table}" '
+        f"FOR VALUES FROM ('{bounds[0]}') TO ('{bounds[1]}')"
+    )
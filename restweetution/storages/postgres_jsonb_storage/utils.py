@@ -3,13 +3,18 @@ General Helper functions used to build statements or to convert / search data
 We want to keep specific Table logic out of this file (Don't import TWEET, MEDIA, etc..)
 """
 
+import base64
 import datetime
-from typing import List, Tuple
+import uuid
+from typing import List, Tuple, Any, AsyncIterator
 
 from pydantic import BaseModel
-from sqlalchemy import and_, or_, Table, join
+from sqlalchemy import and_, or_, Table, join, tuple_, literal, TIMESTAMP, any_, bindparam
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.future import select
 
+from restweetution import serializer
+
 
 def primary_keys(table):
     return [k.name for k in table.primary_key]
@@ -74,6 +79,13 @@ def where_in_builder(stmt, is_and=True, *args):
     return stmt.where(connect(*filters))
 
 
+def in_array(column, values: List):
+    """
+    column = ANY(values) with the values bound as a single array, unlike in_ there is no limit on their number
+    """
+    return column == any_(bindparam(None, list(values), type_=ARRAY(column.type)))
+
+
 def date_from_to(stmt, coll, date_from: datetime.datetime = None, date_to: datetime.datetime = None):
     if date_from:
         stmt = stmt.where(coll >= date_from)
@@ -82,9 +94,111 @@ def date_from_to(stmt, coll, date_from: datetime.datetime = None, date_to: datet
     return stmt
 
 
+def to_utc(date: datetime.datetime | None):
+    """
+    Convert to an aware UTC datetime, naive datetimes are considered UTC
+    """
+    if date is None:
+        return None
+    if date.tzinfo is None:
+        return date.replace(tzinfo=datetime.timezone.utc)
+    return date.astimezone(datetime.timezone.utc)
+
+
+def utc_day(date: datetime.datetime) -> datetime.date:
+    return to_utc(date).date()
+
+
+def day_start(day: datetime.date) -> datetime.datetime:
+    return datetime.datetime.combine(day, datetime.time(), tzinfo=datetime.timezone.utc)
+
+
+def month_start(date: datetime.datetime) -> datetime.date:
+    """
+    First day of the UTC month of a date
+    """
+    return utc_day(date).replace(day=1)
+
+
+def next_month(month: datetime.date) -> datetime.date:
+    return (month.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+
+
 def offset_limit(stmt, offset: int = None, limit: int = None):
     if offset:
         stmt = stmt.offset(offset)
     if limit:
         stmt = stmt.limit(limit)
     return stmt
+
+
+def encode_cursor(values: List[Any]) -> str:
+    """
+    Encode the sort key of the last row of a page into an opaque cursor
+    @param values: values of the keyset columns
+    @return: url safe cursor string
+    """
+    return base64.urlsafe_b64encode(serializer.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    try:
+        values = serializer.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception as e:
+        raise ValueError(f'Invalid cursor: {cursor}') from e
+    if not isinstance(values, list):
+        raise ValueError(f'Invalid cursor: {cursor}')
+    return values
+
+
+def keyset(stmt, columns: List, cursor: str = None, desc=False):
+    """
+    Keyset pagination, order the statement by columns and start after the row encoded in the cursor
+    Use with a limit instead of an offset, the columns must be unique together and backed by an index
+    @param stmt: statement
+    @param columns: sort key columns
+    @param cursor: cursor given by encode_cursor, None for the first page
+    @param desc: descending order
+    @return: statement
+    """
+    if cursor:
+        values = decode_cursor(cursor)
+        if len(values) != len(columns):
+            raise ValueError(f'Invalid cursor: {cursor}')
+        values = [
+            datetime.datetime.fromisoformat(v) if v is not None and isinstance(c.type, TIMESTAMP) else v
+            for c, v in zip(columns, values)
+        ]
+        key = tuple_(*columns)
+        last = tuple_(*[literal(v, c.type) for c, v in zip(columns, values)])
+        stmt = stmt.where(key < last if desc else key > last)
+
+    stmt = stmt.order_by(*[c.desc() if desc else c.asc() for c in columns])
+    return stmt
+
+
+async def server_cursor(conn, stmt, chunk_size: int, fetch_size: int = None) -> AsyncIterator[List]:
+    """
+    Stream the rows of a statement through a named cursor (DECLARE ... CURSOR / FETCH)
+    Unlike a protocol level portal, a declared cursor is planned for a fast start (cursor_tuple_fraction),
+    ex: an ordered statement reads the index instead of sorting the whole result
+    Must be called inside a transaction, the cursor is closed with the transaction
+    @param conn: AsyncConnection in a transaction
+    @param stmt: select statement
+    @param chunk_size: rows of a yielded chunk
+    @param fetch_size: rows of a FETCH round trip, default chunk_size
+    @return: chunks of rows
+    """
+    fetch_size = max(fetch_size or chunk_size, chunk_size)
+    compiled = stmt.compile(dialect=conn.dialect, compile_kwargs={'render_postcompile': True})
+    params = compiled.construct_params()
+    name = f'cursor_{uuid.uuid4().hex}'
+    await conn.exec_driver_sql(f'DECLARE {name} NO SCROLL CURSOR FOR {compiled.string}',
+                               tuple(params[k] for k in compiled.positiontup))
+    while True:
+        res = await conn.exec_driver_sql(f'FETCH FORWARD {fetch_size} FROM {name}')
+        rows = res.fetchall()
+        for i in range(0, len(rows), chunk_size):
+            yield rows[i:i + chunk_size]
+        if len(rows) < fetch_size:
+            return
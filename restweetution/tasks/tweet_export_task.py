@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import time
 
 from restweetution import data_view
 from restweetution.data_view.view_exporter import ViewExporter
@@ -25,6 +26,7 @@ class ViewExportTask(ServerTask):
         self.exporter = exporter
         self.view_type = query.query.view_type
         view = data_view.get_view(query.query.view_type)
+        self.view = view
         self.view_exporter = ViewExporter(view=view, exporter=exporter)
         self.key = query.key
 
@@ -41,6 +43,25 @@ class ViewExportTask(ServerTask):
         else:
             raise ValueError(f'<<{self.view_type}>> view is not valid')
 
+        await self.exporter.begin_export(self.key)
+        start = time.perf_counter()
+        try:
+            await self._export_chunks(storage_stream_function)
+        finally:
+            try:
+                await self.exporter.end_export(self.key)
+            except Exception as e:
+                # keep the error of the export if any
+                logger.error(f'Failed to end the export {self.key}: {e}', exc_info=True)
+            exported = self.result.get('docs', 0)
+            seconds = time.perf_counter() - start
+            self.result['seconds'] = round(seconds, 2)
+            self.result['docs_per_second'] = round(exported / seconds) if seconds else 0
+            logger.info(f'Exported {exported} docs to {self.key} in {seconds:.1f}s '
+                        f'({self.result["docs_per_second"]} docs/s)')
+
+    async def _export_chunks(self, storage_stream_function):
+        self.result['docs'] = 0
         async for res in storage_stream_function(self.query.query.collection, chunk_size=1000):
             try:
                 coll = StorageCollection(self.storage, res)
@@ -55,6 +76,7 @@ class ViewExportTask(ServerTask):
                 view = coll.build_view(self.view_type, self.query.fields)
                 datas = [CustomData(key=self.key, id=d.id(), data=d) for d in view.view]
                 await self.exporter.save_custom_datas(datas)
+                self.result['docs'] += len(datas)
 
                 self._progress += count
             except Exception as e:
@@ -80,8 +102,17 @@ class ViewExportFileTask(ViewExportTask):
 
     async def _task_routine(self):
         await self.exporter.clear_key(self.key)
-        fields = self.query.fields
-        data = CustomData(key=self.key, id='id', data={f: f for f in fields})
-        await self.exporter.save_custom_datas([data])
-        await super()._task_routine()
-        self.result['path'] = (self.exporter.get_root() / self.key).__str__()
+        # the header is the first row of the export session, it fixes the columns order
+        await self.exporter.begin_export(self.key)
+        try:
+            # no fields is every field of the view, like the rows
+            fields = self.view.all_if_empty(self.query.fields)
+            data = CustomData(key=self.key, id='id', data={f: f for f in fields})
+            await self.exporter.save_custom_datas([data])
+            await super()._task_routine()
+        finally:
+            try:
+                await self.exporter.end_export(self.key)
+            except Exception as e:
+                logger.error(f'Failed to end the export {self.key}: {e}', exc_info=True)
+        self.result['path'] = self.exporter.get_path(self.key).__str__()
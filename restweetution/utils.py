@@ -1,7 +1,9 @@
 import asyncio
-import json
+from collections import OrderedDict
 from typing import Dict, List
 
+from restweetution import serializer
+
 
 class AsyncEvent(set):
     """
@@ -21,6 +23,29 @@ class AsyncEvent(set):
         return "AsyncEvent(%s)" % list.__repr__(self)
 
 
+class LRUCache(OrderedDict):
+    """
+    Dictionary keeping the maxsize most recently used keys
+    ex: cache.put(key, value), cache.get(key)
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def put(self, key, value):
+        self[key] = value
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
 class Event(set):
     """
     Event utility class
@@ -74,7 +99,7 @@ def safe_json(data: Dict):
     @param data: Dictionary
     @return: JSON string
     """
-    return json.dumps(data, default=str)
+    return serializer.dumps(data)
 
 
 def safe_dict(data):
@@ -83,7 +108,7 @@ def safe_dict(data):
     @param data: Dictionary
     @return: Dictionary
     """
-    return json.loads(safe_json(data))
+    return serializer.loads(serializer.dumps(data))
 
 
 def chunks(arr, n):
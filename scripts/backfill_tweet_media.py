@@ -0,0 +1,20 @@
+import asyncio
+import logging
+import os
+
+from restweetution import config_loader
+
+logging.basicConfig()
+logging.root.setLevel(logging.INFO)
+
+sys_conf = config_loader.load_system_config(os.getenv('SYSTEM_CONFIG'))
+
+
+async def async_main():
+    storage = sys_conf.build_storage()
+    await storage.ensure_indexes()
+    total = await storage.backfill_tweet_media()
+    print(f'tweet_media filled from {total} tweets')
+
+
+asyncio.run(async_main())
@@ -0,0 +1,100 @@
+"""
+Compare the decoding of the exported tweet rows: to_json(tweet.*) rows (legacy) and typed columns
+with the rule matches as an array of collected_tweet records (query_tweets_stream)
+usage: python scripts/bench_export.py database_url [n_tweets]
+the database is filled with generated tweets, each tweet is matched by RULES rules
+WARNING: the tables of this database are dropped, use a scratch database
+"""
+import asyncio
+import datetime
+import sys
+import time
+
+from bench_json import sample_line
+from sqlalchemy import func, text, exists
+from sqlalchemy.future import select
+
+from restweetution.collectors.stream_parser import parse_stream_line_rows
+from restweetution.models.linked.linked_bulk_data import LinkedBulkData
+from restweetution.models.rule import Rule, RuleMatch
+from restweetution.models.storage.queries import CollectionQuery
+from restweetution.models.twitter import Tweet
+from restweetution.storages.postgres_jsonb_storage.bulk_rows import BulkRows
+from restweetution.storages.postgres_jsonb_storage.models import TWEET, RULE_MATCH
+from restweetution.storages.postgres_jsonb_storage.postgres_jsonb_storage import PostgresJSONBStorage, \
+    STREAM_FETCH_SIZE
+from restweetution.storages.postgres_jsonb_storage.subqueries import tweet_keyset_columns
+from restweetution.storages.postgres_jsonb_storage.utils import server_cursor, keyset
+
+BATCH_SIZE = 500
+CHUNK_SIZE = 1000
+RULES = 3
+
+
+def build_rows(lines, rule_ids):
+    bulk_rows = BulkRows()
+    collected_at = datetime.datetime.now(tz=datetime.timezone.utc)
+    for line in lines:
+        rows_res = parse_stream_line_rows(line)
+        rows_res.rows.add_rule_matches(rule_ids, [rows_res.tweet_id], collected_at, direct_hit=True)
+        bulk_rows += rows_res.rows
+    return bulk_rows
+
+
+def json_stream_stmt(rule_ids):
+    """
+    Statement of query_tweets_stream with the rows serialized by to_json
+    """
+    match_filters = [RULE_MATCH.c.tweet_id == TWEET.c.id, RULE_MATCH.c.rule_id.in_(rule_ids)]
+    rule_match = select(func.json_agg(func.to_json(text('collected_tweet.*'))))
+    rule_match = rule_match.select_from(RULE_MATCH).where(*match_filters)
+    stmt = select(func.to_json(text('tweet.*')).label('tweet'), rule_match.scalar_subquery().label('rule_match'))
+    stmt = stmt.select_from(TWEET).where(exists().where(*match_filters))
+    return keyset(stmt, tweet_keyset_columns())
+
+
+async def json_stream(storage: PostgresJSONBStorage, rule_ids):
+    async with storage.get_engine().begin() as conn:
+        async for res in server_cursor(conn, json_stream_stmt(rule_ids), CHUNK_SIZE, STREAM_FETCH_SIZE):
+            data = LinkedBulkData()
+            data.add_tweets([Tweet(**r.tweet) for r in res])
+            data.add_rule_matches([RuleMatch(**m) for r in res if r.rule_match for m in r.rule_match])
+            yield data
+
+
+async def bench_stream(name, stream, n):
+    old = time.perf_counter()
+    first = None
+    tweets = 0
+    matches = 0
+    async for data in stream:
+        if first is None:
+            first = time.perf_counter() - old
+        tweets += len(data.tweets)
+        matches += len(data.get_rule_matches())
+    elapsed = time.perf_counter() - old
+    print(f'{name:<30} {tweets / elapsed:>10.0f} tweets/s  first chunk {first:.3f}s  '
+          f'{tweets}/{n} tweets  {matches} matches')
+
+
+async def main():
+    url = sys.argv[1]
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    storage = PostgresJSONBStorage(url)
+    await storage.reset_database()
+    rules = await storage.request_rules([Rule(query=f'bench{i}', tag=f'bench{i}') for i in range(RULES)])
+    rule_ids = [r.id for r in rules]
+    lines = [sample_line(i) for i in range(n)]
+    for i in range(0, n, BATCH_SIZE):
+        await storage.save_bulk(build_rows(lines[i:i + BATCH_SIZE], rule_ids))
+    print(f'{n} tweets, {RULES} rule matches per tweet, chunks of {CHUNK_SIZE}')
+
+    query = CollectionQuery(rule_ids=rule_ids)
+    await bench_stream('to_json rows', json_stream(storage, rule_ids), n)
+    await bench_stream('typed rows', storage.query_tweets_stream(query, chunk_size=CHUNK_SIZE), n)
+    await storage.get_engine().dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,104 @@
+"""
+Compare the ingestion of stream lines with the pydantic models (BulkData) and with the rows parser (BulkRows)
+usage: python scripts/bench_ingestion.py [lines_file] [database_url]
+lines_file contains one stream response per line, without file (or with '') generated tweet responses are used
+with a database_url (postgresql+asyncpg://...) the save_bulk time is measured too
+WARNING: the tables of this database are dropped, use a scratch database
+"""
+import asyncio
+import datetime
+import sys
+import time
+
+from bench_json import sample_line
+
+from restweetution.collectors.response_parser import parse_includes
+from restweetution.collectors.stream_parser import parse_stream_line, parse_stream_line_rows
+from restweetution.models.bulk_data import BulkData
+from restweetution.models.rule import Rule
+from restweetution.storages.postgres_jsonb_storage.bulk_rows import BulkRows
+from restweetution.storages.postgres_jsonb_storage.postgres_jsonb_storage import PostgresJSONBStorage
+
+BATCH_SIZE = 500
+RULE_ID = 1
+
+
+def build_models(lines):
+    bulk_data = BulkData()
+    collected_at = datetime.datetime.now()
+    for line in lines:
+        tweet_res = parse_stream_line(line)
+        data = BulkData()
+        data.add_tweets([tweet_res.data])
+        data.add(**parse_includes(tweet_res.includes))
+        rule = Rule(id=RULE_ID, tag='bench')
+        rule.add_direct_tweets([tweet_res.data.id], collected_at)
+        if tweet_res.includes and tweet_res.includes.tweets:
+            rule.add_includes_tweets([t.id for t in tweet_res.includes.tweets], collected_at)
+        data.add_rules([rule])
+        bulk_data += data
+    # values given to the insert statements by save_bulk
+    for items in [bulk_data.tweets, bulk_data.users, bulk_data.medias, bulk_data.polls, bulk_data.places]:
+        [m.dict() for m in items.values()]
+    return bulk_data
+
+
+def build_rows(lines):
+    bulk_rows = BulkRows()
+    collected_at = datetime.datetime.now()
+    for line in lines:
+        rows_res = parse_stream_line_rows(line)
+        rows_res.rows.add_rule_matches([RULE_ID], [rows_res.tweet_id], collected_at, direct_hit=True)
+        rows_res.rows.add_rule_matches([RULE_ID], rows_res.include_tweet_ids, collected_at)
+        bulk_rows += rows_res.rows
+    for table_rows in bulk_rows.tables.values():
+        table_rows.get_dicts()
+    return bulk_rows
+
+
+def batches(lines):
+    return [lines[i:i + BATCH_SIZE] for i in range(0, len(lines), BATCH_SIZE)]
+
+
+def bench_parse(name, build, lines):
+    old = time.perf_counter()
+    for batch in batches(lines):
+        build(batch)
+    elapsed = time.perf_counter() - old
+    print(f'{name:<30} {len(lines) / elapsed:>10.0f} tweets/s')
+
+
+async def bench_save(url, name, build, lines, mode):
+    storage = PostgresJSONBStorage(url)
+    await storage.reset_database()
+    await storage.request_rules([Rule(query='bench', tag='bench')])
+
+    built = [build(batch) for batch in batches(lines)]
+    old = time.perf_counter()
+    for data in built:
+        await storage.save_bulk(data, mode=mode)
+    elapsed = time.perf_counter() - old
+    print(f'{name + " save " + mode:<30} {len(lines) / elapsed:>10.0f} tweets/s')
+    await storage.get_engine().dispose()
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1]:
+        with open(sys.argv[1], 'rb') as f:
+            lines = [line for line in f if line.strip()]
+    else:
+        lines = [sample_line(i) for i in range(20000)]
+    url = sys.argv[2] if len(sys.argv) > 2 else None
+
+    print(f'{len(lines)} lines, batches of {BATCH_SIZE}')
+    bench_parse('pydantic parse + build', build_models, lines)
+    bench_parse('rows parse + build', build_rows, lines)
+
+    if url:
+        for mode in ['insert', 'copy']:
+            asyncio.run(bench_save(url, 'pydantic', build_models, lines, mode))
+            asyncio.run(bench_save(url, 'rows', build_rows, lines, mode))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Compare the JSON backends of restweetution.serializer on recorded stream lines
+usage: python scripts/bench_json.py [lines_file] [repeat]
+lines_file contains one stream response per line, as sent by the Twitter Stream API
+without file a generated tweet response is used
+"""
+import sys
+import time
+
+from restweetution import serializer
+from restweetution.collectors.stream_parser import parse_stream_line
+
+
+def sample_line(i):
+    user = {'id': str(1000 + i), 'name': f'user {i}', 'username': f'user{i}', 'created_at': '2015-01-01T00:00:00.000Z',
+            'public_metrics': {'followers_count': 10, 'following_count': 20, 'tweet_count': 30, 'listed_count': 0},
+            'description': 'some description ' * 5, 'verified': False}
+    tweet = {'id': str(i), 'text': f'tweet {i} ' + 'some text #hashtag @mention https://t.co/abc ' * 4,
+             'author_id': user['id'], 'created_at': '2023-01-01T00:00:00.000Z', 'lang': 'fr',
+             'conversation_id': str(i), 'possibly_sensitive': False, 'reply_settings': 'everyone',
+             'public_metrics': {'retweet_count': 1, 'reply_count': 2, 'like_count': 3, 'quote_count': 4},
+             'entities': {'hashtags': [{'start': 10, 'end': 18, 'tag': 'hashtag'}],
+                          'mentions': [{'start': 20, 'end': 28, 'username': 'mention'}]},
+             'attachments': {'media_keys': [f'3_{i}']}}
+    media = {'media_key': f'3_{i}', 'type': 'photo', 'url': f'https://pbs.twimg.com/media/{i}.jpg',
+             'width': 1200, 'height': 800}
+    res = {'data': tweet, 'includes': {'users': [user], 'media': [media]},
+           'matching_rules': [{'id': '1600000000000000000', 'tag': 'bench'}]}
+    return (serializer.get_backend().dumps(res) + '\r\n').encode()
+
+
+def bench(name, func, items, repeat):
+    best = None
+    for _ in range(repeat):
+        old = time.perf_counter()
+        for item in items:
+            func(item)
+        elapsed = time.perf_counter() - old
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{name:<30} {len(items) / best:>12.0f} lines/s  {best / len(items) * 1e6:>8.2f} us/line')
+
+
+def main():
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as f:
+            lines = [line for line in f if line.strip()]
+    else:
+        lines = [sample_line(i) for i in range(10000)]
+
+    print(f'{len(lines)} lines, {sum(len(line) for line in lines) / len(lines):.0f} bytes/line, best of {repeat}')
+
+    for name in serializer.BACKENDS:
+        try:
+            backend = serializer.set_backend(name)
+        except ImportError:
+            print(f'{name:<30} not installed')
+            continue
+
+        bench(f'{name} loads', backend.loads, lines, repeat)
+        data = [backend.loads(line) for line in lines]
+        bench(f'{name} dumps', backend.dumps, data, repeat)
+        # full stream parsing: decode, loads and pydantic validation
+        bench(f'{name} parse_stream_line', parse_stream_line, lines, repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Scaling of BulkData.get_rule_matches, from 1k to 1M matches
+The time per match must stay flat, the old sum(.., []) aggregation is quadratic and is only run on small sizes
+usage: python scripts/bench_rule_matches.py
+"""
+import time
+from datetime import datetime
+
+from restweetution.models.bulk_data import BulkData
+from restweetution.models.rule import RuleMatch
+
+RULES = 3
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+LEGACY_MAX_SIZE = 30_000
+
+
+def build_bulk_data(n_matches: int):
+    bulk_data = BulkData()
+    collected_at = datetime.now()
+    # construct skips validation, only the aggregation is measured
+    bulk_data.add_rule_matches([
+        RuleMatch.construct(tweet_id=str(i // RULES), rule_id=i % RULES, collected_at=collected_at, direct_hit=True)
+        for i in range(n_matches)
+    ])
+    return bulk_data
+
+
+def legacy_get_rule_matches(bulk_data: BulkData):
+    return sum([list(match_list.values()) for match_list in bulk_data.rule_matches.values()], [])
+
+
+def timed(func, *args):
+    old = time.perf_counter()
+    res = func(*args)
+    return time.perf_counter() - old, res
+
+
+def main():
+    print(f'{"matches":>10} {"chain (s)":>12} {"ns/match":>10} {"legacy (s)":>12} {"ns/match":>10}')
+    for size in SIZES:
+        bulk_data = build_bulk_data(size)
+        elapsed, res = timed(bulk_data.get_rule_matches)
+        assert len(res) == size
+
+        legacy = ''
+        if size <= LEGACY_MAX_SIZE:
+            legacy_elapsed, legacy_res = timed(legacy_get_rule_matches, bulk_data)
+            assert len(legacy_res) == size
+            legacy = f'{legacy_elapsed:>12.4f} {legacy_elapsed / size * 1e9:>10.0f}'
+        print(f'{size:>10} {elapsed:>12.4f} {elapsed / size * 1e9:>10.0f} {legacy}')
+
+
+if __name__ == '__main__':
+    main()
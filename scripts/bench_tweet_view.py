@@ -0,0 +1,198 @@
+"""
+Compare the former row by row TweetView2 computation with the compiled TweetViewPlan
+usage: python scripts/bench_tweet_view.py [n_tweets] [repeat]
+Generated tweets with users, medias, downloaded medias and rule matches, all the view fields are computed
+"""
+import datetime
+import sys
+import time
+from typing import List
+
+from restweetution.data_view.data_view2 import ViewDict, get_safe_set, get_any_field
+from restweetution.data_view.tweet_view2 import TweetView2, TweetViewPlan, ID, TEXT, MEDIA_KEYS, MEDIA_SHA1S, \
+    MEDIA_FORMAT, MEDIA_TYPES, MEDIA_FILES, POLL_IDS, AUTHOR_ID, AUTHOR_USERNAME, CONTEXT_DOMAINS, CONTEXT_ENTITIES, \
+    CONVERSATION_ID, CREATED_AT, ANNOTATIONS, CASHTAGS, HASHTAGS, MENTIONS, URLS, COORDINATES, PLACE_ID, \
+    IN_REPLY_TO_USER_ID, IN_REPLY_TO_USERNAME, LANG, POSSIBLY_SENSITIVE, RETWEET_COUNT, REPLY_COUNT, LIKE_COUNT, \
+    QUOTE_COUNT, REFERENCED_TWEETS_TYPES, REFERENCED_TWEETS_IDS, REPLY_SETTINGS, SOURCE, WITHHELD_COPYRIGHT, \
+    WITHHELD_COUNTRY_CODES, WITHHELD_SCOPE, RULE_TAGS, DIRECT_HIT
+from restweetution.downloaders.media_store import relative_path
+from restweetution.models.linked.linked_bulk_data import LinkedBulkData
+from restweetution.models.linked.linked_tweet import LinkedTweet
+from restweetution.models.rule import Rule, RuleMatch
+from restweetution.models.storage.downloaded_media import DownloadedMedia
+from restweetution.models.twitter import Tweet, User, Media
+
+
+def tweet_to_view(link_tweet: LinkedTweet, fields: List[str]):
+    """
+    Row by row computation of the former TweetView2, reference of the TweetViewPlan columns
+    """
+    tweet = link_tweet.tweet
+    res = ViewDict(id_=tweet.id)
+
+    # set default value
+    [res.update({f: None}) for f in fields]
+    # utility functions to avoid writing if statement in front of every assignement
+    # safe_set only sets value if the field is present in the arguments
+    # any_ tests if any of the fields are present in the arguments
+    safe_set = get_safe_set(res, fields)
+    any_ = get_any_field(fields)
+
+    safe_set(ID, tweet.id)
+    safe_set(TEXT, tweet.text)
+    safe_set(CREATED_AT, tweet.created_at)
+    safe_set(CONVERSATION_ID, tweet.conversation_id)
+
+    if tweet.attachments and tweet.attachments.poll_ids:
+        safe_set(POLL_IDS, tweet.attachments.poll_ids)
+
+    medias = link_tweet.get_media()
+    if medias:
+        safe_set(MEDIA_KEYS, [m.media.media_key for m in medias])
+        safe_set(MEDIA_TYPES, [m.media.type for m in medias])
+
+        safe_set(MEDIA_SHA1S, [m.downloaded.sha1 for m in medias if m.downloaded])
+        safe_set(MEDIA_FILES, [relative_path(m.downloaded.sha1, m.downloaded.format) for m in medias if m.downloaded])
+        safe_set(MEDIA_FORMAT, [m.downloaded.format for m in medias if m.downloaded])
+
+    author = link_tweet.get_author_user()
+    if author:
+        safe_set(AUTHOR_ID, author.id)
+        safe_set(AUTHOR_USERNAME, author.username)
+
+    if any_(CONTEXT_DOMAINS, CONTEXT_ENTITIES):
+        if tweet.context_annotations:
+            domains = [c.domain.name for c in tweet.context_annotations]
+            entities = [c.entity.name for c in tweet.context_annotations]
+            safe_set(CONTEXT_DOMAINS, domains)
+            safe_set(CONTEXT_ENTITIES, entities)
+
+    if tweet.get_annotations():
+        safe_set(ANNOTATIONS, [a.normalized_text for a in tweet.get_annotations()])
+    if tweet.get_cashtags():
+        safe_set(CASHTAGS, [t.tag for t in tweet.get_cashtags()])
+    if tweet.get_hashtags():
+        safe_set(HASHTAGS, [t.tag for t in tweet.get_hashtags()])
+    if tweet.get_mentions():
+        safe_set(MENTIONS, [t.username for t in tweet.get_mentions()])
+    if tweet.get_urls():
+        safe_set(URLS, [t.url for t in tweet.get_urls()])
+
+    if tweet.geo:
+        if tweet.geo.coordinates:
+            safe_set(COORDINATES, tweet.geo.coordinates.coordinates)
+        safe_set(PLACE_ID, tweet.geo.place_id)
+
+    if tweet.in_reply_to_user_id:
+        replied_user = link_tweet.get_replied_user()
+        safe_set(IN_REPLY_TO_USER_ID, replied_user.id)
+        safe_set(IN_REPLY_TO_USERNAME, replied_user.username)
+
+    safe_set(LANG, tweet.lang)
+    safe_set(POSSIBLY_SENSITIVE, tweet.possibly_sensitive)
+
+    if tweet.public_metrics:
+        safe_set(RETWEET_COUNT, tweet.public_metrics.retweet_count)
+        safe_set(REPLY_COUNT, tweet.public_metrics.reply_count)
+        safe_set(LIKE_COUNT, tweet.public_metrics.like_count)
+        safe_set(QUOTE_COUNT, tweet.public_metrics.quote_count)
+
+    if tweet.referenced_tweets:
+        tweet_types = [t.type for t in tweet.referenced_tweets]
+        tweet_ids = [t.id for t in tweet.referenced_tweets]
+        safe_set(REFERENCED_TWEETS_TYPES, tweet_types)
+        safe_set(REFERENCED_TWEETS_IDS, tweet_ids)
+
+        # if any_field(REFERENCED_TWEETS_AUTHOR_IDS, REFERENCED_TWEETS_AUTHOR_USERNAMES):
+        #     tweets = [bulk_data.tweets[i] for i in tweet_ids if i in bulk_data.tweets]
+        #     author_ids = [t.author_id for t in tweets if t.author_id]
+        #     authors = [bulk_data.users[i] for i in author_ids if i in bulk_data.users]
+        #     author_usernames = [a.username for a in authors if a.username]
+        #
+        #     safe_set(REFERENCED_TWEETS_AUTHOR_IDS, author_ids)
+        #     safe_set(REFERENCED_TWEETS_AUTHOR_USERNAMES, author_usernames)
+
+    safe_set(REPLY_SETTINGS, tweet.reply_settings)
+    safe_set(SOURCE, tweet.source)
+
+    if tweet.withheld:
+        safe_set(WITHHELD_COPYRIGHT, tweet.withheld.copyright)
+        safe_set(WITHHELD_SCOPE, tweet.withheld.scope)
+        safe_set(WITHHELD_COUNTRY_CODES, tweet.withheld.country_codes)
+
+    rules = link_tweet.get_rules()
+    if rules and any_(RULE_TAGS, DIRECT_HIT):
+        tags = set()
+        direct_hit = False
+        for r in rules:
+            tags.update(r.tag.split(','))
+        safe_set(RULE_TAGS, list(tags))
+
+        for m in link_tweet.get_rule_matches():
+            direct_hit |= m.direct_hit
+
+        safe_set(DIRECT_HIT, direct_hit)
+    return res
+
+
+def sample_data(n: int):
+    data = LinkedBulkData()
+    now = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+    data.add_users([User(id=str(i), username=f'user{i}', name=f'user {i}') for i in range(1000)])
+    data.add_rules([Rule(id=1, tag='bench,test', query='bench'), Rule(id=2, tag='other', query='other')])
+    tweets, medias, downloaded, matches = [], [], [], []
+    for i in range(n):
+        keys = [f'3_{i}'] if i % 3 == 0 else []
+        tweets.append(Tweet(id=str(i), text=f'tweet {i} #hashtag @mention', author_id=str(i % 1000),
+                            created_at=now + datetime.timedelta(seconds=i), lang='fr', conversation_id=str(i),
+                            in_reply_to_user_id=str((i + 1) % 1000) if i % 5 == 0 else None,
+                            attachments={'media_keys': keys} if keys else None,
+                            entities={'hashtags': [{'start': 10, 'end': 18, 'tag': 'hashtag'}],
+                                      'mentions': [{'start': 20, 'end': 28, 'username': 'mention'}]},
+                            public_metrics={'retweet_count': 1, 'reply_count': 2, 'like_count': 3, 'quote_count': 4},
+                            referenced_tweets=[{'type': 'quoted', 'id': str(i + 1)}] if i % 4 == 0 else None))
+        for key in keys:
+            medias.append(Media(media_key=key, type='photo', url=f'https://pbs.twimg.com/media/{i}.jpg'))
+            downloaded.append(DownloadedMedia(media_key=key, sha1=f'{i:040x}', format='jpg'))
+        matches.append(RuleMatch(tweet_id=str(i), rule_id=1 + i % 2, direct_hit=i % 2 == 0))
+    data.add_tweets(tweets)
+    data.add_medias(medias)
+    data.add_downloaded_medias(downloaded)
+    data.add_rule_matches(matches)
+    return data.get_linked_tweets()
+
+
+def bench(name, func, n, repeat):
+    best = None
+    for _ in range(repeat):
+        old = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - old
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{name:<30} {n / best:>12.0f} rows/s  {best / n * 1e6:>8.2f} us/row')
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    linked = sample_data(n)
+    print(f'{len(linked)} tweets, best of {repeat}')
+
+    for fields in [TweetView2.get_fields(), TweetView2.get_default_fields()]:
+        print(f'{len(fields)} fields')
+        plan = TweetViewPlan(fields)
+        expected = [tweet_to_view(t, fields) for t in linked]
+        # sets (rule_tags) have no order
+        rows = [{k: sorted(v) if k == 'rule_tags' and v else v for k, v in r.items()} for r in expected]
+        computed = [{k: sorted(v) if k == 'rule_tags' and v else v for k, v in r.items()}
+                    for r in TweetView2.compute(linked, fields).view]
+        print(f'{"same rows":<30} {rows == computed}')
+
+        bench('row by row', lambda: [tweet_to_view(t, fields) for t in linked], n, repeat)
+        bench('plan compute_columns', lambda: plan.compute_columns(linked), n, repeat)
+        bench('plan compute_rows', lambda: plan.compute_rows(linked), n, repeat)
+        bench('TweetView2.compute', lambda: TweetView2.compute(linked, fields), n, repeat)
+
+
+if __name__ == '__main__':
+    main()
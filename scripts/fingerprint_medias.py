@@ -0,0 +1,28 @@
+import asyncio
+import logging
+import os
+from pathlib import Path
+
+from restweetution import config_loader
+from restweetution.downloaders.media_fingerprinter import MediaFingerprinter
+
+logging.basicConfig()
+logging.root.setLevel(logging.INFO)
+
+sys_conf = config_loader.load_system_config(os.getenv('SYSTEM_CONFIG'))
+
+
+async def async_main():
+    storage = sys_conf.build_storage()
+    await storage.ensure_indexes()
+    workers = sys_conf.downloader.fingerprint_workers if sys_conf.downloader else os.cpu_count()
+    fingerprinter = MediaFingerprinter(root=str(Path(sys_conf.media_dir_path) / 'photo'), storage=storage,
+                                       workers=max(workers, 1))
+    try:
+        total = await fingerprinter.hash_backlog()
+    finally:
+        await fingerprinter.close()
+    print(f'{total} photos hashed')
+
+
+asyncio.run(async_main())
@@ -14,6 +14,7 @@ from os import listdir
 from os.path import isfile, join
 
 tweet_dir = '/home/felixalie/collectes_twitter/IVG/tweets'
+batch_size = 5000
 
 tag_to_rule = {
     'ZM': 78,
@@ -58,12 +59,17 @@ async def launch():
 
     base = Path(tweet_dir)
 
+    bulk = BulkData()
     for file in files:
         created_at = datetime.datetime.fromtimestamp(os.path.getctime(base/file))
         with open(base / file, 'r') as f:
             data = json.load(f)
             resp = TweetResponse(**data)
-            bulk = parse_data(resp, created_at)
-            await storage.save_bulk(bulk)
+            bulk += parse_data(resp, created_at)
+        if len(bulk.tweets) >= batch_size:
+            await storage.save_bulk(bulk, mode='copy')
+            bulk = BulkData()
+    if bulk.tweets:
+        await storage.save_bulk(bulk, mode='copy')
 
 asyncio.run(launch())
@@ -0,0 +1,26 @@
+import asyncio
+import logging
+import os
+from pathlib import Path
+
+from restweetution import config_loader
+from restweetution.downloaders.media_store import MediaStore
+
+logging.basicConfig()
+logging.root.setLevel(logging.INFO)
+
+sys_conf = config_loader.load_system_config(os.getenv('SYSTEM_CONFIG'))
+
+
+async def async_main():
+    # move the <sha1>.<ext> files of the media folders to the sharded layout of the MediaStore
+    root = Path(sys_conf.media_dir_path)
+    for media_type in ['photo', 'video', 'gif']:
+        folder = root / media_type
+        if not folder.exists():
+            continue
+        moved = await MediaStore(folder).migrate()
+        print(f'{media_type}: {len(moved)} files moved')
+
+
+asyncio.run(async_main())
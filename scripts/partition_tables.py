@@ -0,0 +1,20 @@
+import asyncio
+import logging
+import os
+
+from restweetution import config_loader
+
+logging.basicConfig()
+logging.root.setLevel(logging.INFO)
+
+sys_conf = config_loader.load_system_config(os.getenv('SYSTEM_CONFIG'))
+
+
+async def async_main():
+    storage = sys_conf.build_storage()
+    # stop the collectors first, run again to resume an interrupted migration
+    total = await storage.partition_tables()
+    print(f'tweet and collected_tweet partitioned by month, {total} tweets copied')
+
+
+asyncio.run(async_main())
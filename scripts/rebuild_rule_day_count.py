@@ -0,0 +1,21 @@
+import asyncio
+import logging
+import os
+
+from restweetution import config_loader
+
+logging.basicConfig()
+logging.root.setLevel(logging.INFO)
+
+sys_conf = config_loader.load_system_config(os.getenv('SYSTEM_CONFIG'))
+
+
+async def async_main():
+    storage = sys_conf.build_storage()
+    # run backfill_tweet_media.py first, has_media is read from the tweet_media table
+    await storage.ensure_indexes()
+    await storage.rebuild_rule_day_count()
+    print('rule_day_count rebuilt')
+
+
+asyncio.run(async_main())
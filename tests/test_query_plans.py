@@ -0,0 +1,159 @@
+"""
+Regression tests of the query plans of the collected_tweet access patterns
+The statements of subqueries.py are run with EXPLAIN on a small generated collection, the plans must use the
+managed indexes of collected_tweet
+Needs a scratch postgres database, the tests are skipped without RESTWEETUTION_TEST_DATABASE_URL
+ex: RESTWEETUTION_TEST_DATABASE_URL=postgresql+asyncpg://postgres@localhost/restweet_test pytest tests
+WARNING: the tables of this database are dropped
+"""
+import asyncio
+import datetime
+import os
+
+import pytest
+
+DATABASE_URL = os.getenv('RESTWEETUTION_TEST_DATABASE_URL')
+
+pytestmark = pytest.mark.skipif(not DATABASE_URL, reason='RESTWEETUTION_TEST_DATABASE_URL is not set')
+
+if DATABASE_URL:
+    from sqlalchemy.future import select
+
+    from restweetution.models.bulk_data import BulkData
+    from restweetution.models.rule import Rule
+    from restweetution.models.storage.queries import CollectionQuery, TweetFilter
+    from restweetution.models.twitter import Tweet
+    from restweetution.storages.postgres_jsonb_storage.models import RULE_MATCH
+    from restweetution.storages.postgres_jsonb_storage.postgres_jsonb_storage import PostgresJSONBStorage
+    from restweetution.storages.postgres_jsonb_storage.subqueries import stmt_query_count_tweets, \
+        stmt_get_rule_matches, stmt_stream_tweets, stmt_media_tweet, stmt_query_tweets
+    from restweetution.storages.postgres_jsonb_storage.utils import date_from_to
+
+N_TWEETS = 20000
+RULES = 3
+START = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+DATE_FROM = START + datetime.timedelta(days=100)
+DATE_TO = START + datetime.timedelta(days=101)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def _fill(storage: 'PostgresJSONBStorage'):
+    await storage.reset_database()
+    rules = await storage.request_rules([Rule(query=f'plan{i}', tag=f'plan{i}') for i in range(RULES)])
+    # one tweet per 10 minutes, every tweet matches each rule, a tenth are direct hits
+    collected_at = datetime.datetime.now(tz=datetime.timezone.utc)
+    for start in range(0, N_TWEETS, 2000):
+        data = BulkData()
+        tweets = [Tweet(id=str(i), text=f'tweet {i}', created_at=START + datetime.timedelta(minutes=10 * i))
+                  for i in range(start, start + 2000)]
+        data.add_tweets(tweets)
+        for rule in rules:
+            rule.matches = {}
+            rule.add_direct_tweets([t.id for t in tweets if int(t.id) % 10 == 0], collected_at)
+            rule.add_includes_tweets([t.id for t in tweets if int(t.id) % 10 != 0], collected_at)
+        data.add_rules(rules)
+        await storage.save_bulk(data)
+    async with storage.get_engine().connect() as conn:
+        conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+        await conn.exec_driver_sql('ANALYZE')
+    return [r.id for r in rules]
+
+
+@pytest.fixture(scope='module')
+def rule_ids():
+    async def fill():
+        storage = PostgresJSONBStorage(DATABASE_URL)
+        try:
+            return await _fill(storage)
+        finally:
+            await storage.get_engine().dispose()
+
+    return run(fill())
+
+
+def explain(stmt) -> str:
+    """
+    @return: text of the plan of the statement
+    """
+    async def _explain():
+        storage = PostgresJSONBStorage(DATABASE_URL)
+        try:
+            async with storage.get_engine().begin() as conn:
+                compiled = stmt.compile(dialect=conn.dialect, compile_kwargs={'render_postcompile': True})
+                params = compiled.construct_params()
+                res = await conn.exec_driver_sql(f'EXPLAIN {compiled.string}',
+                                                 tuple(params[k] for k in compiled.positiontup))
+                return '\n'.join(r[0] for r in res)
+        finally:
+            await storage.get_engine().dispose()
+
+    return run(_explain())
+
+
+def test_ensure_indexes(rule_ids):
+    async def ensure():
+        storage = PostgresJSONBStorage(DATABASE_URL)
+        try:
+            return await storage.ensure_indexes()
+        finally:
+            await storage.get_engine().dispose()
+
+    # build_tables created them all
+    assert run(ensure()) == []
+
+
+def test_count_rule_date_range(rule_ids):
+    query = CollectionQuery(rule_ids=rule_ids[:1], date_from=DATE_FROM, date_to=DATE_TO)
+    plan = explain(stmt_query_count_tweets(query, TweetFilter()))
+    assert 'ix_collected_tweet_rule_date' in plan
+    assert ' on tweet ' not in plan
+
+
+def test_count_direct_hit_partial_index(rule_ids):
+    query = CollectionQuery(rule_ids=rule_ids[:1], date_from=DATE_FROM, date_to=DATE_TO, direct_hit=True)
+    plan = explain(stmt_query_count_tweets(query, TweetFilter()))
+    assert 'ix_collected_tweet_rule_date_direct_hit' in plan
+
+
+def test_count_rules_with_media(rule_ids):
+    query = CollectionQuery(rule_ids=rule_ids, date_from=DATE_FROM, date_to=DATE_TO)
+    plan = explain(stmt_query_count_tweets(query, TweetFilter(media=True)))
+    assert 'Seq Scan on collected_tweet' not in plan
+    assert ' on tweet ' not in plan
+
+
+def test_rule_matches_by_tweet_ids(rule_ids):
+    plan = explain(stmt_get_rule_matches(tweet_ids=['10', '20', '30']))
+    assert 'ix_collected_tweet_tweet_id' in plan
+    assert 'Seq Scan' not in plan
+
+
+def test_query_tweets_rule_date_range(rule_ids):
+    query = CollectionQuery(rule_ids=rule_ids[:1], date_from=DATE_FROM, date_to=DATE_TO, limit=100, order=1)
+    plan = explain(stmt_query_tweets(query, TweetFilter()))
+    assert 'ix_collected_tweet_rule_date' in plan
+    assert 'Seq Scan on collected_tweet' not in plan
+
+
+def test_stream_tweets_matches_lookup(rule_ids):
+    # without rule_ids the matches of each tweet are found by tweet_id
+    plan = explain(stmt_stream_tweets(CollectionQuery(date_from=DATE_FROM, date_to=DATE_TO), TweetFilter()))
+    assert 'ix_collected_tweet_tweet_id' in plan
+    assert 'Seq Scan on collected_tweet' not in plan
+
+
+def test_media_tweet_date_without_tweet_join(rule_ids):
+    query = CollectionQuery(rule_ids=rule_ids[:1], date_from=DATE_FROM, date_to=DATE_TO)
+    plan = explain(stmt_media_tweet(query))
+    assert ' on tweet ' not in plan
+    assert 'Seq Scan on collected_tweet' not in plan
+
+
+def test_date_filter_on_rule_match(rule_ids):
+    stmt = select(RULE_MATCH.c.tweet_id).where(RULE_MATCH.c.rule_id == rule_ids[0])
+    stmt = date_from_to(stmt, RULE_MATCH.c.tweet_created_at, DATE_FROM, DATE_TO)
+    plan = explain(stmt)
+    assert 'ix_collected_tweet_rule_date' in plan
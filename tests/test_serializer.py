@@ -0,0 +1,31 @@
+import datetime
+import decimal
+import json
+import uuid
+
+import pytest
+
+from restweetution.serializer import BACKENDS
+
+PAYLOAD = {
+    'created_at': datetime.datetime(2022, 5, 1, 12, 30, tzinfo=datetime.timezone.utc),
+    'naive': datetime.datetime(2022, 5, 1, 12, 30, 0, 4500),
+    'day': datetime.date(2022, 5, 1),
+    'delay': datetime.timedelta(minutes=5),
+    'id': uuid.UUID('12345678-1234-5678-1234-567812345678'),
+    'count': decimal.Decimal('1.50'),
+    'nested': [{'collected_at': datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)}, ('a', 1)],
+    'text': 'tweet #tag éà'
+}
+
+
+@pytest.mark.parametrize('name', list(BACKENDS))
+def test_dumps_same_values_as_json(name):
+    # the stored JSONB and the keyset cursors must not depend on the installed backend
+    try:
+        backend = BACKENDS[name]()
+    except ImportError:
+        pytest.skip(f'{name} is not installed')
+    res = json.loads(backend.dumps(PAYLOAD))
+    assert res == json.loads(json.dumps(PAYLOAD, default=str))
+    assert res['created_at'] == '2022-05-01 12:30:00+00:00'